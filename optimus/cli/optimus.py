@@ -1,13 +1,62 @@
+import os
+import shutil
 import sys
-from argparse import ArgumentParser
+import tempfile
+from argparse import ArgumentParser, Namespace
 
 from optimus.__version__ import VERSION
-from optimus.server.udp_listener import UdpServer
+from optimus.dns.cache import (
+    DEFAULT_MAX_BYTES,
+    DEFAULT_MAX_ENTRIES,
+    DEFAULT_MAX_NEGATIVE_TTL,
+    DEFAULT_MAX_RESPONSES,
+    DEFAULT_MAX_STALE_TTL,
+    DEFAULT_PREFETCH_MIN_HITS,
+    record_cache,
+    response_cache,
+)
+from optimus.dns.edns import DEFAULT_UDP_PAYLOAD_SIZE, MAX_UDP_PAYLOAD_SIZE, MIN_UDP_PAYLOAD_SIZE, edns_config
+from optimus.dns.forwarding import forwarding_rules
+from optimus.dns.local_zones import local_zones
+from optimus.dns.resolver import DEFAULT_QUERY_TIMEOUT, resolver_settings
+from optimus.dns.root_zone import DEFAULT_ROOT_ZONE_RELOAD_INTERVAL, local_root_zone
+from optimus.dns.snapshot import DEFAULT_SNAPSHOT_INTERVAL, cache_snapshot
+from optimus.networking.hedging import DEFAULT_MAX_HEDGE_RATIO, hedging_policy
+from optimus.server.tcp_listener import DEFAULT_IDLE_TIMEOUT, DEFAULT_MAX_CONNECTIONS
+
+# Directory through which worker processes share their Prometheus metrics, has to be set before
+# prometheus_client is imported (see optimus.prometheus)
+PROMETHEUS_MULTIPROC_DIR = "PROMETHEUS_MULTIPROC_DIR"
+
+
+def run_server(args: Namespace) -> None:
+    # Servers are imported lazily, so that the Prometheus client picks up multiprocess mode
+    from optimus.server.async_listener import AsyncUdpServer
+    from optimus.server.supervisor import Supervisor
+    from optimus.server.udp_listener import UdpServer
+
+    reuse_port = args.w > 1
+
+    def serve(worker: int = 0) -> None:
+        if args.w > 1 and args.s:
+            # Every worker has a cache of its own, saved to a file of its own
+            cache_snapshot.configure(f"{args.s}.{worker}", args.i, hot_names_path=args.N)
+        if args.m == "async":
+            AsyncUdpServer(args.p, reuse_port=reuse_port, max_tcp_connections=args.T, tcp_idle_timeout=args.I).run()
+        else:
+            UdpServer(args.p, args.t, reuse_port=reuse_port, max_tcp_connections=args.T, tcp_idle_timeout=args.I).run()
+
+    if args.w > 1:
+        Supervisor(args.w, serve).run()
+    else:
+        serve()
 
 
 def main(argv):
     DEFAULT_WORKER_THREADS = 9
     DEFAULT_PORT = 53
+    DEFAULT_MODE = "thread"
+    DEFAULT_WORKER_PROCESSES = 1
 
     arg_parser = ArgumentParser(
         prog="Optimus",
@@ -29,10 +78,180 @@ def main(argv):
         default=DEFAULT_WORKER_THREADS,
         help=f"Number of worker threads to spin up for handling requests (defaults to {DEFAULT_WORKER_THREADS})",
     )
+    arg_parser.add_argument(
+        "-w",
+        metavar="WORKERS",
+        type=int,
+        default=DEFAULT_WORKER_PROCESSES,
+        help=f"Number of worker processes sharing the port via SO_REUSEPORT (defaults to {DEFAULT_WORKER_PROCESSES})",
+    )
+    arg_parser.add_argument(
+        "-m",
+        metavar="MODE",
+        choices=["thread", "async"],
+        default=DEFAULT_MODE,
+        help=f"Server engine, 'thread' (thread pool) or 'async' (asyncio event loop) (defaults to {DEFAULT_MODE})",
+    )
+    arg_parser.add_argument(
+        "-c",
+        metavar="CACHE_SIZE",
+        type=int,
+        default=DEFAULT_MAX_ENTRIES,
+        help=f"Maximum number of RRsets to keep in the answer cache (defaults to {DEFAULT_MAX_ENTRIES})",
+    )
+    arg_parser.add_argument(
+        "-M",
+        metavar="CACHE_MEMORY",
+        type=int,
+        default=DEFAULT_MAX_BYTES // (1024 * 1024),
+        help=f"Memory budget of the answer cache in MiB (defaults to {DEFAULT_MAX_BYTES // (1024 * 1024)})",
+    )
+    arg_parser.add_argument(
+        "-C",
+        metavar="RESPONSE_CACHE_SIZE",
+        type=int,
+        default=DEFAULT_MAX_RESPONSES,
+        help=f"Maximum number of responses to keep in the response cache (defaults to {DEFAULT_MAX_RESPONSES})",
+    )
+    arg_parser.add_argument(
+        "-B",
+        metavar="RESPONSE_CACHE_MEMORY",
+        type=int,
+        default=DEFAULT_MAX_BYTES // (1024 * 1024),
+        help=f"Memory budget of the response cache in MiB (defaults to {DEFAULT_MAX_BYTES // (1024 * 1024)})",
+    )
+    arg_parser.add_argument(
+        "-n",
+        metavar="MAX_NEGATIVE_TTL",
+        type=int,
+        default=DEFAULT_MAX_NEGATIVE_TTL,
+        help=f"Upper bound in seconds on caching NXDOMAIN/NODATA answers (defaults to {DEFAULT_MAX_NEGATIVE_TTL})",
+    )
+    arg_parser.add_argument(
+        "-T",
+        metavar="MAX_TCP_CONNECTIONS",
+        type=int,
+        default=DEFAULT_MAX_CONNECTIONS,
+        help=f"Maximum number of client TCP connections open at a time (defaults to {DEFAULT_MAX_CONNECTIONS})",
+    )
+    arg_parser.add_argument(
+        "-I",
+        metavar="TCP_IDLE_TIMEOUT",
+        type=float,
+        default=DEFAULT_IDLE_TIMEOUT,
+        help=f"Seconds after which idle client TCP connections are closed (defaults to {DEFAULT_IDLE_TIMEOUT})",
+    )
+    arg_parser.add_argument(
+        "-e",
+        metavar="EDNS_BUFFER_SIZE",
+        type=int,
+        default=DEFAULT_UDP_PAYLOAD_SIZE,
+        help=f"EDNS UDP payload size advertised to clients and upstream servers, between {MIN_UDP_PAYLOAD_SIZE} "
+        f"and {MAX_UDP_PAYLOAD_SIZE} (defaults to {DEFAULT_UDP_PAYLOAD_SIZE})",
+    )
+    arg_parser.add_argument(
+        "-H",
+        metavar="HEDGE_RATIO",
+        type=float,
+        default=DEFAULT_MAX_HEDGE_RATIO,
+        help="Share of extra upstream queries that may be sent to a second nameserver when the first one is slow "
+        f"to respond, 0 disables hedging (defaults to {DEFAULT_MAX_HEDGE_RATIO})",
+    )
+    arg_parser.add_argument(
+        "-D",
+        metavar="QUERY_TIMEOUT",
+        type=float,
+        default=DEFAULT_QUERY_TIMEOUT,
+        help="Seconds a client query may take to resolve, including retries, before it is answered with SERVFAIL "
+        f"(defaults to {DEFAULT_QUERY_TIMEOUT})",
+    )
+    arg_parser.add_argument(
+        "-P",
+        metavar="PREFETCH_HITS",
+        type=int,
+        default=DEFAULT_PREFETCH_MIN_HITS,
+        help="Cache hits after which an answer is refreshed in the background shortly before it expires, "
+        f"0 disables prefetching (defaults to {DEFAULT_PREFETCH_MIN_HITS})",
+    )
+    arg_parser.add_argument(
+        "-S",
+        metavar="MAX_STALE_TTL",
+        type=int,
+        default=DEFAULT_MAX_STALE_TTL,
+        help="Seconds expired answers are kept to be served when resolving them again fails or is slow, "
+        f"0 disables serving stale answers (defaults to {DEFAULT_MAX_STALE_TTL})",
+    )
+    arg_parser.add_argument(
+        "-s",
+        metavar="SNAPSHOT_FILE",
+        help="File the cache is saved to periodically and on shutdown, and restored from on startup. "
+        "With several worker processes, each has its own file suffixed by the index of the worker",
+    )
+    arg_parser.add_argument(
+        "-i",
+        metavar="SNAPSHOT_INTERVAL",
+        type=float,
+        default=DEFAULT_SNAPSHOT_INTERVAL,
+        help=f"Seconds between two saves of the cache snapshot (defaults to {DEFAULT_SNAPSHOT_INTERVAL})",
+    )
+    arg_parser.add_argument(
+        "-N",
+        metavar="HOT_NAMES_FILE",
+        help="File listing names to resolve on startup, one per line optionally followed by a record type",
+    )
+    arg_parser.add_argument(
+        "-R",
+        metavar="ROOT_ZONE_FILE",
+        help="Copy of the root zone to refer queries to TLDs from, instead of querying the root servers (RFC 8806)",
+    )
+    arg_parser.add_argument(
+        "-z",
+        metavar="ZONE_FILE",
+        action="append",
+        default=[],
+        help="Zone file whose names are answered authoritatively instead of being resolved, as [ORIGIN=]PATH "
+        "(may be repeated)",
+    )
+    arg_parser.add_argument(
+        "-Z",
+        metavar="ZONE_RELOAD",
+        type=float,
+        default=DEFAULT_ROOT_ZONE_RELOAD_INTERVAL,
+        help="Seconds between two checks of the root zone and zone files for changes, 0 disables reloading "
+        f"(defaults to {DEFAULT_ROOT_ZONE_RELOAD_INTERVAL})",
+    )
+    arg_parser.add_argument(
+        "-F",
+        metavar="FORWARD",
+        action="append",
+        default=[],
+        help="Forward queries for names under a suffix to recursive resolvers instead of resolving them, as "
+        "SUFFIX=ADDRESS[:PORT][,ADDRESS[:PORT]...], the suffix being left out to forward every query "
+        "(may be repeated)",
+    )
     arg_parser.add_argument("-v", action="store_true", help="Get version info")
     args = arg_parser.parse_args(argv)
     if args.r:
-        UdpServer(args.p, args.t).run()
+        record_cache.configure(
+            max_entries=args.c, max_bytes=args.M * 1024 * 1024, max_negative_ttl=args.n, max_stale_ttl=args.S
+        )
+        edns_config.configure(args.e)
+        hedging_policy.configure(args.H)
+        resolver_settings.configure(args.D)
+        response_cache.configure(max_entries=args.C, max_bytes=args.B * 1024 * 1024, prefetch_min_hits=args.P)
+        cache_snapshot.configure(args.s, args.i, hot_names_path=args.N)
+        local_root_zone.configure(args.R, args.Z)
+        local_zones.configure(args.z, args.Z)
+        forwarding_rules.configure(args.F)
+        metrics_dir = None
+        if args.w > 1 and not os.environ.get(PROMETHEUS_MULTIPROC_DIR):
+            metrics_dir = tempfile.mkdtemp(prefix="optimus-metrics-")
+            os.environ[PROMETHEUS_MULTIPROC_DIR] = metrics_dir
+        try:
+            run_server(args)
+        finally:
+            if metrics_dir:
+                shutil.rmtree(metrics_dir, ignore_errors=True)
     elif args.v:
         print(f"Optimus Version: {VERSION}")
     else:
@@ -0,0 +1,763 @@
+import copy
+import random
+import struct
+import threading
+import time
+from collections import OrderedDict
+from ipaddress import IPv4Address
+from typing import Callable, List, Optional, Tuple
+
+from optimus.dns.models.packet import DNSHeader, DNSPacket, Question, ResponseCode, Section
+from optimus.dns.models.records import NS, A, Record, RecordClass, RecordType
+from optimus.utils import SingletonMeta, get_question_section, normalize_name
+
+CacheKey = Tuple[str, RecordType, RecordClass]
+
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+# Upper bound on how long NXDOMAIN/NODATA answers are cached for (RFC 2308 suggests 1-3 hours)
+DEFAULT_MAX_NEGATIVE_TTL = 3600
+# How long expired answers are kept around, to be served when they can't be refreshed (RFC 8767 suggests 1-3 days)
+DEFAULT_MAX_STALE_TTL = 86400
+# TTL of stale answers served to clients (RFC 8767 Section 4)
+STALE_ANSWER_TTL = 30
+DEFAULT_MAX_DELEGATIONS = 10000
+DEFAULT_MAX_RESPONSES = 10000
+DEFAULT_MAX_SERVERS = 10000
+# Timeouts of upstream queries are derived from the RTT of the server, within these bounds (in seconds)
+MIN_UPSTREAM_TIMEOUT = 0.05
+MAX_UPSTREAM_TIMEOUT = 5.0
+# RTT assumed for servers never queried before, so that they get a fair chance against known ones
+UNKNOWN_SERVER_RTT = 0.376
+UNKNOWN_SERVER_TIMEOUT = 1.0
+# Servers whose smoothed RTT lies within this band of the fastest one are picked from at random
+RTT_BAND = 0.025
+# Share of queries sent to a random server, so that the RTT of the other servers gets refreshed
+EXPLORATION_RATE = 0.05
+# Consecutive timeouts after which a server is considered down, and for how long it is left alone
+MAX_CONSECUTIVE_FAILURES = 3
+HOLD_DOWN_SECONDS = 60
+# Stats are forgotten after a while, since routes and server loads change
+SERVER_STATS_TTL = 900
+# Popular responses hit within this last share of their TTL get refreshed in the background (prefetched)
+PREFETCH_WINDOW = 0.1
+# Hits a response needs to have got to be prefetched, 0 disables prefetching
+DEFAULT_PREFETCH_MIN_HITS = 3
+# Rough per-record bookkeeping overhead (python objects, dict slots etc.) on top of its wire size
+RECORD_OVERHEAD_BYTES = 200
+
+
+def make_key(name: str, rtype: RecordType, rclass: RecordClass) -> CacheKey:
+    # Domain names are case-insensitive, so normalize them before using them as keys
+    return (normalize_name(name), rtype, rclass)
+
+
+class CacheEntry:
+    records: List[Record]
+    # Only populated for negative entries, holds the SOA record of the zone which denied the name
+    authority: List[Record]
+    response_code: ResponseCode
+    stored_at: float  # monotonic timestamp of insertion
+    expires_at: float
+    size: int  # Approximate memory footprint of this entry in bytes
+
+    def __init__(
+        self,
+        records: List[Record],
+        ttl: int,
+        size: int,
+        response_code: ResponseCode = ResponseCode.NOERROR,
+        authority: Optional[List[Record]] = None,
+    ) -> None:
+        self.records = records
+        self.authority = authority if authority else []
+        self.response_code = response_code
+        self.stored_at = time.monotonic()
+        self.expires_at = self.stored_at + ttl
+        self.size = size
+
+    @property
+    def is_negative(self) -> bool:
+        return not self.records
+
+
+class RecordCache(metaclass=SingletonMeta):
+    """
+    Thread safe RRset cache keyed by (qname, qtype, qclass).
+    Entries expire once the lowest TTL amongst their records runs out, and the least recently used
+    entries are evicted once either the entry or the memory budget is exhausted.
+    Negative answers (NXDOMAIN/NODATA) are cached as per RFC 2308, and a cached NXDOMAIN also denies
+    every name below it (RFC 8020). Expired entries are kept for a while longer, so that they can still be
+    served as stale answers when resolving them again fails (RFC 8767)
+    """
+
+    def __init__(
+        self,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        max_negative_ttl: int = DEFAULT_MAX_NEGATIVE_TTL,
+        max_stale_ttl: int = DEFAULT_MAX_STALE_TTL,
+    ) -> None:
+        self.__entries: OrderedDict[CacheKey, CacheEntry] = OrderedDict()
+        # Index of names known to not exist, pointing to the cache entry holding the NXDOMAIN answer
+        self.__nxdomains: dict[Tuple[str, RecordClass], CacheKey] = dict()
+        self.__lock = threading.Lock()
+        self.__max_entries = max_entries
+        self.__max_bytes = max_bytes
+        self.__max_negative_ttl = max_negative_ttl
+        self.__max_stale_ttl = max_stale_ttl
+        self.__used_bytes = 0
+
+    def configure(
+        self,
+        max_entries: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        max_negative_ttl: Optional[int] = None,
+        max_stale_ttl: Optional[int] = None,
+    ) -> None:
+        with self.__lock:
+            if max_entries is not None:
+                self.__max_entries = max_entries
+            if max_bytes is not None:
+                self.__max_bytes = max_bytes
+            if max_negative_ttl is not None:
+                self.__max_negative_ttl = max_negative_ttl
+            if max_stale_ttl is not None:
+                self.__max_stale_ttl = max_stale_ttl
+            self.__evict()
+
+    def get(self, name: str, rtype: RecordType, rclass: RecordClass) -> Optional[List[Record]]:
+        """Returns copies of the cached records with their TTLs counted down, or None on a miss"""
+        key = make_key(name, rtype, rclass)
+        with self.__lock:
+            entry = self.__lookup(key)
+        if not entry or entry.is_negative:
+            return None
+        return self.__countdown(entry.records, entry)
+
+    def get_response(self, query_packet: DNSPacket) -> Optional[DNSPacket]:
+        """Builds a response for the query out of cached positive or negative answers, None on a miss"""
+        question = query_packet.questions[0]
+        key = make_key(question.name, question.rtype, question.qclass)
+        with self.__lock:
+            entry = self.__lookup(key) or self.__lookup_nxdomain_cut(key[0], question.qclass)
+        if not entry:
+            return None
+        return self.__build_response(
+            query_packet, entry, self.__countdown(entry.records, entry), self.__countdown(entry.authority, entry)
+        )
+
+    def get_stale_response(self, query_packet: DNSPacket) -> Optional[DNSPacket]:
+        """
+        Builds a response for the query out of cached answers which may have expired, as long as they did
+        within the stale window. Their TTL is set to STALE_ANSWER_TTL, None if there is nothing to serve
+        """
+        question = query_packet.questions[0]
+        with self.__lock:
+            entry = self.__lookup(make_key(question.name, question.rtype, question.qclass), allow_stale=True)
+        if not entry:
+            return None
+        answers = [self.__with_ttl(rec, STALE_ANSWER_TTL) for rec in entry.records]
+        authority = [self.__with_ttl(rec, STALE_ANSWER_TTL) for rec in entry.authority]
+        return self.__build_response(query_packet, entry, answers, authority)
+
+    def export_responses(self) -> List[DNSPacket]:
+        """Builds a response out of every entry which hasn't expired yet, so that the cache can be saved"""
+        now = time.monotonic()
+        with self.__lock:
+            entries = [(key, entry) for key, entry in self.__entries.items() if entry.expires_at > now]
+        return [
+            self.__build_response(
+                DNSPacket(DNSHeader(id=0, question_count=1), [Question(*key)]),
+                entry,
+                self.__countdown(entry.records, entry),
+                self.__countdown(entry.authority, entry),
+            )
+            for key, entry in entries
+        ]
+
+    def __build_response(
+        self, query_packet: DNSPacket, entry: CacheEntry, answers: List[Record], authority: List[Record]
+    ) -> DNSPacket:
+        return DNSPacket(
+            DNSHeader(
+                id=query_packet.header.ID,
+                is_recursion_desired=query_packet.header.is_recursion_desired,
+                response_code=entry.response_code,
+                question_count=len(query_packet.questions),
+                answer_count=len(answers),
+                nameserver_records_count=len(authority),
+            ),
+            questions=query_packet.questions,
+            answers=answers,
+            nameserver_records=authority,
+        )
+
+    def put(self, name: str, rtype: RecordType, rclass: RecordClass, records: List[Record]) -> None:
+        if not records:
+            return
+        ttl = min(rec.ttl for rec in records)
+        if ttl <= 0:
+            return
+        size = sum(len(rec.to_bin()) + RECORD_OVERHEAD_BYTES for rec in records)
+        self.__insert(make_key(name, rtype, rclass), CacheEntry([copy.copy(rec) for rec in records], ttl, size))
+
+    def get_negative_ttl(self, soa: Record) -> int:
+        """Time a denial carrying the SOA record may be cached for, capped by the configured maximum"""
+        # RFC 2308 Section 5, the negative TTL is the minimum of the SOA's own TTL and its MINIMUM field
+        return min(soa.ttl, soa.minimum, self.__max_negative_ttl)
+
+    def put_negative(self, name: str, rtype: RecordType, rclass: RecordClass, rcode: ResponseCode, soa: Record) -> None:
+        ttl = self.get_negative_ttl(soa)
+        if ttl <= 0:
+            return
+        soa = copy.copy(soa)
+        soa.ttl = ttl
+        size = len(soa.to_bin()) + RECORD_OVERHEAD_BYTES
+        key = make_key(name, rtype, rclass)
+        self.__insert(key, CacheEntry([], ttl, size, response_code=rcode, authority=[soa]))
+
+    def put_response(self, response_packet: DNSPacket) -> None:
+        """Caches the answer section of a successful response, or the denial of a negative one, against its question"""
+        if not response_packet.questions:
+            return
+        question = response_packet.questions[0]
+        response_code = response_packet.header.response_code
+        if response_code == ResponseCode.NOERROR and response_packet.answers:
+            self.put(question.name, question.rtype, question.qclass, response_packet.answers)
+            return
+        if response_code not in (ResponseCode.NOERROR, ResponseCode.NXDOMAIN) or response_packet.answers:
+            # TODO: Cache negative answers at the end of a CNAME chain
+            return
+        soa_records = response_packet.get_records(Section.AUTHORITY, RecordType.SOA)
+        if not soa_records:
+            # RFC 2308 Section 5, negative responses without SOA records SHOULD NOT be cached
+            return
+        self.put_negative(question.name, question.rtype, question.qclass, response_code, soa_records[0])
+
+    def delete(self, name: str, rtype: RecordType, rclass: RecordClass) -> None:
+        with self.__lock:
+            self.__remove(make_key(name, rtype, rclass))
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__entries.clear()
+            self.__nxdomains.clear()
+            self.__used_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    @property
+    def used_bytes(self) -> int:
+        return self.__used_bytes
+
+    def __lookup(self, key: CacheKey, allow_stale: bool = False) -> Optional[CacheEntry]:
+        # Caller must hold the lock
+        entry = self.__entries.get(key)
+        if not entry:
+            return None
+        now = time.monotonic()
+        if entry.expires_at <= now:
+            if entry.expires_at + self.__max_stale_ttl <= now:
+                self.__remove(key)
+                return None
+            if not allow_stale:
+                return None
+        self.__entries.move_to_end(key)
+        return entry
+
+    def __lookup_nxdomain_cut(self, name: str, rclass: RecordClass) -> Optional[CacheEntry]:
+        # Caller must hold the lock. Walks up from the name towards the root looking for a cached NXDOMAIN
+        labels = name.split(".")
+        for i in range(len(labels)):
+            key = self.__nxdomains.get((".".join(labels[i:]), rclass))
+            if key:
+                entry = self.__lookup(key)
+                if entry:
+                    return entry
+        return None
+
+    def __insert(self, key: CacheKey, entry: CacheEntry) -> None:
+        with self.__lock:
+            if key in self.__entries:
+                self.__remove(key)
+            self.__entries[key] = entry
+            self.__used_bytes += entry.size
+            if entry.response_code == ResponseCode.NXDOMAIN:
+                self.__nxdomains[(key[0], key[2])] = key
+            self.__evict()
+
+    def __remove(self, key: CacheKey) -> None:
+        entry = self.__entries.pop(key, None)
+        if entry:
+            self.__forget(key, entry)
+
+    def __forget(self, key: CacheKey, entry: CacheEntry) -> None:
+        self.__used_bytes -= entry.size
+        if entry.response_code == ResponseCode.NXDOMAIN and self.__nxdomains.get((key[0], key[2])) == key:
+            del self.__nxdomains[(key[0], key[2])]
+
+    def __evict(self) -> None:
+        # Caller must hold the lock. Entries are kept in LRU order, oldest first
+        while self.__entries and (len(self.__entries) > self.__max_entries or self.__used_bytes > self.__max_bytes):
+            key, entry = self.__entries.popitem(last=False)
+            self.__forget(key, entry)
+
+    def __countdown(self, records: List[Record], entry: CacheEntry) -> List[Record]:
+        elapsed = int(time.monotonic() - entry.stored_at)
+        return [self.__with_ttl(rec, rec.ttl - elapsed) for rec in records]
+
+    def __with_ttl(self, record: Record, ttl: int) -> Record:
+        rec = copy.copy(record)
+        rec.ttl = max(ttl, 0)
+        return rec
+
+
+class Delegation:
+    zone: str
+    nameservers: List[str]  # Names of the nameservers authoritative for the zone
+    addresses: dict[str, List[str]]  # Nameserver name -> IPv4 addresses learnt from glue records
+    expires_at: float
+
+    def __init__(self, zone: str, nameservers: List[str], addresses: dict[str, List[str]], ttl: int) -> None:
+        self.zone = zone
+        self.nameservers = nameservers
+        self.addresses = addresses
+        self.expires_at = time.monotonic() + ttl
+
+    @classmethod
+    def from_referral(cls, response_packet: DNSPacket) -> Optional["Delegation"]:
+        """Builds the zone cut described by the NS records and glue of a referral, None if it isn't one"""
+        ns_records = response_packet.get_records(Section.AUTHORITY, RecordType.NS)
+        if not ns_records:
+            return None
+        zone = normalize_name(ns_records[0].name)
+        ns_records = [rec for rec in ns_records if normalize_name(rec.name) == zone]
+        nameservers = list(dict.fromkeys(normalize_name(rec.nsdname) for rec in ns_records))
+        ttls = [rec.ttl for rec in ns_records]
+        addresses: dict[str, List[str]] = dict()
+        # Only A glue is of any use, other additional records don't even get parsed
+        for rec in response_packet.get_records(Section.ADDITIONAL, RecordType.A):
+            name = normalize_name(rec.name)
+            if name in nameservers:
+                addresses.setdefault(name, []).append(str(rec.ipv4_address))
+                ttls.append(rec.ttl)
+        return cls(zone, nameservers, addresses, min(ttls))
+
+    def to_referral(self) -> DNSPacket:
+        """Inverse of `from_referral`, the records carry the time left before the delegation expires as TTL"""
+        ttl = max(int(self.expires_at - time.monotonic()), 0)
+        ns_records: List[Record] = [NS(self.zone, RecordType.NS, RecordClass.IN, ttl, 0, ns) for ns in self.nameservers]
+        glue_records: List[Record] = [
+            A(ns, RecordType.A, RecordClass.IN, ttl, 4, IPv4Address(addr))
+            for ns in self.nameservers
+            for addr in self.addresses.get(ns, [])
+        ]
+        return DNSPacket(
+            DNSHeader(
+                id=0,
+                question_count=1,
+                nameserver_records_count=len(ns_records),
+                additional_records_count=len(glue_records),
+            ),
+            [Question(self.zone, RecordType.NS, RecordClass.IN)],
+            nameserver_records=ns_records,
+            additional_records=glue_records,
+        )
+
+    def get_server_addresses(self) -> List[str]:
+        return [addr for ns in self.nameservers for addr in self.addresses.get(ns, [])]
+
+    def __repr__(self) -> str:
+        rep_dict = {
+            "zone": self.zone,
+            "nameservers": self.nameservers,
+            "addresses": self.addresses,
+        }
+        return str(rep_dict)
+
+
+class DelegationCache(metaclass=SingletonMeta):
+    """
+    Thread safe cache of zone cuts, i.e the NS records of a zone along with the glue addresses of those
+    nameservers as learnt from referrals. Lets the resolver start iterating at the closest known zone
+    instead of at the root
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_DELEGATIONS) -> None:
+        self.__entries: OrderedDict[str, Delegation] = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__max_entries = max_entries
+
+    def configure(self, max_entries: int) -> None:
+        with self.__lock:
+            self.__max_entries = max_entries
+            self.__evict()
+
+    def put(self, delegation: Delegation) -> None:
+        if delegation.expires_at <= time.monotonic():
+            return
+        with self.__lock:
+            self.__entries[delegation.zone] = delegation
+            self.__entries.move_to_end(delegation.zone)
+            self.__evict()
+
+    def get(self, zone: str) -> Optional[Delegation]:
+        zone = normalize_name(zone)
+        with self.__lock:
+            delegation = self.__entries.get(zone)
+            if not delegation:
+                return None
+            if delegation.expires_at <= time.monotonic():
+                del self.__entries[zone]
+                return None
+            self.__entries.move_to_end(zone)
+            return delegation
+
+    def export_delegations(self) -> List[Delegation]:
+        now = time.monotonic()
+        with self.__lock:
+            return [delegation for delegation in self.__entries.values() if delegation.expires_at > now]
+
+    def get_closest(self, name: str) -> Optional[Delegation]:
+        """Returns the deepest cached delegation enclosing the name which has usable nameserver addresses"""
+        labels = normalize_name(name).split(".")
+        for i in range(len(labels)):
+            delegation = self.get(".".join(labels[i:]))
+            if delegation and delegation.get_server_addresses():
+                return delegation
+        return None
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__entries.clear()
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def __evict(self) -> None:
+        # Caller must hold the lock
+        while len(self.__entries) > self.__max_entries:
+            self.__entries.popitem(last=False)
+
+
+class ServerStats:
+    srtt: float  # Smoothed round trip time in seconds
+    rttvar: float  # Round trip time variation
+    timeout: float
+    failures: int  # Consecutive timeouts
+    held_down_until: float
+    updated_at: float
+
+    def __init__(self, rtt: float) -> None:
+        self.srtt = rtt
+        self.rttvar = rtt / 2
+        self.timeout = self.get_rto()
+        self.failures = 0
+        self.held_down_until = 0.0
+        self.updated_at = time.monotonic()
+
+    def get_expected_rtt(self) -> float:
+        # Servers which just timed out are expected to take as long as their (backed off) timeout
+        return max(self.srtt, self.timeout) if self.failures else self.srtt
+
+    def get_rto(self) -> float:
+        # Retransmission timeout as computed for TCP (RFC 6298 Section 2)
+        return min(max(self.srtt + 4 * self.rttvar, MIN_UPSTREAM_TIMEOUT), MAX_UPSTREAM_TIMEOUT)
+
+
+class InfraCache(metaclass=SingletonMeta):
+    """
+    Thread safe table of the smoothed RTT and its variation for every nameserver address queried, from which
+    upstream queries get their timeout and servers to query are picked. The fastest servers are preferred,
+    while a few queries still go to the others so that their RTT keeps up with how they perform.
+    Servers which keep on timing out are put on hold-down, and only queried when there is no other choice
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_SERVERS) -> None:
+        self.__entries: OrderedDict[str, ServerStats] = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__max_entries = max_entries
+
+    def get_timeout(self, server_addr: str) -> float:
+        with self.__lock:
+            stats = self.__lookup(server_addr)
+            return stats.timeout if stats else UNKNOWN_SERVER_TIMEOUT
+
+    def get_hedge_delay(self, server_addr: str) -> float:
+        """How long to wait on the server before asking another one too, i.e about as long as its slowest replies"""
+        with self.__lock:
+            stats = self.__lookup(server_addr)
+            if not stats:
+                return UNKNOWN_SERVER_RTT
+            return min(max(stats.get_expected_rtt() + 2 * stats.rttvar, MIN_UPSTREAM_TIMEOUT), stats.timeout)
+
+    def get_rtt(self, server_addr: str) -> float:
+        with self.__lock:
+            stats = self.__lookup(server_addr)
+            return stats.srtt if stats else UNKNOWN_SERVER_RTT
+
+    def is_held_down(self, server_addr: str) -> bool:
+        with self.__lock:
+            stats = self.__lookup(server_addr)
+            return stats is not None and stats.held_down_until > time.monotonic()
+
+    def select(self, server_addresses: List[str]) -> str:
+        """Picks the server to query out of the given (non-empty) list"""
+        now = time.monotonic()
+        with self.__lock:
+            stats = [self.__lookup(addr) for addr in server_addresses]
+        available = [
+            (stat.get_expected_rtt() if stat else UNKNOWN_SERVER_RTT, addr)
+            for addr, stat in zip(server_addresses, stats)
+            if not stat or stat.held_down_until <= now
+        ]
+        if not available:
+            # Every server is on hold-down, go with the one to come out of it first
+            held_down = [(stat.held_down_until if stat else 0.0, addr) for addr, stat in zip(server_addresses, stats)]
+            return min(held_down)[1]
+        if random.random() < EXPLORATION_RATE:
+            return random.choice(available)[1]
+        fastest = min(rtt for rtt, _ in available)
+        return random.choice([addr for rtt, addr in available if rtt <= fastest + RTT_BAND])
+
+    def record_rtt(self, server_addr: str, rtt: float) -> None:
+        with self.__lock:
+            stats = self.__lookup(server_addr)
+            if not stats:
+                self.__insert(server_addr, ServerStats(rtt))
+                return
+            # RFC 6298 Section 2.3, with alpha = 1/8 and beta = 1/4
+            stats.rttvar = 0.75 * stats.rttvar + 0.25 * abs(stats.srtt - rtt)
+            stats.srtt = 0.875 * stats.srtt + 0.125 * rtt
+            stats.timeout = stats.get_rto()
+            stats.failures = 0
+            stats.held_down_until = 0.0
+            stats.updated_at = time.monotonic()
+            self.__entries.move_to_end(server_addr)
+
+    def record_timeout(self, server_addr: str) -> None:
+        with self.__lock:
+            stats = self.__lookup(server_addr)
+            if not stats:
+                stats = ServerStats(UNKNOWN_SERVER_RTT)
+                stats.timeout = UNKNOWN_SERVER_TIMEOUT
+                self.__insert(server_addr, stats)
+            # Back off, the server may just be slower than it used to be (RFC 6298 Section 5.5)
+            stats.timeout = min(stats.timeout * 2, MAX_UPSTREAM_TIMEOUT)
+            stats.failures += 1
+            stats.updated_at = time.monotonic()
+            if stats.failures >= MAX_CONSECUTIVE_FAILURES:
+                stats.held_down_until = stats.updated_at + HOLD_DOWN_SECONDS
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__entries.clear()
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def __lookup(self, server_addr: str) -> Optional[ServerStats]:
+        # Caller must hold the lock
+        stats = self.__entries.get(server_addr)
+        if stats and stats.updated_at + SERVER_STATS_TTL <= time.monotonic():
+            del self.__entries[server_addr]
+            return None
+        return stats
+
+    def __insert(self, server_addr: str, stats: ServerStats) -> None:
+        # Caller must hold the lock
+        self.__entries[server_addr] = stats
+        while len(self.__entries) > self.__max_entries:
+            self.__entries.popitem(last=False)
+
+
+def get_question_key(query: bytes) -> Optional[bytes]:
+    """
+    Extracts a cache key straight out of the wire format of a standard query with a single question,
+    i.e the lowercased question name followed by the Type and Class bytes
+    """
+    # Header must be a query (QR unset) with OPCODE 0 (QUERY) and exactly one question
+    if len(query) < 12 or query[2] & 0xF8 or query[4:6] != b"\x00\x01":
+        return None
+    question = get_question_section(query)
+    if question is None:
+        return None
+    # Only the name is case-insensitive, Type and Class bytes must be left alone
+    return question[:-4].lower() + question[-4:]
+
+
+class ResponseEntry:
+    data: bytes  # Serialized response
+    ttl_offsets: List[int]
+    ttls: List[int]
+    question_length: int  # Length of the question section, which starts right after the 12 byte header
+    stored_at: float
+    expires_at: float
+    prefetch_at: float  # Hits from then on trigger a refresh of the response
+    hits: int
+    is_prefetching: bool
+
+    def __init__(self, data: bytes, ttl_offsets: List[int], ttls: List[int], question_length: int) -> None:
+        self.data = data
+        self.ttl_offsets = ttl_offsets
+        self.ttls = ttls
+        self.question_length = question_length
+        self.stored_at = time.monotonic()
+        self.expires_at = self.stored_at + min(ttls)
+        self.prefetch_at = self.expires_at - min(ttls) * PREFETCH_WINDOW
+        self.hits = 0
+        self.is_prefetching = False
+
+
+def get_response_key(query: bytes) -> Optional[bytes]:
+    """
+    Queries sharing the question and the RD flag get the very same response, e.g queries without RD
+    may well be answered with a referral where the ones with RD get the answer
+    """
+    question_key = get_question_key(query)
+    if question_key is None:
+        return None
+    return bytes([query[2] & 0x01]) + question_key
+
+
+def is_cacheable_response(response_packet: DNSPacket) -> bool:
+    """
+    Whether the response is worth caching as is, i.e it either answers the question, or denies it with
+    a SOA record telling how long for (RFC 2308 Section 5). Referrals and errors never are
+    """
+    response_code = response_packet.header.response_code
+    if response_code == ResponseCode.NOERROR and response_packet.answers:
+        return True
+    return (
+        response_code in (ResponseCode.NOERROR, ResponseCode.NXDOMAIN)
+        and not response_packet.answers
+        and bool(response_packet.get_records(Section.AUTHORITY, RecordType.SOA))
+    )
+
+
+class ResponseCache(metaclass=SingletonMeta):
+    """
+    Thread safe cache of fully serialized responses, keyed by question and RD flag. On a hit the cached bytes
+    are copied and only the ID, the question (to echo the client's casing) and the decremented TTLs are patched in,
+    so that neither the query nor the response ever has to be parsed or serialized.
+    Popular responses hit shortly before they expire are handed over to the prefetcher, if one is set,
+    which is expected to resolve the query again in the background and cache the fresh response
+    """
+
+    def __init__(
+        self,
+        max_entries: int = DEFAULT_MAX_RESPONSES,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        prefetch_min_hits: int = DEFAULT_PREFETCH_MIN_HITS,
+    ) -> None:
+        self.__entries: OrderedDict[bytes, ResponseEntry] = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__max_entries = max_entries
+        self.__max_bytes = max_bytes
+        self.__prefetch_min_hits = prefetch_min_hits
+        self.__prefetcher: Optional[Callable[[bytes], None]] = None
+        self.__used_bytes = 0
+
+    def configure(
+        self,
+        max_entries: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        prefetch_min_hits: Optional[int] = None,
+    ) -> None:
+        with self.__lock:
+            if max_entries is not None:
+                self.__max_entries = max_entries
+            if max_bytes is not None:
+                self.__max_bytes = max_bytes
+            if prefetch_min_hits is not None:
+                self.__prefetch_min_hits = prefetch_min_hits
+            self.__evict()
+
+    def set_prefetcher(self, prefetcher: Optional[Callable[[bytes], None]]) -> None:
+        """Sets the callback the queries to prefetch are handed to, it must not block"""
+        self.__prefetcher = prefetcher
+
+    def get(self, query: bytes) -> Optional[bytearray]:
+        """Returns the cached response to the query patched up for this client, or None on a miss"""
+        key = get_response_key(query)
+        if key is None:
+            return None
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if not entry:
+                return None
+            now = time.monotonic()
+            if entry.expires_at <= now:
+                self.__used_bytes -= len(entry.data)
+                del self.__entries[key]
+                return None
+            self.__entries.move_to_end(key)
+            entry.hits += 1
+            prefetcher = self.__prefetcher if self.__should_prefetch(entry, now) else None
+            if prefetcher:
+                entry.is_prefetching = True
+        if prefetcher:
+            # Refreshed with the query of the client, only its question matters
+            prefetcher(bytes(query))
+        response = bytearray(entry.data)
+        # Copy over the ID, the question only differs in casing so it can be copied over as is as well
+        response[0:2] = query[0:2]
+        response[12 : 12 + entry.question_length] = query[12 : 12 + entry.question_length]
+        elapsed = int(now - entry.stored_at)
+        for offset, ttl in zip(entry.ttl_offsets, entry.ttls):
+            struct.pack_into(">I", response, offset, max(ttl - elapsed, 0))
+        return response
+
+    def put(self, query: bytes, response: bytes, ttl_offsets: List[int]) -> None:
+        """
+        Caches the serialized response to the query, given the offsets of the TTL fields within it.
+        Callers are expected to only hand over responses worth caching (see `is_cacheable_response`)
+        """
+        # Only NOERROR and NXDOMAIN responses to queries with a single question are worth caching
+        if response[3] & 0x0F not in (ResponseCode.NOERROR.value, ResponseCode.NXDOMAIN.value) or response[5] != 1:
+            return
+        key = get_response_key(query)
+        if key is None:
+            return
+        ttls = [struct.unpack_from(">I", response, offset)[0] for offset in ttl_offsets]
+        if not ttls or min(ttls) <= 0:
+            return
+        entry = ResponseEntry(bytes(response), ttl_offsets, ttls, len(key) - 1)
+        with self.__lock:
+            old_entry = self.__entries.pop(key, None)
+            if old_entry:
+                self.__used_bytes -= len(old_entry.data)
+            self.__entries[key] = entry
+            self.__used_bytes += len(entry.data)
+            self.__evict()
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__entries.clear()
+            self.__used_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def __should_prefetch(self, entry: ResponseEntry, now: float) -> bool:
+        # Caller must hold the lock. Every response is only prefetched once, its refreshed copy replaces it
+        return (
+            self.__prefetch_min_hits > 0
+            and entry.hits >= self.__prefetch_min_hits
+            and now >= entry.prefetch_at
+            and not entry.is_prefetching
+        )
+
+    def __evict(self) -> None:
+        # Caller must hold the lock
+        while self.__entries and (len(self.__entries) > self.__max_entries or self.__used_bytes > self.__max_bytes):
+            _, entry = self.__entries.popitem(last=False)
+            self.__used_bytes -= len(entry.data)
+
+
+record_cache = RecordCache()
+delegation_cache = DelegationCache()
+response_cache = ResponseCache()
+infra_cache = InfraCache()
@@ -0,0 +1,111 @@
+import struct
+from typing import List, Optional
+
+from optimus.dns.models.packet import HEADER_FORMAT, DNSPacket, Section
+from optimus.dns.models.records import OptPseudoRR, Record, RecordType
+from optimus.dns.models.wire import RECORD_FORMAT
+from optimus.utils import SingletonMeta, get_question_section
+
+# Avoids IP fragmentation on practically every path (DNS Flag Day 2020)
+DEFAULT_UDP_PAYLOAD_SIZE = 1232
+# Plain DNS limit, which also applies to clients advertising anything smaller (RFC 6891 Section 6.2.5)
+MIN_UDP_PAYLOAD_SIZE = 512
+MAX_UDP_PAYLOAD_SIZE = 4096
+TYPE_OPT = RecordType.OPT.value
+
+
+class EdnsConfig(metaclass=SingletonMeta):
+    """UDP payload size advertised to upstream servers as well as to clients"""
+
+    def __init__(self, udp_payload_size: int = DEFAULT_UDP_PAYLOAD_SIZE) -> None:
+        self.udp_payload_size = udp_payload_size
+
+    def configure(self, udp_payload_size: int) -> None:
+        if not MIN_UDP_PAYLOAD_SIZE <= udp_payload_size <= MAX_UDP_PAYLOAD_SIZE:
+            raise ValueError(f"EDNS buffer size must be between {MIN_UDP_PAYLOAD_SIZE} and {MAX_UDP_PAYLOAD_SIZE}")
+        self.udp_payload_size = udp_payload_size
+
+    def get_opt_record_bytes(self) -> bytes:
+        # Root name, no extended RCODE, version 0, DO bit unset and no options
+        return b"\x00" + RECORD_FORMAT.pack(TYPE_OPT, self.udp_payload_size, 0, 0)
+
+
+def make_opt_record() -> OptPseudoRR:
+    return OptPseudoRR("", RecordType.OPT, edns_config.udp_payload_size, 0, 0, [])
+
+
+def strip_opt_records(packet: DNSPacket) -> None:
+    """
+    Removes the OPT records of a response relayed from upstream, they are hop-by-hop and the one for
+    the client is only added once it is known whether the client supports EDNS (see `fit_response`)
+    """
+    if not packet.get_records(Section.ADDITIONAL, RecordType.OPT):
+        return
+    additional_records: List[Record] = [rec for rec in packet.additional_records if rec.rtype != RecordType.OPT]
+    packet.additional_records = additional_records
+    packet.header.additional_records_count = len(additional_records)
+
+
+def get_udp_payload_size(query: bytes) -> Optional[int]:
+    """Returns the UDP payload size advertised by the OPT record of the query, None if it has none"""
+    try:
+        _, _, _, question_count, answer_count, nameserver_count, additional_count = HEADER_FORMAT.unpack_from(query)
+        if not additional_count:
+            return None
+        pos = HEADER_FORMAT.size
+        for _ in range(question_count):
+            pos = __skip_name(query, pos) + 4
+        for _ in range(answer_count + nameserver_count + additional_count):
+            pos = __skip_name(query, pos)
+            rtype, rclass, _, length = RECORD_FORMAT.unpack_from(query, pos)
+            if rtype == TYPE_OPT:
+                payload_size: int = max(rclass, MIN_UDP_PAYLOAD_SIZE)
+                return payload_size
+            pos += RECORD_FORMAT.size + length
+    except (IndexError, struct.error):
+        pass
+    return None
+
+
+def fit_response(query: bytes, response: bytes, over_tcp: bool = False) -> bytes:
+    """
+    Adds our OPT record to the response if the query carried one, and truncates it when it doesn't fit
+    in the UDP payload size both sides support, in which case the client is expected to retry over TCP
+    """
+    client_payload_size = get_udp_payload_size(query)
+    opt_record = edns_config.get_opt_record_bytes() if client_payload_size is not None else b""
+    if opt_record:
+        with_opt_record = bytearray(response)
+        struct.pack_into(">H", with_opt_record, 10, struct.unpack_from(">H", response, 10)[0] + 1)
+        with_opt_record.extend(opt_record)
+        response = with_opt_record
+    if over_tcp:
+        return response
+    max_size = (
+        min(client_payload_size, edns_config.udp_payload_size)
+        if client_payload_size is not None
+        else MIN_UDP_PAYLOAD_SIZE
+    )
+    if len(response) <= max_size:
+        return response
+    # Whole RRsets can't be left out without the client knowing, so only the question is kept (RFC 2181 Section 9)
+    question = get_question_section(response) or b""
+    truncated = bytearray(response[0 : HEADER_FORMAT.size])
+    truncated[2] |= 0x02
+    struct.pack_into(">HHHH", truncated, 4, 1 if question else 0, 0, 0, 1 if opt_record else 0)
+    truncated.extend(question)
+    truncated.extend(opt_record)
+    return truncated
+
+
+def __skip_name(data: bytes, pos: int) -> int:
+    while True:
+        label_length = data[pos]
+        if label_length == 0:
+            return pos + 1
+        if label_length & 0xC0 == 0xC0:
+            return pos + 2
+        pos += 1 + label_length
+
+
+edns_config = EdnsConfig()
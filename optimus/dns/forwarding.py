@@ -0,0 +1,48 @@
+from ipaddress import IPv4Address
+from typing import Dict, List, Optional
+
+from optimus.utils import SingletonMeta, normalize_name, split_server_addr
+
+
+class ForwardingRules(metaclass=SingletonMeta):
+    """
+    Domain suffixes whose queries are forwarded to designated recursive resolvers (e.g corporate DNS)
+    instead of being resolved iteratively, the rule with the longest matching suffix applies.
+    A rule for the root domain forwards every query which no other rule matches
+    """
+
+    def __init__(self) -> None:
+        self.__rules: Dict[str, List[str]] = dict()
+
+    def configure(self, rules: List[str]) -> None:
+        """
+        Rules are written `suffix=address[,address...]`, or just as the addresses to forward every query.
+        Addresses may carry a port, e.g 127.0.0.1:5353
+        """
+        parsed: Dict[str, List[str]] = dict()
+        for rule in rules:
+            suffix, _, addresses = rule.rpartition("=")
+            servers = [addr.strip() for addr in addresses.split(",") if addr.strip()]
+            if not servers:
+                raise ValueError(f"Forwarding rule '{rule}' has no resolver to forward to")
+            for server in servers:
+                host, port = split_server_addr(server)
+                IPv4Address(host)
+                if not 0 < port < 65536:
+                    raise ValueError(f"Invalid port in forwarding rule '{rule}'")
+            parsed.setdefault(normalize_name(suffix), []).extend(servers)
+        self.__rules = parsed
+
+    def get_forwarders(self, name: str) -> Optional[List[str]]:
+        """Resolvers the query for the name is to be forwarded to, None if it is to be resolved iteratively"""
+        if not self.__rules:
+            return None
+        labels = normalize_name(name).split(".")
+        for i in range(len(labels)):
+            forwarders = self.__rules.get(".".join(labels[i:]))
+            if forwarders:
+                return forwarders
+        return self.__rules.get("")
+
+
+forwarding_rules = ForwardingRules()
@@ -0,0 +1,269 @@
+import copy
+from typing import Dict, List, Optional, Set, Tuple
+
+from optimus.dns.cache import Delegation
+from optimus.dns.models.packet import DNSHeader, DNSPacket, ResponseCode
+from optimus.dns.models.records import Record, RecordClass, RecordType
+from optimus.dns.parser.zone import ZoneFileParser
+from optimus.dns.reloader import ZoneFileReloader
+from optimus.logging.logger import log, log_debug, log_error
+from optimus.utils import SingletonMeta, get_question_section, is_subdomain, normalize_name
+
+# Interval (in seconds) at which zone files are checked for changes, never by default
+DEFAULT_ZONE_RELOAD_INTERVAL = 0
+# CNAMEs followed from one local name to another before giving up on the chain
+MAX_CNAME_CHAIN = 8
+
+# Response code along with the answer, authority and additional records of a lookup
+LookupResult = Tuple[ResponseCode, List[Record], List[Record], List[Record]]
+
+
+class Zone:
+    """Records of a zone indexed by owner name and type. Never modified once built, reloads build a new one"""
+
+    origin: str
+    soa: Record
+    records: Dict[str, Dict[RecordType, List[Record]]]  # Owner name -> Type -> Records
+    names: Set[str]  # Owner names, along with the empty non-terminals between them and the origin
+    cuts: Set[str]  # Names below the origin delegated to other nameservers
+
+    def __init__(self, records: List[Record]) -> None:
+        soa_records = [rec for rec in records if rec.rtype == RecordType.SOA]
+        if len(soa_records) != 1:
+            raise ValueError(f"Zone must have exactly one SOA record, found {len(soa_records)}")
+        self.soa = soa_records[0]
+        self.origin = normalize_name(self.soa.name)
+        self.records = dict()
+        self.names = {self.origin}
+        self.cuts = set()
+        for rec in records:
+            name = normalize_name(rec.name)
+            if not is_subdomain(name, self.origin):
+                raise ValueError(f"{rec.name} is outside of zone {self.origin or '.'}")
+            self.records.setdefault(name, {}).setdefault(rec.rtype, []).append(rec)
+            if rec.rtype == RecordType.NS and name != self.origin:
+                self.cuts.add(name)
+            while name not in self.names:
+                self.names.add(name)
+                name = name.partition(".")[2]
+        for name, rrsets in self.records.items():
+            # RFC 1034 Section 3.6.2, names with a CNAME can't have any other data
+            if RecordType.CNAME in rrsets and len(rrsets) > 1:
+                raise ValueError(f"{name} has a CNAME record along with other data")
+
+    def lookup(self, name: str, rtype: RecordType) -> LookupResult:
+        """
+        Looks the (normalized) name up as per RFC 1034 Section 4.3.2, i.e referring names at or below
+        delegations to the nameservers of the delegation, synthesizing answers out of wildcards (RFC 4592)
+        for names which don't exist, and denying the others along with the SOA of the zone
+        """
+        cut = self.__find_cut(name)
+        if cut:
+            ns_records = [copy.copy(rec) for rec in self.records[cut][RecordType.NS]]
+            return ResponseCode.NOERROR, [], ns_records, self.__get_glue(ns_records)
+        rrsets = self.records.get(name)
+        owner: Optional[str] = None
+        if rrsets is None:
+            if name in self.names:
+                # Empty non-terminal, the name exists but has no data at all
+                return ResponseCode.NOERROR, [], [self.__get_negative_soa()], []
+            wildcard = self.__find_wildcard(name)
+            if not wildcard:
+                return ResponseCode.NXDOMAIN, [], [self.__get_negative_soa()], []
+            rrsets, owner = self.records[wildcard], name
+        records = rrsets.get(rtype) or rrsets.get(RecordType.CNAME)
+        if not records:
+            return ResponseCode.NOERROR, [], [self.__get_negative_soa()], []
+        answers = [copy.copy(rec) for rec in records]
+        if owner is not None:
+            for rec in answers:
+                rec.name = owner
+        return ResponseCode.NOERROR, answers, [], []
+
+    def get_delegation(self, name: str) -> Optional[Delegation]:
+        """Zone cut the (normalized) name lies at or below, None if there is none or it has no glue to start from"""
+        cut = self.__find_cut(name)
+        if not cut:
+            return None
+        ns_records = self.records[cut][RecordType.NS]
+        nameservers = list(dict.fromkeys(normalize_name(rec.nsdname) for rec in ns_records))
+        addresses = {
+            ns: [str(rec.ipv4_address) for rec in self.records[ns][RecordType.A]]
+            for ns in nameservers
+            if RecordType.A in self.records.get(ns, {})
+        }
+        if not addresses:
+            return None
+        return Delegation(cut, nameservers, addresses, min(rec.ttl for rec in ns_records))
+
+    def __find_cut(self, name: str) -> Optional[str]:
+        while name != self.origin:
+            if name in self.cuts:
+                return name
+            name = name.partition(".")[2]
+        return None
+
+    def __find_wildcard(self, name: str) -> Optional[str]:
+        # The wildcard applying to a name is the one right below its closest existing ancestor
+        encloser = name.partition(".")[2]
+        while encloser not in self.names:
+            encloser = encloser.partition(".")[2]
+        wildcard = f"*.{encloser}" if encloser else "*"
+        return wildcard if wildcard in self.records else None
+
+    def __get_glue(self, ns_records: List[Record]) -> List[Record]:
+        glue: List[Record] = []
+        for ns in ns_records:
+            rrsets = self.records.get(normalize_name(ns.nsdname), {})
+            for rtype in (RecordType.A, RecordType.AAAA):
+                glue.extend(copy.copy(rec) for rec in rrsets.get(rtype, []))
+        return glue
+
+    def __get_negative_soa(self) -> Record:
+        # RFC 2308 Section 3, the TTL of the SOA of negative answers is the one they may be cached for
+        soa = copy.copy(self.soa)
+        soa.ttl = min(soa.ttl, soa.minimum)
+        return soa
+
+
+class LocalZones(metaclass=SingletonMeta):
+    """
+    Zones loaded from zone files, whose names are answered authoritatively instead of being resolved.
+    Zone files may be checked for changes periodically, the zones being swapped with the reloaded ones
+    as a whole (see `ZoneFileReloader`)
+    """
+
+    def __init__(self) -> None:
+        self.__zone_files: List[Tuple[str, str]] = []  # Origin (empty if set by the file itself), Path
+        self.__zones: Dict[str, Zone] = dict()
+        self.__reloader = ZoneFileReloader("local zones", self.__load_zone_files)
+
+    def configure(self, zone_files: List[str], reload_interval: float = DEFAULT_ZONE_RELOAD_INTERVAL) -> None:
+        """Zone files are given as their path, prefixed by `origin=` unless the file sets its own $ORIGIN"""
+        self.__zone_files = [
+            (origin, path) if path else ("", origin)
+            for origin, _, path in (zone_file.partition("=") for zone_file in zone_files)
+        ]
+        self.__reloader.configure([path for _, path in self.__zone_files], reload_interval)
+        self.__zones = dict()
+        if self.__zone_files and not self.load():
+            raise ValueError("Couldn't load the local zones")
+
+    def load(self) -> bool:
+        """Loads every zone file, keeping the previous zones if any of them can't be loaded"""
+        return self.__reloader.load()
+
+    def start(self) -> None:
+        """Checks the zone files for changes periodically, on a background thread"""
+        self.__reloader.start()
+
+    def stop(self) -> None:
+        self.__reloader.stop()
+
+    def answer(self, qpacket: DNSPacket) -> Optional[DNSPacket]:
+        """
+        Answers the query out of the zone enclosing its name, None if no local zone does. Names delegated
+        to other nameservers are only referred to them when recursion isn't desired, they are left to be
+        resolved through the delegation otherwise (see `get_delegation`)
+        """
+        zones = self.__zones
+        question = qpacket.questions[0]
+        if not zones or question.qclass != RecordClass.IN:
+            return None
+        name = normalize_name(question.name)
+        zone = self.__find_zone(zones, name)
+        if not zone or (qpacket.header.is_recursion_desired and zone.get_delegation(name)):
+            return None
+        answers: List[Record] = []
+        for _ in range(MAX_CNAME_CHAIN):
+            response_code, records, authority, additional = zone.lookup(name, question.rtype)
+            answers.extend(records)
+            # Follow CNAMEs pointing at other local names, the client is left to resolve the others
+            if not records or records[0].rtype != RecordType.CNAME or question.rtype == RecordType.CNAME:
+                break
+            name = normalize_name(records[0].cname)
+            next_zone = self.__find_zone(zones, name)
+            if not next_zone:
+                break
+            zone = next_zone
+        # Referrals carry the NS records of the delegation in authority, denials the SOA of the zone
+        is_referral = bool(authority) and authority[0].rtype == RecordType.NS
+        return DNSPacket(
+            DNSHeader(
+                id=qpacket.header.ID,
+                is_authoritative_answer=not is_referral,
+                is_recursion_desired=qpacket.header.is_recursion_desired,
+                response_code=response_code,
+                question_count=len(qpacket.questions),
+                answer_count=len(answers),
+                nameserver_records_count=len(authority),
+                additional_records_count=len(additional),
+            ),
+            questions=qpacket.questions,
+            answers=answers,
+            nameserver_records=authority,
+            additional_records=additional,
+        )
+
+    def covers(self, received_bytes: bytes) -> bool:
+        """
+        Whether the query is for a name within the local zones, looked up straight out of its wire format.
+        Such queries are never to be answered from the response cache, which may hold what they resolved to
+        before the zone was loaded or reloaded
+        """
+        zones = self.__zones
+        if not zones:
+            return False
+        question = get_question_section(received_bytes)
+        # Only class IN is answered locally
+        if question is None or question[-2:] != b"\x00\x01":
+            return False
+        labels: List[str] = []
+        pos = 0
+        while question[pos]:
+            labels.append(str(question[pos + 1 : pos + 1 + question[pos]], "latin-1"))
+            pos += question[pos] + 1
+        name = normalize_name(".".join(labels))
+        zone = self.__find_zone(zones, name)
+        # Same as `answer`, recursive queries for delegated names get resolved like any other
+        return zone is not None and not (received_bytes[2] & 0x01 and zone.get_delegation(name))
+
+    def get_delegation(self, name: str) -> Optional[Delegation]:
+        """Zone cut within the local zones which recursive queries for the name are to be resolved through"""
+        zones = self.__zones
+        if not zones:
+            return None
+        name = normalize_name(name)
+        zone = self.__find_zone(zones, name)
+        return zone.get_delegation(name) if zone else None
+
+    def __find_zone(self, zones: Dict[str, Zone], name: str) -> Optional[Zone]:
+        """Zone closest to the name, i.e the one with the longest origin enclosing it"""
+        while True:
+            zone = zones.get(name)
+            if zone or not name:
+                return zone
+            name = name.partition(".")[2]
+
+    def __load_zone_files(self, mtimes: List[float]) -> bool:
+        zones: Dict[str, Zone] = dict()
+        try:
+            for origin, path in self.__zone_files:
+                with open(path, "r") as f:
+                    parser = ZoneFileParser(f, origin, source=path)
+                    zone = Zone(parser.get_records())
+                if parser.skipped_types:
+                    log_debug(f"Skipped records of type {', '.join(sorted(parser.skipped_types))} of {path}")
+                if zone.origin in zones:
+                    raise ValueError(f"Zone {zone.origin or '.'} is loaded from more than one file")
+                zones[zone.origin] = zone
+        except (OSError, ValueError) as e:
+            log_error(f"Couldn't load the local zones {e!r}")
+            return False
+        self.__zones = zones
+        for zone in zones.values():
+            log(f"Loaded zone {zone.origin or '.'} serial {zone.soa.serial} with {len(zone.records)} names")
+        return True
+
+
+local_zones = LocalZones()
@@ -1,8 +1,14 @@
+import struct
 from enum import Enum
-from typing import List, Optional
+from typing import List, Optional, Tuple
 
 from optimus.dns.models.records import Record, RecordClass, RecordType
-from optimus.utils import to_n_bytes
+from optimus.dns.models.wire import WireWriter
+
+# ID, flags (2 single bytes) and the 4 section counts
+HEADER_FORMAT = struct.Struct(">HBBHHHH")
+# Type and Class of a question
+QUESTION_FORMAT = struct.Struct(">HH")
 
 
 class ResponseCode(Enum):  # 4 bits
@@ -27,14 +33,22 @@ class ResponseCode(Enum):  # 4 bits
     UNKNOWN = -1
 
     @classmethod
-    def from_value(cls, value: int):
-        for rec in ResponseCode:
-            if rec.value == value:
-                return rec
-        return ResponseCode.UNKNOWN
+    def from_value(cls, value: int) -> "ResponseCode":
+        return RESPONSE_CODES.get(value, ResponseCode.UNKNOWN)
+
+
+RESPONSE_CODES = {rcode.value: rcode for rcode in ResponseCode}
+
+
+class Section(Enum):
+    ANSWER = 0
+    AUTHORITY = 1
+    ADDITIONAL = 2
 
 
 class Question:
+    __slots__ = ("name", "rtype", "qclass")
+
     name: str
     rtype: RecordType
     qclass: RecordClass
@@ -44,21 +58,14 @@ class Question:
         self.rtype = rtype
         self.qclass = qclass
 
+    def write(self, writer: WireWriter) -> None:
+        writer.write_name(self.name)
+        writer.write_struct(QUESTION_FORMAT, self.rtype.value, self.qclass.value)
+
     def to_bin(self) -> bytearray:
-        dns_question_bin: bytearray = bytearray(0)
-        labels = self.name.split(".")
-        for label in labels:
-            # Write label's length
-            dns_question_bin.append(len(label))  # TODO: Add check to ensure that label length is <=63
-            for ch in label:
-                data = ord(ch) if ch != "." else 0
-                dns_question_bin.append(data)
-        dns_question_bin.append(0)
-        # Set Type (In 2 byte format)
-        dns_question_bin.extend(to_n_bytes(self.rtype.value, 2))
-        # Set Class (In 2 byte format)
-        dns_question_bin.extend(to_n_bytes(self.qclass.value, 2))
-        return dns_question_bin
+        writer = WireWriter(compress=False)
+        self.write(writer)
+        return writer.getvalue()
 
     def __repr__(self) -> str:
         rep_dict = {
@@ -70,6 +77,22 @@ class Question:
 
 
 class DNSHeader:
+    __slots__ = (
+        "ID",
+        "is_query",
+        "opcode",
+        "is_authoritative_answer",
+        "is_truncated_message",
+        "is_recursion_desired",
+        "is_recursion_available",
+        "z_flag",
+        "response_code",
+        "question_count",
+        "answer_count",
+        "nameserver_records_count",
+        "additional_records_count",
+    )
+
     ID: int  # 2 bytes
     is_query: bool
     opcode: int  # 4 bits
@@ -84,27 +107,32 @@ class DNSHeader:
     nameserver_records_count: int  # 2 bytes
     additional_records_count: int  # 2 bytes
 
+    def write(self, writer: WireWriter) -> None:
+        # QR, OPCODE, AA, TC and RD
+        msb_byte = int(not self.is_query) << 7
+        msb_byte |= (self.opcode & 0x0F) << 3
+        msb_byte |= int(self.is_authoritative_answer) << 2
+        msb_byte |= int(self.is_truncated_message) << 1
+        msb_byte |= int(self.is_recursion_desired)
+        # RA, Z and RCODE
+        lsb_byte = int(self.is_recursion_available) << 7
+        lsb_byte |= (self.z_flag & 0x07) << 4
+        lsb_byte |= self.response_code.value & 0x0F
+        writer.write_struct(
+            HEADER_FORMAT,
+            self.ID,
+            msb_byte,
+            lsb_byte,
+            self.question_count,
+            self.answer_count,
+            self.nameserver_records_count,
+            self.additional_records_count,
+        )
+
     def to_bin(self) -> bytearray:
-        dns_header_bin: bytearray = bytearray()
-        # Represent Id in 2 byte format
-        dns_header_bin.extend(to_n_bytes(self.ID, 2))
-        # Set QR, RD
-        qr_rd_flags = int(not self.is_query) << 7
-        qr_rd_flags |= int(self.is_recursion_desired)
-        dns_header_bin.append(qr_rd_flags)
-        data = int(self.is_recursion_available) << 7
-        data = data | (self.z_flag << 4)
-        data = data | self.response_code.value
-        dns_header_bin.append(data)
-        # Set Question Count
-        dns_header_bin.extend(to_n_bytes(self.question_count, 2))
-        # Set Answer Count
-        dns_header_bin.extend(to_n_bytes(self.answer_count, 2))
-        # Set NS Records Count
-        dns_header_bin.extend(to_n_bytes(self.nameserver_records_count, 2))
-        # Set Additional Records Count
-        dns_header_bin.extend(to_n_bytes(self.additional_records_count, 2))
-        return dns_header_bin
+        writer = WireWriter()
+        self.write(writer)
+        return writer.getvalue()
 
     def __init__(
         self,
@@ -156,6 +184,8 @@ class DNSHeader:
 
 
 class DNSPacket:
+    __slots__ = ("header", "questions", "answers", "nameserver_records", "additional_records")
+
     def __init__(
         self,
         dns_header: DNSHeader,
@@ -170,24 +200,29 @@ class DNSPacket:
         self.nameserver_records = nameserver_records if nameserver_records else []
         self.additional_records = additional_records if additional_records else []
 
+    def get_records(self, section: Section, rtype: RecordType) -> List[Record]:
+        """Returns the records of the given type in a section"""
+        records = (self.answers, self.nameserver_records, self.additional_records)[section.value]
+        return [rec for rec in records if rec.rtype == rtype]
+
     def to_bin(self) -> bytearray:
-        dns_packet_bin: bytearray = bytearray(0)
-        if self.header:
-            dns_packet_bin.extend(self.header.to_bin())
-        if self.questions:
-            for question in self.questions:
-                dns_packet_bin.extend(question.to_bin())
-        if self.answers:
-            for answer in self.answers:
-                dns_packet_bin.extend(answer.to_bin())
-        if self.nameserver_records:
-            for ns_record in self.nameserver_records:
-                dns_packet_bin.extend(ns_record.to_bin())
-        if self.additional_records:
-            for ad_record in self.additional_records:
-                dns_packet_bin.extend(ad_record.to_bin())
+        dns_packet_bin, _ = self.to_bin_with_ttl_offsets()
         return dns_packet_bin
 
+    def to_bin_with_ttl_offsets(self) -> Tuple[bytearray, List[int]]:
+        """Serializes the packet, along with the offsets of the TTL field of every resource record in it"""
+        writer = WireWriter()
+        ttl_offsets: List[int] = []
+        self.header.write(writer)
+        for question in self.questions:
+            question.write(writer)
+        for record in self.answers + self.nameserver_records + self.additional_records:
+            ttl_offset = record.write(writer)
+            # TTL field of the OPT pseudo-RR carries extended RCODE and flags instead
+            if record.rtype != RecordType.OPT:
+                ttl_offsets.append(ttl_offset)
+        return writer.getvalue(), ttl_offsets
+
     def __repr__(self) -> str:
         rep_dict = {
             "header": self.header,
@@ -1,7 +1,14 @@
+import struct
 from enum import Enum
 from ipaddress import IPv4Address, IPv6Address
+from typing import List
 
-from optimus.utils import to_n_bytes
+from optimus.dns.models.wire import UINT16_FORMAT, WireWriter
+
+# Serial, Refresh, Retry, Expire and Minimum of a SOA record
+SOA_FORMAT = struct.Struct(">IIIII")
+# Code and length of an option in the RDATA of an OPT record
+EDNS_OPTION_FORMAT = struct.Struct(">HH")
 
 
 class RecordType(Enum):  # 2 bytes
@@ -21,11 +28,8 @@ class RecordType(Enum):  # 2 bytes
     UNKNOWN = -1
 
     @classmethod
-    def from_value(cls, value: int):
-        for rec in RecordType:
-            if rec.value == value:
-                return rec
-        return RecordType.UNKNOWN
+    def from_value(cls, value: int) -> "RecordType":
+        return RECORD_TYPES.get(value, RecordType.UNKNOWN)
 
 
 class RecordClass(Enum):  # 2 bytes
@@ -33,14 +37,18 @@ class RecordClass(Enum):  # 2 bytes
     UNKNOWN = -1
 
     @classmethod
-    def from_value(cls, value: int):
-        for rec in RecordClass:
-            if rec.value == value:
-                return rec
-        return RecordClass.UNKNOWN
+    def from_value(cls, value: int) -> "RecordClass":
+        return RECORD_CLASSES.get(value, RecordClass.UNKNOWN)
+
+
+# Lookups by value, enums would otherwise be scanned for every field parsed
+RECORD_TYPES = {rtype.value: rtype for rtype in RecordType}
+RECORD_CLASSES = {rclass.value: rclass for rclass in RecordClass}
 
 
 class Record:
+    __slots__ = ("name", "rtype", "rec_class", "ttl", "length")
+
     name: str
     rtype: RecordType
     rec_class: RecordClass
@@ -72,25 +80,17 @@ class Record:
         self.ttl = ttl
         self.length = length
 
+    def write(self, writer: WireWriter) -> int:
+        """Writes the record to the message, returning the offset of its TTL field"""
+        return writer.write_record(self.name, self.rtype.value, self.rec_class.value, self.ttl, self.write_rdata)
+
+    def write_rdata(self, writer: WireWriter) -> None:
+        """Writes the type specific data of the record, which records of the base type have none of"""
+
     def to_bin(self) -> bytearray:
-        dns_record_bin: bytearray = bytearray(0)
-        labels = self.name.split(".")
-        for label in labels:
-            # Write label's length
-            dns_record_bin.append(len(label))  # TODO: Add check to ensure that label length is <=63
-            for ch in label:
-                data = ord(ch) if ch != "." else 0
-                dns_record_bin.append(data)
-        dns_record_bin.append(0)
-        # Set Type (In 2 byte format)
-        dns_record_bin.extend(to_n_bytes(self.rtype.value, 2))
-        # Set Class (In 2 byte format)
-        dns_record_bin.extend(to_n_bytes(self.rec_class.value, 2))
-        # Set TTL
-        dns_record_bin.extend(to_n_bytes(self.ttl, 4))
-        # Set Length
-        dns_record_bin.extend(to_n_bytes(self.length, 2))
-        return dns_record_bin
+        writer = WireWriter(compress=False)
+        self.write(writer)
+        return writer.getvalue()
 
     def __repr__(self) -> str:
         rep_dict = {
@@ -105,6 +105,8 @@ class Record:
 
 # Record Type A, representing IPv4 address of a host
 class A(Record):
+    __slots__ = ("ipv4_address",)
+
     ipv4_address: IPv4Address
 
     def __init__(
@@ -119,11 +121,8 @@ class A(Record):
         super().__init__(name, rtype, rclass, ttl, length)
         self.ipv4_address = address
 
-    def to_bin(self) -> bytearray:
-        dns_record_bin: bytearray = super().to_bin()
-        data = int(self.ipv4_address)
-        dns_record_bin.extend(to_n_bytes(data, 4))
-        return dns_record_bin
+    def write_rdata(self, writer: WireWriter) -> None:
+        writer.write_bytes(self.ipv4_address.packed)
 
     def __repr__(self) -> str:
         rep_dict = {
@@ -139,6 +138,8 @@ class A(Record):
 
 # Record Type AAAA, representing IPv6 address of a host
 class AAAA(Record):
+    __slots__ = ("ipv6_address",)
+
     ipv6_address: IPv6Address
 
     def __init__(
@@ -153,15 +154,8 @@ class AAAA(Record):
         super().__init__(name, rtype, rclass, ttl, length)
         self.ipv6_address = address
 
-    def to_bin(self) -> bytearray:
-        dns_record_bin: bytearray = super().to_bin()
-        cur_len = len(dns_record_bin)
-        data = int(self.ipv6_address)
-        dns_record_bin.extend(to_n_bytes(data, 16))
-        # Modify length to reflect the actual bytes present in the record
-        dns_record_bin[cur_len - 2] = (self.length & 0xFF00) >> 8
-        dns_record_bin[cur_len - 1] = self.length & 0xFF
-        return dns_record_bin
+    def write_rdata(self, writer: WireWriter) -> None:
+        writer.write_bytes(self.ipv6_address.packed)
 
     def __repr__(self) -> str:
         rep_dict = {
@@ -177,6 +171,8 @@ class AAAA(Record):
 
 # Record Type CNAME, representing Canonical name of a host
 class CNAME(Record):
+    __slots__ = ("cname",)
+
     cname: str
 
     def __init__(
@@ -191,23 +187,8 @@ class CNAME(Record):
         super().__init__(name, rtype, rclass, ttl, length)
         self.cname = cname
 
-    def to_bin(self) -> bytearray:
-        dns_record_bin: bytearray = super().to_bin()
-        cur_len = len(dns_record_bin)
-        labels = self.cname.split(".")
-        for label in labels:
-            # Write label's length
-            dns_record_bin.append(len(label))
-            for ch in label:
-                data = ord(ch) if ch != "." else 0
-                dns_record_bin.append(data)
-        dns_record_bin.append(0)
-        new_len = len(dns_record_bin)
-        self.length = new_len - cur_len
-        # Modify length to reflect the actual bytes present in the record
-        dns_record_bin[cur_len - 2] = (self.length & 0xFF00) >> 8
-        dns_record_bin[cur_len - 1] = self.length & 0xFF
-        return dns_record_bin
+    def write_rdata(self, writer: WireWriter) -> None:
+        writer.write_name(self.cname)
 
     def __repr__(self) -> str:
         rep_dict = {
@@ -223,6 +204,8 @@ class CNAME(Record):
 
 # Record Type MX, representing the host of the mail server for a domain
 class MX(Record):
+    __slots__ = ("preference", "exchange")
+
     # Lower pref value => High Priority
     preference: int  # 2 bytes : Specifies the preference given to this record among others
     exchange: str  # Domain name which specifies a host willing to act as a mail exchange
@@ -241,25 +224,9 @@ class MX(Record):
         self.preference = preference
         self.exchange = exchange
 
-    def to_bin(self) -> bytearray:
-        dns_record_bin: bytearray = super().to_bin()
-        cur_len = len(dns_record_bin)
-        dns_record_bin.append((self.preference & 0xFF00) >> 8)
-        dns_record_bin.append(self.preference & 0xFF)
-        labels = self.exchange.split(".")
-        for label in labels:
-            # Write label's length
-            dns_record_bin.append(len(label))
-            for ch in label:
-                data = ord(ch) if ch != "." else 0
-                dns_record_bin.append(data)
-        dns_record_bin.append(0)
-        new_len = len(dns_record_bin)
-        self.length = new_len - cur_len
-        # Modify length to reflect the actual bytes present in the record
-        dns_record_bin[cur_len - 2] = (self.length & 0xFF00) >> 8
-        dns_record_bin[cur_len - 1] = self.length & 0xFF
-        return dns_record_bin
+    def write_rdata(self, writer: WireWriter) -> None:
+        writer.write_struct(UINT16_FORMAT, self.preference)
+        writer.write_name(self.exchange)
 
     def __repr__(self) -> str:
         rep_dict = {
@@ -276,6 +243,8 @@ class MX(Record):
 
 # Record Type NS, Representing the DNS server address for a domain
 class NS(Record):
+    __slots__ = ("nsdname",)
+
     nsdname: str  # Domain name which specifies a host which should be authoritative for specified class and domain
 
     def __init__(
@@ -290,23 +259,8 @@ class NS(Record):
         super().__init__(name, rtype, rclass, ttl, length)
         self.nsdname = nsdname
 
-    def to_bin(self) -> bytearray:
-        dns_record_bin: bytearray = super().to_bin()
-        cur_len = len(dns_record_bin)
-        labels = self.nsdname.split(".")
-        for label in labels:
-            # Write label's length
-            dns_record_bin.append(len(label))
-            for ch in label:
-                data = ord(ch) if ch != "." else 0
-                dns_record_bin.append(data)
-        dns_record_bin.append(0)
-        new_len = len(dns_record_bin)
-        self.length = new_len - cur_len
-        # Modify length to reflect the actual bytes present in the record
-        dns_record_bin[cur_len - 2] = (self.length & 0xFF00) >> 8
-        dns_record_bin[cur_len - 1] = self.length & 0xFF
-        return dns_record_bin
+    def write_rdata(self, writer: WireWriter) -> None:
+        writer.write_name(self.nsdname)
 
     def __repr__(self) -> str:
         rep_dict = {
@@ -321,6 +275,8 @@ class NS(Record):
 
 
 class SOA(Record):
+    __slots__ = ("mname", "rname", "serial", "refresh", "retry", "expire", "minimum")
+
     # Domain name of the name server that was the
     # original or primary source of data for this zone.
     mname: str
@@ -370,37 +326,10 @@ class SOA(Record):
         self.expire = expire
         self.minimum = minimum
 
-    def to_bin(self) -> bytearray:
-        dns_record_bin: bytearray = super().to_bin()
-        cur_len = len(dns_record_bin)
-        labels = self.mname.split(".")
-        for label in labels:
-            # Write label's length
-            dns_record_bin.append(len(label))
-            for ch in label:
-                data = ord(ch) if ch != "." else 0
-                dns_record_bin.append(data)
-        dns_record_bin.append(0)
-
-        labels = self.rname.split(".")
-        for label in labels:
-            # Write label's length
-            dns_record_bin.append(len(label))
-            for ch in label:
-                data = ord(ch) if ch != "." else 0
-                dns_record_bin.append(data)
-        dns_record_bin.append(0)
-        dns_record_bin.extend(to_n_bytes(self.serial, 4))
-        dns_record_bin.extend(to_n_bytes(self.refresh, 4))
-        dns_record_bin.extend(to_n_bytes(self.retry, 4))
-        dns_record_bin.extend(to_n_bytes(self.expire, 4))
-        dns_record_bin.extend(to_n_bytes(self.minimum, 4))
-        new_len = len(dns_record_bin)
-        self.length = new_len - cur_len
-        # Modify length to reflect the actual bytes present in the record
-        dns_record_bin[cur_len - 2] = (self.length & 0xFF00) >> 8
-        dns_record_bin[cur_len - 1] = self.length & 0xFF
-        return dns_record_bin
+    def write_rdata(self, writer: WireWriter) -> None:
+        writer.write_name(self.mname)
+        writer.write_name(self.rname)
+        writer.write_struct(SOA_FORMAT, self.serial, self.refresh, self.retry, self.expire, self.minimum)
 
     def __repr__(self) -> str:
         rep_dict = {
@@ -420,6 +349,66 @@ class SOA(Record):
         return str(rep_dict)
 
 
+# Record of a type which isn't modelled, carrying its RDATA over as is (RFC 3597)
+class OpaqueRecord(Record):
+    __slots__ = ("rdata", "type_value", "class_value")
+
+    rdata: bytes
+    # Type and Class as found on the wire, which may well be missing from RecordType/RecordClass
+    type_value: int
+    class_value: int
+
+    def __init__(
+        self,
+        name: str,
+        rtype: RecordType,
+        rclass: RecordClass,
+        ttl: int,
+        length: int,
+        rdata: bytes,
+        type_value: int,
+        class_value: int,
+    ) -> None:
+        super().__init__(name, rtype, rclass, ttl, length)
+        self.rdata = rdata
+        self.type_value = type_value
+        self.class_value = class_value
+
+    def write(self, writer: WireWriter) -> int:
+        return writer.write_record(self.name, self.type_value, self.class_value, self.ttl, self.write_rdata)
+
+    def write_rdata(self, writer: WireWriter) -> None:
+        # Names within the data of unknown types must not be compressed, so the data is copied over verbatim
+        writer.write_bytes(self.rdata)
+
+    def __repr__(self) -> str:
+        rep_dict = {
+            "name": self.name,
+            "type": self.type_value,
+            "class": self.class_value,
+            "ttl": self.ttl,
+            "length": self.length,
+            "rdata": self.rdata.hex(),
+        }
+        return str(rep_dict)
+
+
+class EdnsOption:
+    """Option carried in the RDATA of an OPT record, as {OPTION-CODE, OPTION-LENGTH, OPTION-DATA} (RFC 6891)"""
+
+    __slots__ = ("code", "data")
+
+    def __init__(self, code: int, data: bytes) -> None:
+        self.code = code
+        self.data = data
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, EdnsOption) and (self.code, self.data) == (other.code, other.data)
+
+    def __repr__(self) -> str:
+        return str({"code": self.code, "data": self.data.hex()})
+
+
 # An OPT pseudo-RR (sometimes called a meta-RR) MAY be added to the
 # additional data section of a request. An OPT record does not carry any DNS data
 class OptPseudoRR(Record):
@@ -431,7 +420,9 @@ class OptPseudoRR(Record):
     length: int  # 2 bytes, length of all Record data
     """
 
-    data: bytearray  # octet stream  {attribute,value}
+    __slots__ = ("requestor_udp_payload_size", "ext_rcode_flags", "options")
+
+    options: List[EdnsOption]
 
     def __init__(
         self,
@@ -440,24 +431,42 @@ class OptPseudoRR(Record):
         requestor_udp_payload_size: int,
         ext_rcode_flags: int,
         length: int,
-        data: bytearray,
+        options: List[EdnsOption],
     ) -> None:
         super().__init__(name, rtype, RecordClass.from_value(requestor_udp_payload_size), ext_rcode_flags, length)
         self.requestor_udp_payload_size = requestor_udp_payload_size
         self.ext_rcode_flags = ext_rcode_flags
-        self.data = data
+        self.options = options
 
-    def to_bin(self) -> bytearray:
-        return self.data
+    @property
+    def extended_rcode(self) -> int:
+        # Upper 8 bits of the 12 bit RCODE, the lower 4 ones being in the header
+        return self.ext_rcode_flags >> 24
+
+    @property
+    def version(self) -> int:
+        return (self.ext_rcode_flags >> 16) & 0xFF
+
+    @property
+    def dnssec_ok(self) -> bool:
+        return self.ext_rcode_flags & 0x8000 != 0
+
+    def write(self, writer: WireWriter) -> int:
+        return writer.write_record(
+            self.name, self.rtype.value, self.requestor_udp_payload_size, self.ext_rcode_flags, self.write_rdata
+        )
+
+    def write_rdata(self, writer: WireWriter) -> None:
+        for option in self.options:
+            writer.write_struct(EDNS_OPTION_FORMAT, option.code, len(option.data))
+            writer.write_bytes(option.data)
 
     def __repr__(self) -> str:
         rep_dict = {
-            # "name": self.name,
-            # "type": self.rtype.name,
-            # "class": self.rec_class,
-            # "ttl": self.ttl,
-            # "length": self.length,
-            # "rdata": self.rec_data,
-            "data": self.data
+            "udp_payload_size": self.requestor_udp_payload_size,
+            "extended_rcode": self.extended_rcode,
+            "version": self.version,
+            "dnssec_ok": self.dnssec_ok,
+            "options": self.options,
         }
         return str(rep_dict)
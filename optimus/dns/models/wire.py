@@ -0,0 +1,94 @@
+import struct
+from functools import lru_cache
+from typing import Callable, Dict, Tuple
+
+INITIAL_BUFFER_SIZE = 512
+# Compression pointers carry a 14 bit offset, so only names in the first 16KiB of a message can be pointed to
+MAX_POINTER_OFFSET = 0x3FFF
+MAX_LABEL_LENGTH = 63
+
+UINT16_FORMAT = struct.Struct(">H")
+UINT32_FORMAT = struct.Struct(">I")
+# Type, Class, TTL and RDLENGTH of a resource record
+RECORD_FORMAT = struct.Struct(">HHIH")
+
+# Label of a name, prefixed by its length, along with the lowercased suffix of the name starting at that label
+EncodedLabel = Tuple[str, bytes]
+
+
+@lru_cache(maxsize=4096)
+def encode_name(name: str) -> Tuple[EncodedLabel, ...]:
+    """Encodes the labels of a name once, names being repeated all over the responses of popular domains"""
+    labels = [label.encode("latin-1") for label in name.rstrip(".").split(".") if label]
+    encoded = []
+    for i, label in enumerate(labels):
+        if len(label) > MAX_LABEL_LENGTH:
+            raise ValueError(f"Label of {name} is longer than {MAX_LABEL_LENGTH} octets")
+        suffix = b".".join(labels[i:]).lower().decode("latin-1")
+        encoded.append((suffix, bytes([len(label)]) + label))
+    return tuple(encoded)
+
+
+class WireWriter:
+    """
+    Encodes a DNS message in a single pass into one growable buffer. Names are compressed against the
+    names already written (RFC 1035 Section 4.1.4), unless compression is turned off
+    """
+
+    def __init__(self, compress: bool = True, size: int = INITIAL_BUFFER_SIZE) -> None:
+        self.__buffer = bytearray(size)
+        self.__pos = 0
+        self.__compress = compress
+        # Lowercased name -> offset of its first occurrence in the message
+        self.__names: Dict[str, int] = dict()
+
+    @property
+    def pos(self) -> int:
+        return self.__pos
+
+    def getvalue(self) -> bytearray:
+        return self.__buffer[: self.__pos]
+
+    def write_bytes(self, data: bytes) -> None:
+        self.__reserve(len(data))
+        self.__buffer[self.__pos : self.__pos + len(data)] = data
+        self.__pos += len(data)
+
+    def write_struct(self, fmt: struct.Struct, *values: int) -> None:
+        self.__reserve(fmt.size)
+        fmt.pack_into(self.__buffer, self.__pos, *values)
+        self.__pos += fmt.size
+
+    def patch_uint16(self, offset: int, value: int) -> None:
+        UINT16_FORMAT.pack_into(self.__buffer, offset, value)
+
+    def write_name(self, name: str, compress: bool = True) -> None:
+        compress = compress and self.__compress
+        for suffix, label in encode_name(name):
+            if compress:
+                offset = self.__names.get(suffix)
+                if offset is not None:
+                    # Rest of the name has been written already, point to it
+                    self.write_struct(UINT16_FORMAT, 0xC000 | offset)
+                    return
+                if self.__pos <= MAX_POINTER_OFFSET:
+                    self.__names[suffix] = self.__pos
+            self.write_bytes(label)
+        self.write_bytes(b"\x00")
+
+    def write_record(
+        self, name: str, rtype: int, rclass: int, ttl: int, write_rdata: Callable[["WireWriter"], None]
+    ) -> int:
+        """Writes a resource record, returning the offset of its TTL field within the message"""
+        self.write_name(name)
+        ttl_offset = self.__pos + 4
+        # RDLENGTH is only known once RDATA is written
+        self.write_struct(RECORD_FORMAT, rtype, rclass, ttl, 0)
+        rdata_start = self.__pos
+        write_rdata(self)
+        self.patch_uint16(rdata_start - 2, self.__pos - rdata_start)
+        return ttl_offset
+
+    def __reserve(self, size: int) -> None:
+        if self.__pos + size > len(self.__buffer):
+            self.__buffer.extend(bytes(max(size, len(self.__buffer))))
@@ -1,215 +1,305 @@
 from ipaddress import IPv4Address, IPv6Address
 from typing import List, Optional, Union
 
-from optimus.dns.models.packet import DNSHeader, DNSPacket, Question, ResponseCode
-from optimus.dns.models.records import AAAA, CNAME, MX, NS, SOA, A, OptPseudoRR, Record, RecordClass, RecordType
-from optimus.dns.parser.iter import BytearrayIterator
+from optimus.dns.models.packet import (
+    HEADER_FORMAT,
+    QUESTION_FORMAT,
+    DNSHeader,
+    DNSPacket,
+    Question,
+    ResponseCode,
+    Section,
+)
+from optimus.dns.models.records import (
+    AAAA,
+    CNAME,
+    MX,
+    NS,
+    EDNS_OPTION_FORMAT,
+    SOA,
+    SOA_FORMAT,
+    A,
+    EdnsOption,
+    OpaqueRecord,
+    OptPseudoRR,
+    Record,
+    RecordClass,
+    RecordType,
+)
+from optimus.dns.models.wire import RECORD_FORMAT, UINT16_FORMAT
+
+TYPE_A = RecordType.A.value
+TYPE_AAAA = RecordType.AAAA.value
+TYPE_CNAME = RecordType.CNAME.value
+TYPE_MX = RecordType.MX.value
+TYPE_NS = RecordType.NS.value
+TYPE_SOA = RecordType.SOA.value
+TYPE_OPT = RecordType.OPT.value
 
 
 class DNSParser:
+    """
+    Parses DNS messages by walking a memoryview over the given bytes, so that no field is ever copied
+    out of the buffer before being decoded
+    """
+
     def __init__(self, bin_data: bytearray) -> None:
         if not bin_data:
             raise Exception("No binary data given to parse")
-        self.__iter = BytearrayIterator(bin_data)
-
-    def __to_int(self, data: bytearray) -> int:
-        value = 0
-        for x in data:
-            value = value << 8 | x
-        return value
+        self.__data = memoryview(bin_data)
+        self.__pos = 0
+        # Record counts of the answer, authority and additional sections
+        self.__section_counts = [0, 0, 0]
+        # Start offsets of the sections, filled in as far as they have been skipped over
+        self.__section_offsets: List[int] = []
 
     def get_dns_packet(self) -> DNSPacket:
+        """
+        Parses the header and question section right away, resource records are only parsed once
+        the section holding them is accessed
+        """
         dns_header: DNSHeader = self.__get_dns_header()
         questions = self.__get_ques_section(dns_header.question_count)
-        answers = []
-        nameserver_records = []
-        additional_records: Optional[List[Union[Record, OptPseudoRR]]] = []
-        if not dns_header.is_query:
-            if dns_header.answer_count > 0:
-                answers = self.__get_ans_section(dns_header.answer_count)
-            if dns_header.nameserver_records_count > 0:
-                nameserver_records = self.__get_authoritative_section(dns_header.nameserver_records_count)
-            if dns_header.additional_records_count > 0:
-                additional_records = self.__get_additional_section(dns_header.additional_records_count)
-        else:
-            if dns_header.additional_records_count > 0:
-                dns_header.additional_records_count = 0
-        return DNSPacket(dns_header, questions, answers, nameserver_records, additional_records)
-
-    def __parse_record_name(self) -> str:
-        msb_data: int = self.__to_int(self.__iter.get_n_bytes(1))
-        if self.__is_label_compressed(msb_data):
-            # In this case, the next byte should be treated as OFFSET
-            # which specifies the position from where the name has to be
-            # read
-            self.__iter.seek_ptr_pos(self.__iter.get_cur_ptr_pos() + 1)
-            name = self.__parse_compressed_label()
-            return name
-        return self.__parse_sequence_of_labels()
-
-    def __is_label_compressed(self, label_length) -> bool:
-        # If the First Byte (MSB) of the 'length' byte has two leftmost(MS)
-        #  bits set then the label is represented in Compressed format.
-        return bool(label_length ^ 0xC0 == 0)
-
-    def __parse_compressed_label(self) -> str:
-        offset: int = self.__to_int(self.__iter.get_n_bytes_and_move(1))
-        cur_ptr_pos: int = self.__iter.get_cur_ptr_pos()
-        self.__iter.seek_ptr_pos(offset)
-        name: str = self.__parse_sequence_of_labels()
-        # Restore pointer to where it was
-        self.__iter.seek_ptr_pos(cur_ptr_pos)
-        return name
-
-    def __parse_sequence_of_labels(self) -> str:
-        full_name: List = []
-        name_str: str = ""
-        # 2 MSB bits of the this label_length field are always 0
-        # So the label_length can have values between 0 and 63, meaning
-        # that the name can take only between 0-63 octets
-        label_length: int = self.__to_int(self.__iter.get_n_bytes_and_move(1))
-        # Parse sequence of labels to decode the Name
-        while label_length != 0:
-            if self.__is_label_compressed(label_length):
-                name_str = self.__parse_compressed_label()
-                full_name.append(name_str)
-                return ".".join(full_name)
-            for _ in range(0, label_length):
-                label: int = self.__to_int(self.__iter.get_n_bytes_and_move(1))
-                name_str = name_str + chr(label)
-            full_name.append(name_str)
-            name_str = ""
-            label_length = self.__to_int(self.__iter.get_n_bytes_and_move(1))
-        return ".".join(full_name)
+        self.__section_counts = [
+            dns_header.answer_count,
+            dns_header.nameserver_records_count,
+            dns_header.additional_records_count,
+        ]
+        self.__section_offsets = [self.__pos]
+        return LazyDNSPacket(self, dns_header, questions)
+
+    def get_section(self, section: Section, rtype: Optional[RecordType] = None) -> List[Record]:
+        """Parses the records of a section, or only those of the given type while skipping over the rest"""
+        self.__pos = self.__get_section_offset(section.value)
+        total_records = self.__section_counts[section.value]
+        if rtype is None:
+            return [self.__parse_record() for _ in range(total_records)]
+        records: List[Record] = []
+        for _ in range(total_records):
+            record_start = self.__pos
+            self.__skip_name()
+            if UINT16_FORMAT.unpack_from(self.__data, self.__pos)[0] == rtype.value:
+                self.__pos = record_start
+                records.append(self.__parse_record())
+            else:
+                self.__skip_record_fields()
+        return records
+
+    def __get_section_offset(self, index: int) -> int:
+        # Sections are laid out one after the other, so get to a section by skipping the ones before
+        while len(self.__section_offsets) <= index:
+            previous = len(self.__section_offsets) - 1
+            self.__pos = self.__section_offsets[previous]
+            for _ in range(self.__section_counts[previous]):
+                self.__skip_name()
+                self.__skip_record_fields()
+            self.__section_offsets.append(self.__pos)
+        return self.__section_offsets[index]
+
+    def __skip_name(self) -> None:
+        data = self.__data
+        pos = self.__pos
+        while True:
+            label_length = data[pos]
+            if label_length == 0:
+                self.__pos = pos + 1
+                return
+            if label_length & 0xC0 == 0xC0:
+                # Name ends with a pointer to the rest of it
+                self.__pos = pos + 2
+                return
+            pos += 1 + label_length
+
+    def __skip_record_fields(self) -> None:
+        # Type, Class, TTL and RDLENGTH followed by RDATA
+        length: int = UINT16_FORMAT.unpack_from(self.__data, self.__pos + RECORD_FORMAT.size - 2)[0]
+        self.__pos += RECORD_FORMAT.size + length
+        if self.__pos > len(self.__data):
+            raise Exception("Record data runs past the end of the message")
+
+    def __parse_name(self) -> str:
+        """Decodes the (possibly compressed) name at the current position and moves past it"""
+        data = self.__data
+        pos = self.__pos
+        # Position right after the name as it appears in place, known once the first pointer is followed
+        end = -1
+        labels: List[str] = []
+        while True:
+            label_length = data[pos]
+            if label_length == 0:
+                break
+            if label_length & 0xC0 == 0xC0:
+                # Compression pointer, whose offset is given by the remaining 14 bits of these 2 bytes
+                offset = ((label_length & 0x3F) << 8) | data[pos + 1]
+                # Pointers may only refer to prior occurrences of a name, which also rules out loops
+                if offset >= pos:
+                    raise Exception(f"Invalid compression pointer to {offset} at {pos}")
+                if end < 0:
+                    end = pos + 2
+                pos = offset
+                continue
+            if label_length & 0xC0:
+                raise Exception(f"Unsupported label type {label_length:#x} at {pos}")
+            # 2 MSB bits of the label length are always 0, so a label can only be between 0-63 octets long
+            labels.append(str(data[pos + 1 : pos + 1 + label_length], "latin-1"))
+            pos += 1 + label_length
+        self.__pos = end if end >= 0 else pos + 1
+        return ".".join(labels)
 
     def __get_dns_header(self) -> DNSHeader:
-        # Parse ID
-        id = self.__to_int(self.__iter.get_n_bytes_and_move(2))
-        bytes_data = self.__to_int(self.__iter.get_n_bytes_and_move(2))
-        msb_byte = (bytes_data & 0xFF00) >> 8
-        # Parse QR
-        is_query = msb_byte & (1 << 7) == 0
-        # Parse OPCODE
-        opcode = (msb_byte >> 3) & 0x0F
-        # Parse AA
-        is_authoritative_answer = msb_byte & (1 << 2) != 0
-        # Parse TC
-        is_truncated_message = msb_byte & (1 << 1) != 0
-        # Parse RD
-        is_recursion_desired = msb_byte & 1 != 0
-
-        lsb_byte = bytes_data & 0xFF
-        # Parse RA
-        is_recursion_available = lsb_byte & (1 << 7) != 0
-        # Parse Z
-        z_field = (lsb_byte >> 4) & 7  # TODO: Expand Z field to Z, AD (Authenticated Data), CD (Checking Disabled)
-        # Parse RC
-        response_code = ResponseCode.from_value(lsb_byte & 0x0F)
-        # Parse Record counts
-        question_count = self.__to_int(self.__iter.get_n_bytes_and_move(2))
-        answer_count = self.__to_int(self.__iter.get_n_bytes_and_move(2))
-        nameserver_records_count = self.__to_int(self.__iter.get_n_bytes_and_move(2))
-        additional_records_count = self.__to_int(self.__iter.get_n_bytes_and_move(2))
-        return DNSHeader(
+        (
             id,
-            is_query,
-            opcode,
-            is_authoritative_answer,
-            is_truncated_message,
-            is_recursion_desired,
-            is_recursion_available,
-            z_field,
-            response_code,
+            msb_byte,
+            lsb_byte,
             question_count,
             answer_count,
             nameserver_records_count,
             additional_records_count,
+        ) = HEADER_FORMAT.unpack_from(self.__data, 0)
+        self.__pos = HEADER_FORMAT.size
+        return DNSHeader(
+            id,
+            # QR
+            is_query=msb_byte & 0x80 == 0,
+            opcode=(msb_byte >> 3) & 0x0F,
+            # AA
+            is_authoritative_answer=msb_byte & 0x04 != 0,
+            # TC
+            is_truncated_message=msb_byte & 0x02 != 0,
+            # RD
+            is_recursion_desired=msb_byte & 0x01 != 0,
+            # RA
+            is_recursion_available=lsb_byte & 0x80 != 0,
+            # TODO: Expand Z field to Z, AD (Authenticated Data), CD (Checking Disabled)
+            z_flag=(lsb_byte >> 4) & 7,
+            response_code=ResponseCode.from_value(lsb_byte & 0x0F),
+            question_count=question_count,
+            answer_count=answer_count,
+            nameserver_records_count=nameserver_records_count,
+            additional_records_count=additional_records_count,
         )
 
-    def __get_ques_section(self, total_questions) -> List[Question]:
+    def __get_ques_section(self, total_questions: int) -> List[Question]:
         questions: List[Question] = []
         for _ in range(total_questions):
-            # Parse name
-            name: str = self.__parse_record_name()
-            # Parse type
-            rtype: RecordType = RecordType.from_value(self.__to_int(self.__iter.get_n_bytes_and_move(2)))
-            # Parse class
-            qclass: RecordClass = RecordClass.from_value(self.__to_int(self.__iter.get_n_bytes_and_move(2)))
-            questions.append(Question(name, rtype, qclass))
+            name: str = self.__parse_name()
+            rtype, qclass = QUESTION_FORMAT.unpack_from(self.__data, self.__pos)
+            self.__pos += QUESTION_FORMAT.size
+            questions.append(
+                Question(
+                    name,
+                    RecordType.from_value(rtype),
+                    RecordClass.from_value(qclass),
+                )
+            )
         return questions
 
-    def __parse_records(self) -> Record:
-        name: str = self.__parse_record_name()
-        record_type = self.__to_int(self.__iter.get_n_bytes_and_move(2))
+    def __parse_record(self) -> Record:
+        data = self.__data
+        name: str = self.__parse_name()
+        record_type, record_class, ttl, length = RECORD_FORMAT.unpack_from(data, self.__pos)
+        self.__pos += RECORD_FORMAT.size
+        rdata_start = self.__pos
+        rdata_end = rdata_start + length
+        if rdata_end > len(data):
+            raise Exception(f"Record data of {name} runs past the end of the message")
         rtype: RecordType = RecordType.from_value(record_type)
-        record_class = self.__to_int(self.__iter.get_n_bytes_and_move(2))
         rclass: RecordClass = RecordClass.from_value(record_class)
-        ttl: int = self.__to_int(self.__iter.get_n_bytes_and_move(4))
-        length: int = self.__to_int(self.__iter.get_n_bytes_and_move(2))
         # Parse record acc to RecordType
         record: Union[Record, OptPseudoRR]
-        if rtype.value == RecordType.A.value:
-            ipv4_addr_int: int = self.__to_int(self.__iter.get_n_bytes_and_move(4))
-            record = A(name, rtype, rclass, ttl, length, IPv4Address(ipv4_addr_int))
-        elif rtype.value == RecordType.AAAA.value:
-            ipv6_addr_int: int = self.__to_int(self.__iter.get_n_bytes_and_move(16))
-            record = AAAA(name, rtype, rclass, ttl, length, IPv6Address(ipv6_addr_int))
-        elif rtype.value == RecordType.CNAME.value:
-            record = CNAME(name, rtype, rclass, ttl, length, self.__parse_record_name())
-        elif rtype.value == RecordType.MX.value:
-            record = MX(
-                name,
-                rtype,
-                rclass,
-                ttl,
-                length,
-                self.__to_int(self.__iter.get_n_bytes_and_move(2)),
-                self.__parse_record_name(),
-            )
-        elif rtype.value == RecordType.NS.value:
-            record = NS(name, rtype, rclass, ttl, length, self.__parse_record_name())
-        elif rtype.value == RecordType.SOA.value:
-            record = SOA(
-                name,
-                rtype,
-                rclass,
-                ttl,
-                length,
-                self.__parse_record_name(),
-                self.__parse_record_name(),
-                self.__to_int(self.__iter.get_n_bytes_and_move(4)),
-                self.__to_int(self.__iter.get_n_bytes_and_move(4)),
-                self.__to_int(self.__iter.get_n_bytes_and_move(4)),
-                self.__to_int(self.__iter.get_n_bytes_and_move(4)),
-                self.__to_int(self.__iter.get_n_bytes_and_move(4)),
-            )
-        elif rtype.value == RecordType.OPT.value:
+        if record_type == TYPE_A:
+            record = A(name, rtype, rclass, ttl, length, IPv4Address(bytes(data[rdata_start : rdata_start + 4])))
+        elif record_type == TYPE_AAAA:
+            record = AAAA(name, rtype, rclass, ttl, length, IPv6Address(bytes(data[rdata_start : rdata_start + 16])))
+        elif record_type == TYPE_CNAME:
+            record = CNAME(name, rtype, rclass, ttl, length, self.__parse_name())
+        elif record_type == TYPE_MX:
+            preference: int = UINT16_FORMAT.unpack_from(data, rdata_start)[0]
+            self.__pos += UINT16_FORMAT.size
+            record = MX(name, rtype, rclass, ttl, length, preference, self.__parse_name())
+        elif record_type == TYPE_NS:
+            record = NS(name, rtype, rclass, ttl, length, self.__parse_name())
+        elif record_type == TYPE_SOA:
+            mname: str = self.__parse_name()
+            rname: str = self.__parse_name()
+            record = SOA(name, rtype, rclass, ttl, length, mname, rname, *SOA_FORMAT.unpack_from(data, self.__pos))
+        elif record_type == TYPE_OPT:
             record = OptPseudoRR(
                 name,
                 rtype,
                 requestor_udp_payload_size=record_class,
                 ext_rcode_flags=ttl,
                 length=length,
-                data=bytearray(12),
+                options=self.__parse_edns_options(rdata_start, rdata_end),
             )
         else:
-            record = Record(name, rtype, rclass, ttl, length)
+            # Types without a model of their own keep their RDATA as is
+            rdata = bytes(data[rdata_start:rdata_end])
+            record = OpaqueRecord(name, rtype, rclass, ttl, length, rdata, record_type, record_class)
+        # RDLENGTH is authoritative on where the next record starts, whatever has been decoded above
+        self.__pos = rdata_end
         return record
 
-    def __get_ans_section(self, total_answers: int) -> List[Record]:
-        answers = []
-        for _ in range(total_answers):
-            answers.append(self.__parse_records())
-        return answers
-
-    def __get_additional_section(self, additional_records_count: int) -> List[Record]:
-        ad_records = []
-        for _ in range(additional_records_count):
-            ad_records.append(self.__parse_records())
-        return ad_records
-
-    def __get_authoritative_section(self, nameserver_records_count: int) -> List[Record]:
-        ns_records = []
-        for _ in range(nameserver_records_count):
-            ns_records.append(self.__parse_records())
-        return ns_records
+    def __parse_edns_options(self, start: int, end: int) -> List[EdnsOption]:
+        options: List[EdnsOption] = []
+        pos = start
+        while pos < end:
+            if pos + EDNS_OPTION_FORMAT.size > end:
+                raise Exception(f"Truncated EDNS option at {pos}")
+            code, length = EDNS_OPTION_FORMAT.unpack_from(self.__data, pos)
+            pos += EDNS_OPTION_FORMAT.size
+            if pos + length > end:
+                raise Exception(f"EDNS option {code} runs past the end of the OPT record")
+            options.append(EdnsOption(code, bytes(self.__data[pos : pos + length])))
+            pos += length
+        return options
+
+
+class LazyDNSPacket(DNSPacket):
+    """DNSPacket whose resource record sections are parsed by the parser on first access"""
+
+    __slots__ = ("__parser", "__sections")
+
+    def __init__(self, parser: DNSParser, dns_header: DNSHeader, questions: List[Question]) -> None:
+        self.header = dns_header
+        self.questions = questions
+        self.__parser = parser
+        self.__sections: List[Optional[List[Record]]] = [None, None, None]
+
+    @property
+    def answers(self) -> List[Record]:
+        return self.__get_section(Section.ANSWER)
+
+    @answers.setter
+    def answers(self, records: List[Record]) -> None:
+        self.__sections[Section.ANSWER.value] = records
+
+    @property
+    def nameserver_records(self) -> List[Record]:
+        return self.__get_section(Section.AUTHORITY)
+
+    @nameserver_records.setter
+    def nameserver_records(self, records: List[Record]) -> None:
+        self.__sections[Section.AUTHORITY.value] = records
+
+    @property
+    def additional_records(self) -> List[Record]:
+        return self.__get_section(Section.ADDITIONAL)
+
+    @additional_records.setter
+    def additional_records(self, records: List[Record]) -> None:
+        self.__sections[Section.ADDITIONAL.value] = records
+
+    def get_records(self, section: Section, rtype: RecordType) -> List[Record]:
+        records = self.__sections[section.value]
+        if records is None:
+            # Parse just the records asked for, without materializing the whole section
+            return self.__parser.get_section(section, rtype)
+        return [rec for rec in records if rec.rtype == rtype]
+
+    def __get_section(self, section: Section) -> List[Record]:
+        records = self.__sections[section.value]
+        if records is None:
+            records = self.__parser.get_section(section)
+            self.__sections[section.value] = records
+        return records
@@ -0,0 +1,231 @@
+import re
+from ipaddress import IPv4Address, IPv6Address
+from typing import Iterable, Iterator, List, Optional, Set, Tuple
+
+from optimus.dns.models.records import AAAA, CNAME, MX, NS, SOA, A, OpaqueRecord, Record, RecordClass, RecordType
+from optimus.dns.models.wire import WireWriter
+
+# TTLs may be given in seconds or with BIND's units, e.g 1h30m
+TTL_PATTERN = re.compile(r"(?:\d+[smhdw]?)+", re.IGNORECASE)
+TTL_UNITS = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+MAX_TTL = 2**31 - 1
+# Types written as TYPEnnn, whose data then has to be given in the generic format (RFC 3597 Section 5)
+GENERIC_TYPE_PATTERN = re.compile(r"TYPE(\d+)", re.IGNORECASE)
+GENERIC_RDATA_MARKER = "\\#"
+MAX_CHARACTER_STRING_LENGTH = 255
+DELIMITERS = ' \t\r\n;()"'
+
+
+class ZoneFileParser:
+    """
+    Parses zones written in the master file format (RFC 1035 Section 5) into records, i.e one entry per line
+    unless parenthesized, with the owner, TTL and class defaulting to the ones of the previous entry,
+    names being relative to $ORIGIN unless ending with a dot, and $TTL setting the default TTL (RFC 2308).
+    Only the types modelled by `optimus.dns.models.records` plus PTR and TXT are understood, as well as
+    any type written in the generic format of RFC 3597. Entries of other types (e.g DNSSEC ones) are skipped
+    """
+
+    def __init__(self, lines: Iterable[str], origin: str = "", source: str = "<zone>") -> None:
+        self.__lines = lines
+        self.__origin = origin.rstrip(".")
+        self.__source = source
+        self.__default_ttl: Optional[int] = None
+        self.__last_ttl: Optional[int] = None
+        self.__last_owner: Optional[str] = None
+        self.__line_number = 0
+        # Types of the entries which got skipped, so that callers may report them
+        self.skipped_types: Set[str] = set()
+
+    def get_records(self) -> List[Record]:
+        records: List[Record] = []
+        for line_number, owner_omitted, tokens in self.__tokenize():
+            self.__line_number = line_number
+            try:
+                record = self.__parse_entry(owner_omitted, tokens)
+            except (ValueError, IndexError) as e:
+                raise self.__error(str(e) or "Missing record data")
+            if record:
+                records.append(record)
+        return records
+
+    def __tokenize(self) -> Iterator[Tuple[int, bool, List[str]]]:
+        """Splits the lines into entries, yielding the line each starts on, whether its owner is left out and tokens"""
+        tokens: List[str] = []
+        depth = 0
+        start_line = 0
+        owner_omitted = False
+        for line_number, line in enumerate(self.__lines, 1):
+            self.__line_number = line_number
+            if depth == 0:
+                start_line = line_number
+                owner_omitted = line[:1] in (" ", "\t")
+            pos = 0
+            while pos < len(line):
+                char = line[pos]
+                if char in " \t\r\n":
+                    pos += 1
+                elif char == ";":
+                    break
+                elif char == "(":
+                    depth += 1
+                    pos += 1
+                elif char == ")":
+                    if not depth:
+                        raise self.__error("Closing parenthesis without an opening one")
+                    depth -= 1
+                    pos += 1
+                elif char == '"':
+                    end = pos + 1
+                    while end < len(line) and line[end] != '"':
+                        end += 2 if line[end] == "\\" else 1
+                    if end >= len(line):
+                        raise self.__error("Unterminated quoted string")
+                    # Quotes are kept, so that quoted strings can be told apart from anything else
+                    tokens.append(line[pos : end + 1])
+                    pos = end + 1
+                else:
+                    end = pos
+                    while end < len(line) and line[end] not in DELIMITERS:
+                        end += 2 if line[end] == "\\" else 1
+                    tokens.append(line[pos:end])
+                    pos = end
+            if depth == 0 and tokens:
+                yield start_line, owner_omitted, tokens
+                tokens = []
+        if depth:
+            raise self.__error("Unbalanced parentheses at the end of the zone")
+
+    def __parse_entry(self, owner_omitted: bool, tokens: List[str]) -> Optional[Record]:
+        if tokens[0].startswith("$"):
+            self.__parse_directive(tokens)
+            return None
+        if owner_omitted:
+            if self.__last_owner is None:
+                raise ValueError("First entry of the zone has no owner")
+            owner = self.__last_owner
+        else:
+            owner = self.__to_absolute(tokens[0])
+            tokens = tokens[1:]
+        self.__last_owner = owner
+        ttl: Optional[int] = None
+        # TTL and class may come in any order, both being optional
+        while tokens:
+            if tokens[0].upper() == RecordClass.IN.name:
+                tokens = tokens[1:]
+            elif TTL_PATTERN.fullmatch(tokens[0]):
+                ttl = parse_ttl(tokens[0])
+                tokens = tokens[1:]
+            elif tokens[0].upper() in ("CH", "HS", "CS"):
+                raise ValueError(f"Unsupported class {tokens[0]}")
+            else:
+                break
+        if not tokens:
+            raise ValueError(f"Entry of {owner or '.'} has no type")
+        if ttl is None:
+            ttl = self.__default_ttl if self.__default_ttl is not None else self.__last_ttl
+            if ttl is None:
+                raise ValueError(f"Entry of {owner or '.'} has no TTL, and no $TTL has been set")
+        self.__last_ttl = ttl
+        return self.__make_record(owner, tokens[0].upper(), ttl, tokens[1:])
+
+    def __parse_directive(self, tokens: List[str]) -> None:
+        directive = tokens[0].upper()
+        if directive == "$ORIGIN":
+            self.__origin = self.__to_absolute(tokens[1])
+        elif directive == "$TTL":
+            self.__default_ttl = parse_ttl(tokens[1])
+        else:
+            # $INCLUDE would let zone files read any file, so it isn't supported on purpose
+            raise ValueError(f"Unsupported directive {tokens[0]}")
+
+    def __make_record(self, owner: str, type_name: str, ttl: int, rdata: List[str]) -> Optional[Record]:
+        generic_type = GENERIC_TYPE_PATTERN.fullmatch(type_name)
+        type_value: int
+        if generic_type:
+            type_value = int(generic_type.group(1))
+        elif type_name in RecordType.__members__ and RecordType[type_name].value > 0:
+            type_value = RecordType[type_name].value
+        else:
+            self.skipped_types.add(type_name)
+            return None
+        rtype = RecordType.from_value(type_value)
+        rclass = RecordClass.IN
+        if rdata and rdata[0] == GENERIC_RDATA_MARKER:
+            if rtype in (RecordType.A, RecordType.AAAA, RecordType.CNAME, RecordType.MX, RecordType.NS, RecordType.SOA):
+                raise ValueError(f"Data of {rtype.name} records must be given in their own format")
+            data = bytes.fromhex("".join(rdata[2:]))
+            if len(data) != int(rdata[1]):
+                raise ValueError(f"Expected {rdata[1]} bytes of data, got {len(data)}")
+            return OpaqueRecord(owner, rtype, rclass, ttl, len(data), data, type_value, rclass.value)
+        if rtype == RecordType.A:
+            return A(owner, rtype, rclass, ttl, 4, IPv4Address(rdata[0]))
+        if rtype == RecordType.AAAA:
+            return AAAA(owner, rtype, rclass, ttl, 16, IPv6Address(rdata[0]))
+        if rtype == RecordType.NS:
+            return NS(owner, rtype, rclass, ttl, 0, self.__to_absolute(rdata[0]))
+        if rtype == RecordType.CNAME:
+            return CNAME(owner, rtype, rclass, ttl, 0, self.__to_absolute(rdata[0]))
+        if rtype == RecordType.MX:
+            return MX(owner, rtype, rclass, ttl, 0, int(rdata[0]), self.__to_absolute(rdata[1]))
+        if rtype == RecordType.SOA:
+            mname, rname = self.__to_absolute(rdata[0]), self.__to_absolute(rdata[1])
+            serial = int(rdata[2])
+            refresh, retry, expire, minimum = (parse_ttl(value) for value in rdata[3:7])
+            return SOA(owner, rtype, rclass, ttl, 0, mname, rname, serial, refresh, retry, expire, minimum)
+        if rtype == RecordType.PTR:
+            writer = WireWriter(compress=False)
+            writer.write_name(self.__to_absolute(rdata[0]))
+            data = bytes(writer.getvalue())
+            return OpaqueRecord(owner, rtype, rclass, ttl, len(data), data, type_value, rclass.value)
+        if rtype == RecordType.TXT:
+            data = b"".join(encode_character_string(value) for value in rdata)
+            return OpaqueRecord(owner, rtype, rclass, ttl, len(data), data, type_value, rclass.value)
+        self.skipped_types.add(type_name)
+        return None
+
+    def __to_absolute(self, name: str) -> str:
+        """Names are returned without their trailing dot, the root being an empty string"""
+        if name == "@":
+            return self.__origin
+        if name.endswith("."):
+            return name[:-1]
+        return f"{name}.{self.__origin}" if self.__origin else name
+
+    def __error(self, message: str) -> ValueError:
+        return ValueError(f"{self.__source}, line {self.__line_number}: {message}")
+
+
+def parse_ttl(value: str) -> int:
+    if not TTL_PATTERN.fullmatch(value):
+        raise ValueError(f"Invalid TTL {value}")
+    ttl = sum(int(amount) * TTL_UNITS[unit.lower()] for amount, unit in re.findall(r"(\d+)([smhdw]?)", value, re.I))
+    if ttl > MAX_TTL:
+        raise ValueError(f"TTL {value} is too large")
+    return ttl
+
+
+def encode_character_string(value: str) -> bytes:
+    """Encodes a (possibly quoted) <character-string>, decoding its \\X and \\DDD escapes"""
+    if value.startswith('"'):
+        value = value[1:-1]
+    data = bytearray()
+    pos = 0
+    while pos < len(value):
+        if value[pos] == "\\" and value[pos + 1 : pos + 4].isdigit() and len(value[pos + 1 : pos + 4]) == 3:
+            data.append(int(value[pos + 1 : pos + 4]))
+            pos += 4
+        elif value[pos] == "\\" and pos + 1 < len(value):
+            data.extend(value[pos + 1].encode())
+            pos += 2
+        else:
+            data.extend(value[pos].encode())
+            pos += 1
+    if len(data) > MAX_CHARACTER_STRING_LENGTH:
+        raise ValueError(f"Character string of {len(data)} bytes is too long")
+    return bytes([len(data)]) + data
+
+
+def parse_zone_file(path: str, origin: str = "") -> List[Record]:
+    """Parses the zone file at the given path, streaming its lines"""
+    with open(path, "r") as f:
+        return ZoneFileParser(f, origin, source=path).get_records()
@@ -0,0 +1,71 @@
+import os
+import threading
+from typing import Callable, List, Optional
+
+from optimus.logging.logger import log_error
+
+
+class ZoneFileReloader:
+    """
+    Loads zones out of their files, then checks the files for changes periodically on a background thread,
+    loading them all again whenever any of them changes. Loading itself is left to the callback, which gets
+    the modification times of the files and returns whether it succeeded. The callback is expected to swap
+    the loaded zones in as a whole by swapping a single reference, readers holding on to whichever zones they
+    got, so that lookups never wait on a reload nor see a mix of old and new records
+    """
+
+    def __init__(self, name: str, load: Callable[[List[float]], bool]) -> None:
+        self.__name = name
+        self.__load = load
+        self.__paths: List[str] = []
+        self.__interval: float = 0
+        self.__loaded_mtimes: Optional[List[float]] = None
+        self.__thread: Optional[threading.Thread] = None
+        self.__stopped = threading.Event()
+
+    def configure(self, paths: List[str], interval: float) -> None:
+        """Files are checked for changes every `interval` seconds, never if it is 0"""
+        if interval < 0:
+            raise ValueError(f"Reload interval of the {self.__name} can't be negative")
+        self.__paths = paths
+        self.__interval = interval
+        self.__loaded_mtimes = None
+
+    def load(self) -> bool:
+        """
+        Loads the files right away. Zones are expected to be loaded as soon as they are configured, so that
+        broken files are reported before serving and forked workers inherit the zones
+        """
+        try:
+            # Taken before reading, so that files changing while being read get loaded again
+            mtimes = [os.stat(path).st_mtime for path in self.__paths]
+        except OSError as e:
+            log_error(f"Couldn't load the {self.__name} {e!r}")
+            return False
+        # Broken files aren't tried again until they change
+        self.__loaded_mtimes = mtimes
+        return self.__load(mtimes)
+
+    def start(self) -> None:
+        if not self.__paths or not self.__interval or self.__thread:
+            return
+        self.__stopped.clear()
+        self.__thread = threading.Thread(target=self.__run, name=self.__name.replace(" ", "-"), daemon=True)
+        self.__thread.start()
+
+    def stop(self) -> None:
+        if not self.__thread:
+            return
+        self.__stopped.set()
+        self.__thread.join()
+        self.__thread = None
+
+    def __run(self) -> None:
+        while not self.__stopped.wait(self.__interval):
+            try:
+                mtimes = [os.stat(path).st_mtime for path in self.__paths]
+            except OSError as e:
+                log_error(f"Couldn't check the files of the {self.__name} for changes {e!r}")
+                continue
+            if mtimes != self.__loaded_mtimes:
+                self.load()
@@ -1,84 +1,302 @@
 import math
 import random
-from typing import List
+import time
+from typing import Generator, List, Optional, Set
 
-from optimus.dns.models.packet import DNSHeader, DNSPacket, Question, ResponseCode
+from optimus.dns.cache import Delegation, delegation_cache, infra_cache
+from optimus.dns.edns import make_opt_record
+from optimus.dns.forwarding import forwarding_rules
+from optimus.dns.local_zones import local_zones
+from optimus.dns.models.packet import DNSHeader, DNSPacket, Question, ResponseCode, Section
 from optimus.dns.models.records import Record, RecordClass, RecordType
 from optimus.dns.parser.parse import DNSParser
-from optimus.logging.logger import log_error
-from optimus.networking.udp import query_server_over_udp
+from optimus.dns.root_zone import local_root_zone
+from optimus.logging.logger import log_debug, log_error
+from optimus.networking.udp import query_server, query_server_async
 from optimus.server.context import get_root_servers
+from optimus.utils import SingletonMeta, is_subdomain, normalize_name
+
+
+# Time a client query may take to resolve, clients have long given up on it past that
+DEFAULT_QUERY_TIMEOUT = 6.0
+# Attempts on the servers of a zone before giving up on it, each server being given longer to respond every time
+MAX_ATTEMPTS_PER_ZONE = 4
+
+
+class ResolverSettings(metaclass=SingletonMeta):
+    def __init__(self, query_timeout: float = DEFAULT_QUERY_TIMEOUT) -> None:
+        self.query_timeout = query_timeout
+
+    def configure(self, query_timeout: float) -> None:
+        if query_timeout <= 0:
+            raise ValueError("Query timeout must be positive")
+        self.query_timeout = query_timeout
+
+    def get_deadline(self) -> float:
+        """Deadline of a query received just now"""
+        return time.monotonic() + self.query_timeout
+
+
+class UpstreamQuery:
+    """
+    Upstream query to be performed by whoever drives the iteration, the alternates being the other servers
+    of the zone which haven't been tried yet. The query must be given up on once the deadline has passed
+    """
+
+    __slots__ = ("payload", "server_addr", "alternates", "deadline")
+
+    def __init__(self, payload: bytearray, server_addr: str, alternates: List[str], deadline: float) -> None:
+        self.payload = payload
+        self.server_addr = server_addr
+        self.alternates = alternates
+        self.deadline = deadline
+
+
+def resolve(qpacket: DNSPacket, deadline: Optional[float] = None) -> DNSPacket:
+    """Resolves the query, blocking on every upstream query"""
+    iteration = iterate(qpacket, deadline if deadline is not None else resolver_settings.get_deadline())
+    try:
+        query = next(iteration)
+        while True:
+            query = iteration.send(query_server(query.payload, query.server_addr, query.alternates, query.deadline))
+    except StopIteration as stop:
+        response_packet: DNSPacket = stop.value
+        return response_packet
+
+
+async def resolve_async(qpacket: DNSPacket, deadline: Optional[float] = None) -> DNSPacket:
+    """Resolves the query without blocking the event loop on upstream queries"""
+    iteration = iterate(qpacket, deadline if deadline is not None else resolver_settings.get_deadline())
+    try:
+        query = next(iteration)
+        while True:
+            response = await query_server_async(query.payload, query.server_addr, query.alternates, query.deadline)
+            query = iteration.send(response)
+    except StopIteration as stop:
+        response_packet: DNSPacket = stop.value
+        return response_packet
+
+
+def make_servfail(qpacket: DNSPacket) -> DNSPacket:
+    return DNSPacket(
+        DNSHeader(
+            id=qpacket.header.ID,
+            question_count=qpacket.header.question_count,
+            response_code=ResponseCode.SERVFAIL,
+        ),
+        questions=qpacket.questions,
+    )
+
+
+def parse_upstream_response(response_bytes: bytes) -> Optional[DNSPacket]:
+    """
+    Parses a response received from upstream, None if there is none or it is malformed. Its sections are
+    parsed right away, so that a malformed response counts as a failed server instead of failing later on
+    """
+    if not response_bytes:
+        return None
+    try:
+        response_packet: DNSPacket = DNSParser(bytearray(response_bytes)).get_dns_packet()
+        response_packet.answers, response_packet.nameserver_records, response_packet.additional_records
+    except Exception as e:
+        log_debug(f"Malformed response from upstream {e!r}")
+        return None
+    return response_packet
+
+
+def build_upstream_query(qpacket: DNSPacket, with_edns: bool = True) -> bytearray:
+    """Serializes the question of the query, advertising our UDP payload size unless told otherwise"""
+    additional_records: List[Record] = [make_opt_record()] if with_edns else []
+    return DNSPacket(
+        DNSHeader(
+            id=qpacket.header.ID,
+            is_query=True,
+            opcode=qpacket.header.opcode,
+            is_recursion_desired=qpacket.header.is_recursion_desired,
+            question_count=len(qpacket.questions),
+            additional_records_count=len(additional_records),
+        ),
+        questions=qpacket.questions,
+        additional_records=additional_records,
+    ).to_bin()
+
+
+def forward(qpacket: DNSPacket, forwarders: List[str], deadline: float) -> Generator[UpstreamQuery, bytes, DNSPacket]:
+    """
+    Sends the query to the resolvers it is to be forwarded to, relaying their response as is. Resolvers are
+    picked by RTT, failing over to the ones which haven't been tried yet when they don't respond or can't
+    answer (SERVFAIL/REFUSED), every resolver being tried again with a longer timeout once they all have
+    """
+    tried: Set[str] = set()
+    server_addr: str = infra_cache.select(forwarders)
+    use_edns = True
+    attempts = 0
+    while True:
+        if time.monotonic() >= deadline:
+            log_error(f"Forwarding of {qpacket.questions[0].name} TYPE {qpacket.questions[0].rtype} timed out")
+            return make_servfail(qpacket)
+        tried.add(server_addr)
+        attempts += 1
+        untried: List[str] = [addr for addr in forwarders if addr not in tried]
+        _bytes: bytes = yield UpstreamQuery(
+            build_upstream_query(qpacket, with_edns=use_edns), server_addr, untried, deadline
+        )
+        response_packet: Optional[DNSPacket] = parse_upstream_response(_bytes)
+        if response_packet:
+            response_code: ResponseCode = response_packet.header.response_code
+            if (
+                use_edns
+                and response_code in (ResponseCode.FORMERR, ResponseCode.NOTIMP)
+                and not response_packet.get_records(Section.ADDITIONAL, RecordType.OPT)
+            ):
+                use_edns = False
+                continue
+            if response_code not in (ResponseCode.SERVFAIL, ResponseCode.REFUSED):
+                return response_packet
+        if attempts >= MAX_ATTEMPTS_PER_ZONE:
+            log_error(f"Forwarding of {qpacket.questions[0].name} TYPE {qpacket.questions[0].rtype} failed")
+            return response_packet or make_servfail(qpacket)
+        if not untried:
+            tried = set()
+            untried = forwarders
+        log_debug(f"No usable response from {server_addr}, failing over to another resolver")
+        server_addr = infra_cache.select(untried)
+        use_edns = True
 
 
 # TODO: Improve logging
-def resolve(qpacket: DNSPacket) -> DNSPacket:
-    # Start with first lookup on a random root server
-    server_addr: str = random.choice(get_root_servers())
+def iterate(qpacket: DNSPacket, deadline: float) -> Generator[UpstreamQuery, bytes, DNSPacket]:
+    """
+    Performs iterative resolution of the query without doing any I/O itself, unless the query is to be
+    forwarded. Every upstream query is yielded to the caller, which is expected to send back the bytes
+    received in response (empty on failure). The resolution is given up on once the deadline has passed
+    """
+    name: str = qpacket.questions[0].name
+    forwarders: Optional[List[str]] = forwarding_rules.get_forwarders(name)
+    if forwarders:
+        return (yield from forward(qpacket, forwarders, deadline))
+    # Start with the closest zone cut we know of, then with the TLD as per the local copy of the root zone,
+    # falling back to a random root server
+    closest: Optional[Delegation] = delegation_cache.get_closest(name)
+    # Names delegated from a local zone are resolved through the delegation, unless a deeper cut is cached
+    local_delegation: Optional[Delegation] = local_zones.get_delegation(name)
+    if local_delegation and not (closest and is_subdomain(closest.zone, local_delegation.zone)):
+        closest = local_delegation
+    closest = closest or local_root_zone.get_delegation(name)
+    if not closest:
+        # Queries the root servers would answer themselves, e.g for names under TLDs which don't exist
+        local_response: Optional[DNSPacket] = local_root_zone.answer(qpacket)
+        if local_response:
+            return local_response
+    zone: str = closest.zone if closest else ""
+    # Servers of the zone being queried, the ones which already failed to respond are only tried once
+    server_addresses: List[str] = closest.get_server_addresses() if closest else get_root_servers()
+    tried: Set[str] = set()
+    server_addr: str = infra_cache.select(server_addresses)
+    use_edns = True
+    attempts = 0
+    # Last error a server of the zone responded with, returned if none of them does any better
+    error_response: Optional[DNSPacket] = None
     while True:
-        _bytes: bytes = query_server_over_udp(qpacket.to_bin(), server_addr)
-        # TODO: Implement retries
-        if not _bytes:
-            log_error(
-                f"Resolution of {qpacket.questions[0].name} TYPE {qpacket.questions[0].rtype} ON {server_addr} failed"
-            )
-            return DNSPacket(
-                DNSHeader(
-                    id=qpacket.header.ID,
-                    question_count=qpacket.header.question_count,
-                    response_code=ResponseCode.SERVFAIL,
-                ),
-                questions=qpacket.questions,
-            )
-        response_packet: DNSPacket = DNSParser(bytearray(_bytes)).get_dns_packet()
+        if time.monotonic() >= deadline:
+            log_error(f"Resolution of {qpacket.questions[0].name} TYPE {qpacket.questions[0].rtype} timed out")
+            return make_servfail(qpacket)
+        tried.add(server_addr)
+        attempts += 1
+        untried: List[str] = [addr for addr in server_addresses if addr not in tried]
+        _bytes: bytes = yield UpstreamQuery(
+            build_upstream_query(qpacket, with_edns=use_edns), server_addr, untried, deadline
+        )
+        response_packet: Optional[DNSPacket] = parse_upstream_response(_bytes)
+        if (
+            response_packet
+            and use_edns
+            and response_packet.header.response_code in (ResponseCode.FORMERR, ResponseCode.NOTIMP)
+            and not response_packet.get_records(Section.ADDITIONAL, RecordType.OPT)
+        ):
+            # Server doesn't support EDNS, ask it again without (RFC 6891 Section 7)
+            use_edns = False
+            continue
+        if not response_packet or response_packet.header.response_code in (
+            ResponseCode.SERVFAIL,
+            ResponseCode.REFUSED,
+            ResponseCode.FORMERR,
+        ):
+            # The server couldn't answer, which says nothing about the other servers of the zone
+            error_response = response_packet or error_response
+            if attempts >= MAX_ATTEMPTS_PER_ZONE or (error_response and not untried):
+                log_error(
+                    f"Resolution of {qpacket.questions[0].name} TYPE {qpacket.questions[0].rtype} "
+                    f"ON {server_addr} failed"
+                )
+                return error_response or make_servfail(qpacket)
+            if not untried:
+                # Every server of the zone failed once, start over with them, the timeout of each has backed off
+                tried = set()
+                untried = server_addresses
+            log_debug(f"No usable response from {server_addr}, retrying on another server of zone '{zone}'")
+            server_addr = infra_cache.select(untried)
+            use_edns = True
+            continue
         response_code: ResponseCode = response_packet.header.response_code
         # If the server responds with error or if we get the Answer, return the packet as it is
         if response_code.value in [
             ResponseCode.NXDOMAIN.value,
-            ResponseCode.FORMERR.value,
-            ResponseCode.SERVFAIL.value,
             ResponseCode.NOTIMP.value,
-            ResponseCode.REFUSED.value,
             ResponseCode.UNKNOWN.value,
         ]:
             return response_packet
-        if response_code.value == ResponseCode.NOERROR.value and len(response_packet.answers) > 0:
+        if response_code.value == ResponseCode.NOERROR.value and response_packet.header.answer_count > 0:
             return response_packet
+        if not qpacket.header.is_recursion_desired:
+            return response_packet
+        delegation: Optional[Delegation] = Delegation.from_referral(response_packet)
         # No NS record is found, we need to return with response packet we already have
-        if not response_packet.nameserver_records:
+        if not delegation:
             return response_packet
-        if not qpacket.header.is_recursion_desired:
+        # Referrals must move us closer to the name, bail out on upward or sideways (lame) referrals
+        # and on referrals to zones the name doesn't even belong to, which mustn't get cached
+        if (
+            delegation.zone == zone
+            or not is_subdomain(delegation.zone, zone)
+            or not is_subdomain(normalize_name(name), delegation.zone)
+        ):
             return response_packet
+        # Remember the zone cut so that later lookups under it can skip straight to its nameservers
+        delegation_cache.put(delegation)
+        zone = delegation.zone
+        use_edns = True
+        tried = set()
+        attempts = 0
+        error_response = None
         # Try to find a 'NS' type record with a corresponding 'A' type record in the additional section
         # If found, switch Nameserver and retry the loop i.e perform the lookup on new NameServer again
-        ns_records: List[Record] = list(
-            filter(lambda rec: rec.rtype == RecordType.NS, response_packet.nameserver_records)
+        server_addresses = delegation.get_server_addresses()
+        if server_addresses:
+            server_addr = infra_cache.select(server_addresses)
+            continue
+        # Pick a random NS record and perform lookup for that
+        ns_name: str = random.choice(delegation.nameservers)
+        packet: DNSPacket = yield from iterate(
+            DNSPacket(
+                dns_header=DNSHeader(
+                    id=random.randint(0, int(math.pow(2, 16)) - 1),
+                    is_query=True,
+                    question_count=1,
+                    is_recursion_desired=True,
+                ),
+                questions=[Question(ns_name, RecordType.A, RecordClass.IN)],
+            ),
+            deadline,
         )
-        ns_record_set: set[str] = {ns_rec.nsdname for ns_rec in ns_records}
-        additional_records: List[Record] = response_packet.additional_records
-        if additional_records:
-            for ad_rec in additional_records:
-                if ad_rec.rtype.value == RecordType.A.value and ad_rec.name in ns_record_set:
-                    server_addr = str(ad_rec.ipv4_address)
-                    break
-        else:
-            if not ns_records:
-                return response_packet
-            # Pick a random NS record and perform lookup for that
-            ns_record: Record = random.choice(ns_records)
-            packet: DNSPacket = resolve(
-                DNSPacket(
-                    dns_header=DNSHeader(
-                        id=random.randint(0, int(math.pow(2, 16)) - 1),
-                        is_query=True,
-                        question_count=1,
-                        is_recursion_desired=True,
-                    ),
-                    questions=[Question(ns_record.nsdname, RecordType.A, RecordClass.IN)],
-                )
-            )
-            # No 'A' Type record is found, we need to return with response packet we already have
-            if not packet.answers:
-                return response_packet
-            a_type_record: Record = random.choice(packet.answers)
-            # 'A' Type records are present, pick one of them to retry the lookup on new server
-            server_addr = str(a_type_record.ipv4_address)
+        a_type_records: List[Record] = packet.get_records(Section.ANSWER, RecordType.A)
+        # No 'A' Type record is found, we need to return with response packet we already have
+        if not a_type_records:
+            return response_packet
+        server_addresses = [str(rec.ipv4_address) for rec in a_type_records]
+        delegation.addresses[ns_name] = server_addresses
+        # 'A' Type records are present, pick one of them to retry the lookup on new server
+        server_addr = infra_cache.select(server_addresses)
+
+
+resolver_settings = ResolverSettings()
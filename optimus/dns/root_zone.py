@@ -0,0 +1,157 @@
+import copy
+import time
+from typing import Dict, List, Optional
+
+from optimus.dns.cache import Delegation
+from optimus.dns.models.packet import DNSHeader, DNSPacket, ResponseCode
+from optimus.dns.models.records import Record, RecordClass, RecordType
+from optimus.dns.parser.zone import ZoneFileParser
+from optimus.dns.reloader import ZoneFileReloader
+from optimus.logging.logger import log, log_debug, log_error
+from optimus.utils import SingletonMeta, normalize_name
+
+# Interval (in seconds) at which the root zone file is checked for changes, never by default
+DEFAULT_ROOT_ZONE_RELOAD_INTERVAL = 0
+
+
+class RootZoneIndex:
+    """Records of a copy of the root zone, indexed by TLD. Never modified once built, reloads build a new one"""
+
+    soa: Record
+    apex: Dict[RecordType, List[Record]]  # Records owned by the root itself
+    tlds: Dict[str, List[Record]]  # TLD -> NS records delegating it
+    glue: Dict[str, List[str]]  # Nameserver name -> IPv4 addresses
+    expires_at: float  # Wall clock time past which the copy mustn't be used anymore
+
+    def __init__(self, records: List[Record], fetched_at: float) -> None:
+        self.apex = dict()
+        self.tlds = dict()
+        self.glue = dict()
+        for rec in records:
+            name = normalize_name(rec.name)
+            if not name:
+                self.apex.setdefault(rec.rtype, []).append(rec)
+            elif rec.rtype == RecordType.NS and "." not in name:
+                self.tlds.setdefault(name, []).append(rec)
+            elif rec.rtype == RecordType.A:
+                self.glue.setdefault(name, []).append(str(rec.ipv4_address))
+        soa_records = self.apex.get(RecordType.SOA)
+        if not soa_records:
+            raise ValueError("Root zone has no SOA record at its apex")
+        if not self.tlds:
+            raise ValueError("Root zone delegates no TLD")
+        self.soa = soa_records[0]
+        self.expires_at = fetched_at + self.soa.expire
+
+
+class LocalRootZone(metaclass=SingletonMeta):
+    """
+    Local copy of the root zone loaded from a zone file (RFC 8806), so that referrals to TLDs are synthesized
+    instead of being asked to the root servers, and names under TLDs which don't exist are denied right away.
+    The file may be checked for changes periodically, the copy being swapped with the reloaded one as a whole.
+    Once it has been around for longer than the SOA's EXPIRE, the copy isn't used anymore and resolutions
+    go back to starting at the root servers
+    """
+
+    def __init__(self, path: Optional[str] = None, reload_interval: float = DEFAULT_ROOT_ZONE_RELOAD_INTERVAL) -> None:
+        self.__path = path
+        self.__index: Optional[RootZoneIndex] = None
+        self.__reloader = ZoneFileReloader("root zone", self.__load_root_zone)
+        self.__reloader.configure([path] if path else [], reload_interval)
+
+    def configure(self, path: Optional[str], reload_interval: float = DEFAULT_ROOT_ZONE_RELOAD_INTERVAL) -> None:
+        self.__reloader.configure([path] if path else [], reload_interval)
+        self.__path = path
+        self.__index = None
+        if path and not self.load():
+            raise ValueError(f"Couldn't load the root zone from {path}")
+
+    def load(self) -> bool:
+        """Loads the root zone file, keeping the previous copy if it can't be loaded"""
+        if not self.__path:
+            return False
+        return self.__reloader.load()
+
+    def start(self) -> None:
+        """Checks the root zone file for changes periodically, on a background thread"""
+        self.__reloader.start()
+
+    def stop(self) -> None:
+        self.__reloader.stop()
+
+    def get_delegation(self, name: str) -> Optional[Delegation]:
+        """Referral to the TLD of the name as per the local copy, None if it can't be used or has none"""
+        index = self.__get_index()
+        if not index:
+            return None
+        tld = normalize_name(name).split(".")[-1]
+        ns_records = index.tlds.get(tld)
+        if not ns_records:
+            return None
+        nameservers = list(dict.fromkeys(normalize_name(rec.nsdname) for rec in ns_records))
+        addresses = {ns: index.glue[ns] for ns in nameservers if ns in index.glue}
+        if not addresses:
+            return None
+        return Delegation(tld, nameservers, addresses, min(rec.ttl for rec in ns_records))
+
+    def answer(self, qpacket: DNSPacket) -> Optional[DNSPacket]:
+        """
+        Answers queries the root servers would answer themselves, i.e about the root and about names under
+        TLDs which don't exist. None for any other query, or when the local copy can't be used
+        """
+        index = self.__get_index()
+        question = qpacket.questions[0]
+        if not index or question.qclass != RecordClass.IN:
+            return None
+        name = normalize_name(question.name)
+        answers: List[Record] = []
+        response_code = ResponseCode.NOERROR
+        if not name:
+            answers = [copy.copy(rec) for rec in index.apex.get(question.rtype, [])]
+        elif name.split(".")[-1] in index.tlds:
+            return None
+        else:
+            response_code = ResponseCode.NXDOMAIN
+        # Negative answers carry the SOA, for them to be cached (RFC 2308 Section 3)
+        authority: List[Record] = [] if answers else [copy.copy(index.soa)]
+        return DNSPacket(
+            DNSHeader(
+                id=qpacket.header.ID,
+                is_authoritative_answer=True,
+                is_recursion_desired=qpacket.header.is_recursion_desired,
+                response_code=response_code,
+                question_count=len(qpacket.questions),
+                answer_count=len(answers),
+                nameserver_records_count=len(authority),
+            ),
+            questions=qpacket.questions,
+            answers=answers,
+            nameserver_records=authority,
+        )
+
+    def __get_index(self) -> Optional[RootZoneIndex]:
+        index = self.__index
+        if index and index.expires_at <= time.time():
+            return None
+        return index
+
+    def __load_root_zone(self, mtimes: List[float]) -> bool:
+        path = self.__path or ""
+        try:
+            with open(path, "r") as f:
+                parser = ZoneFileParser(f, source=path)
+                # The modification time stands for when the copy was fetched, which is what expiry counts from
+                index = RootZoneIndex(parser.get_records(), mtimes[0])
+        except (OSError, ValueError) as e:
+            log_error(f"Couldn't load the root zone from {path} {e!r}")
+            return False
+        if parser.skipped_types:
+            log_debug(f"Skipped records of type {', '.join(sorted(parser.skipped_types))} of the root zone")
+        if index.expires_at <= time.time():
+            log_error(f"Root zone in {path} has expired, falling back to the root servers")
+        self.__index = index
+        log(f"Loaded root zone serial {index.soa.serial} delegating {len(index.tlds)} TLDs from {path}")
+        return True
+
+
+local_root_zone = LocalRootZone()
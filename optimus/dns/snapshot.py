@@ -0,0 +1,197 @@
+import mmap
+import os
+import struct
+import threading
+import time
+from typing import List, Optional, Tuple
+
+from optimus.dns.cache import Delegation, delegation_cache, record_cache
+from optimus.dns.models.packet import DNSHeader, DNSPacket, Question
+from optimus.dns.models.records import RecordClass, RecordType
+from optimus.dns.parser.parse import DNSParser
+from optimus.logging.logger import log, log_error
+from optimus.utils import SingletonMeta
+
+# Snapshots start with a magic, the version of the format and the (wall clock) time they were taken at
+SNAPSHOT_HEADER_FORMAT = struct.Struct(">8sBd")
+SNAPSHOT_MAGIC = b"OPTIMUS\x00"
+SNAPSHOT_VERSION = 1
+# Followed by the entries, serialized DNS messages prefixed by their kind and length
+ENTRY_HEADER_FORMAT = struct.Struct(">BH")
+RESPONSE_ENTRY = 1
+DELEGATION_ENTRY = 2
+DEFAULT_SNAPSHOT_INTERVAL = 300
+
+
+class CacheSnapshot(metaclass=SingletonMeta):
+    """
+    Saves the record and delegation caches to a compact binary file every once in a while and when shutting
+    down, and loads them back when starting up so that restarts don't begin with a cold cache.
+    Entries are stored as DNS messages whose TTLs are the time they had left, the time the snapshot spent
+    on disk is deducted from them when loading it. Snapshots are read through mmap on a background thread,
+    so that large ones don't hold up serving
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        interval: float = DEFAULT_SNAPSHOT_INTERVAL,
+        hot_names_path: Optional[str] = None,
+    ) -> None:
+        self.__path = path
+        self.__interval = interval
+        self.__hot_names_path = hot_names_path
+        self.__thread: Optional[threading.Thread] = None
+        self.__stopped = threading.Event()
+        # Saving a partially loaded snapshot would lose the entries which weren't loaded yet
+        self.__loaded = False
+
+    def configure(
+        self, path: Optional[str], interval: float = DEFAULT_SNAPSHOT_INTERVAL, hot_names_path: Optional[str] = None
+    ) -> None:
+        if interval <= 0:
+            raise ValueError("Snapshot interval must be positive")
+        self.__path = path
+        self.__interval = interval
+        self.__hot_names_path = hot_names_path
+
+    def start(self) -> None:
+        """Loads the snapshot, then keeps saving it periodically, on a background thread"""
+        if not self.__path or self.__thread:
+            return
+        self.__stopped.clear()
+        self.__loaded = False
+        self.__thread = threading.Thread(target=self.__run, name="snapshot", daemon=True)
+        self.__thread.start()
+
+    def stop(self) -> None:
+        """Stops saving the snapshot periodically, and saves it one last time"""
+        if not self.__thread:
+            return
+        self.__stopped.set()
+        self.__thread.join()
+        self.__thread = None
+        if self.__loaded:
+            self.save()
+
+    def save(self) -> int:
+        """Saves the unexpired cache entries to the snapshot file, returns how many were saved"""
+        if not self.__path:
+            return 0
+        entries: List[Tuple[int, DNSPacket]] = [(RESPONSE_ENTRY, packet) for packet in record_cache.export_responses()]
+        entries.extend(
+            (DELEGATION_ENTRY, delegation.to_referral()) for delegation in delegation_cache.export_delegations()
+        )
+        # Written aside and then moved over the previous snapshot, which is never seen half written that way
+        temp_path = f"{self.__path}.{os.getpid()}.tmp"
+        saved = 0
+        try:
+            with open(temp_path, "wb") as f:
+                f.write(SNAPSHOT_HEADER_FORMAT.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, time.time()))
+                for kind, packet in entries:
+                    message = packet.to_bin()
+                    if len(message) > 0xFFFF:
+                        continue
+                    f.write(ENTRY_HEADER_FORMAT.pack(kind, len(message)))
+                    f.write(message)
+                    saved += 1
+            os.replace(temp_path, self.__path)
+        except OSError as e:
+            log_error(f"Couldn't save the cache snapshot to {self.__path} {e!r}")
+            return 0
+        log(f"Saved {saved} cache entries to {self.__path}")
+        return saved
+
+    def load(self) -> int:
+        """Loads the entries of the snapshot file which haven't expired since into the caches, returns how many"""
+        if not self.__path or not os.path.exists(self.__path):
+            return 0
+        try:
+            with open(self.__path, "rb") as f:
+                if os.fstat(f.fileno()).st_size < SNAPSHOT_HEADER_FORMAT.size:
+                    log_error(f"Cache snapshot {self.__path} is truncated")
+                    return 0
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    loaded = self.__load_entries(data)
+        except OSError as e:
+            log_error(f"Couldn't load the cache snapshot from {self.__path} {e!r}")
+            return 0
+        except Exception as e:
+            # Whatever the snapshot holds, it mustn't take down the thread which keeps saving it
+            log_error(f"Cache snapshot {self.__path} is corrupt {e!r}")
+            return 0
+        log(f"Loaded {loaded} cache entries from {self.__path}")
+        return loaded
+
+    def get_hot_queries(self) -> List[bytes]:
+        """
+        Queries for the names of the hot names file, to be resolved when starting up.
+        The file lists one name per line, optionally followed by a record type (A by default)
+        """
+        if not self.__hot_names_path:
+            return []
+        queries: List[bytes] = []
+        try:
+            with open(self.__hot_names_path, "r") as f:
+                lines = f.readlines()
+        except OSError as e:
+            log_error(f"Couldn't read hot names from {self.__hot_names_path} {e!r}")
+            return []
+        for line in lines:
+            fields = line.split("#")[0].split()
+            if not fields:
+                continue
+            rtype_name = fields[1].upper() if len(fields) > 1 else RecordType.A.name
+            if rtype_name not in RecordType.__members__:
+                log_error(f"Unknown record type {fields[1]} for hot name {fields[0]}")
+                continue
+            packet = DNSPacket(
+                DNSHeader(id=len(queries) & 0xFFFF, is_query=True, question_count=1, is_recursion_desired=True),
+                [Question(fields[0], RecordType[rtype_name], RecordClass.IN)],
+            )
+            queries.append(bytes(packet.to_bin()))
+        return queries
+
+    def __run(self) -> None:
+        self.load()
+        self.__loaded = not self.__stopped.is_set()
+        while not self.__stopped.wait(self.__interval):
+            self.save()
+
+    def __load_entries(self, data: mmap.mmap) -> int:
+        magic, version, saved_at = SNAPSHOT_HEADER_FORMAT.unpack_from(data)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            log_error(f"{self.__path} isn't a cache snapshot this version of Optimus can load")
+            return 0
+        elapsed = max(int(time.time() - saved_at), 0)
+        loaded = 0
+        pos = SNAPSHOT_HEADER_FORMAT.size
+        while pos + ENTRY_HEADER_FORMAT.size <= len(data) and not self.__stopped.is_set():
+            kind, length = ENTRY_HEADER_FORMAT.unpack_from(data, pos)
+            pos += ENTRY_HEADER_FORMAT.size + length
+            if pos > len(data):
+                log_error(f"Cache snapshot {self.__path} is truncated")
+                break
+            try:
+                packet = DNSParser(bytearray(data[pos - length : pos])).get_dns_packet()
+                # Sections are only parsed once accessed, which is where damaged records show up
+                records = packet.answers + packet.nameserver_records + packet.additional_records
+            except Exception as e:
+                log_error(f"Cache snapshot {self.__path} is corrupt {e!r}")
+                break
+            # Skip what expired in the meantime, and count down the TTLs of the rest
+            if not records or min(rec.ttl for rec in records) <= elapsed:
+                continue
+            for rec in records:
+                rec.ttl -= elapsed
+            if kind == RESPONSE_ENTRY:
+                record_cache.put_response(packet)
+            elif kind == DELEGATION_ENTRY:
+                delegation: Optional[Delegation] = Delegation.from_referral(packet)
+                if delegation:
+                    delegation_cache.put(delegation)
+            loaded += 1
+        return loaded
+
+
+cache_snapshot = CacheSnapshot()
@@ -0,0 +1,48 @@
+import threading
+from typing import Optional, Sequence
+
+from optimus.dns.cache import infra_cache
+from optimus.utils import SingletonMeta
+
+# Hedging is off unless a share of extra upstream queries is allowed for it
+DEFAULT_MAX_HEDGE_RATIO = 0.0
+# Hedges which may be sent in a row, once enough upstream queries have been sent without any
+MAX_HEDGE_BURST = 10
+
+
+class HedgingPolicy(metaclass=SingletonMeta):
+    """
+    Decides when an upstream query which is taking long gets sent to another server of the zone as well.
+    Every query which could be hedged earns `max_ratio` of a hedge, so that hedges never add more than
+    that share of upstream queries
+    """
+
+    def __init__(self, max_ratio: float = DEFAULT_MAX_HEDGE_RATIO) -> None:
+        self.__max_ratio = max_ratio
+        self.__budget = 0.0
+        self.__lock = threading.Lock()
+
+    def configure(self, max_ratio: float) -> None:
+        if not 0 <= max_ratio <= 1:
+            raise ValueError("Hedge ratio must be between 0 and 1")
+        with self.__lock:
+            self.__max_ratio = max_ratio
+            self.__budget = 0.0
+
+    def get_delay(self, server_addr: str, alternates: Sequence[str]) -> Optional[float]:
+        """Returns how long to wait for the server before hedging, None if the query isn't to be hedged"""
+        if not self.__max_ratio or not alternates:
+            return None
+        with self.__lock:
+            self.__budget = min(self.__budget + self.__max_ratio, MAX_HEDGE_BURST)
+        return infra_cache.get_hedge_delay(server_addr)
+
+    def try_hedge(self) -> bool:
+        with self.__lock:
+            if self.__budget < 1:
+                return False
+            self.__budget -= 1
+            return True
+
+
+hedging_policy = HedgingPolicy()
@@ -0,0 +1,165 @@
+import asyncio
+import heapq
+import itertools
+import selectors
+import socket
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, List, Optional, Tuple, Union
+
+from optimus.logging.logger import log_error
+
+Callback = Callable[..., None]
+
+
+class TimerHandle:
+    def __init__(self, when: float, callback: Callback, args: Tuple[Any, ...]) -> None:
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self) -> None:
+        self.cancelled = True
+
+
+class EventLoop:
+    """
+    Minimal selectors (epoll on Linux) based event loop. Readers, writers and timers may only be
+    managed from the thread running the loop, other threads have to go through `call_soon_threadsafe`
+    """
+
+    def __init__(self) -> None:
+        self.__selector = selectors.DefaultSelector()
+        self.__callbacks: Deque[Tuple[Callback, Tuple[Any, ...]]] = deque()
+        self.__timers: List[Tuple[float, int, TimerHandle]] = []
+        self.__timer_sequence = itertools.count()
+        self.__running = False
+        self.__thread_id: Optional[int] = None
+        # Writing to this socket pair wakes the loop up from select when called from other threads
+        self.__wakeup_reader, self.__wakeup_writer = socket.socketpair()
+        self.__wakeup_reader.setblocking(False)
+        self.__wakeup_writer.setblocking(False)
+        self.add_reader(self.__wakeup_reader, self.__drain_wakeups)
+
+    def add_reader(self, sock: socket.socket, callback: Callback) -> None:
+        self.__watch(sock, selectors.EVENT_READ, callback)
+
+    def remove_reader(self, sock: socket.socket) -> None:
+        self.__unwatch(sock, selectors.EVENT_READ)
+
+    def add_writer(self, sock: socket.socket, callback: Callback) -> None:
+        self.__watch(sock, selectors.EVENT_WRITE, callback)
+
+    def remove_writer(self, sock: socket.socket) -> None:
+        self.__unwatch(sock, selectors.EVENT_WRITE)
+
+    def call_soon(self, callback: Callback, *args: Any) -> None:
+        self.__callbacks.append((callback, args))
+
+    def call_soon_threadsafe(self, callback: Callback, *args: Any) -> None:
+        self.__callbacks.append((callback, args))
+        if self.__thread_id != threading.get_ident():
+            self.__wakeup()
+
+    def call_later(self, delay: float, callback: Callback, *args: Any) -> TimerHandle:
+        timer = TimerHandle(time.monotonic() + delay, callback, args)
+        heapq.heappush(self.__timers, (timer.when, next(self.__timer_sequence), timer))
+        return timer
+
+    def is_running(self) -> bool:
+        return self.__running
+
+    def run_forever(self) -> None:
+        self.__running = True
+        self.__thread_id = threading.get_ident()
+        try:
+            while self.__running:
+                self.__run_once()
+        finally:
+            self.__running = False
+            self.__thread_id = None
+
+    def stop(self) -> None:
+        def _stop() -> None:
+            self.__running = False
+
+        self.call_soon_threadsafe(_stop)
+
+    def close(self) -> None:
+        self.__selector.close()
+        self.__wakeup_reader.close()
+        self.__wakeup_writer.close()
+
+    def __run_once(self) -> None:
+        timeout: Optional[float] = None
+        if self.__callbacks:
+            timeout = 0
+        elif self.__timers:
+            timeout = max(self.__timers[0][0] - time.monotonic(), 0)
+        for key, events in self.__selector.select(timeout):
+            reader, writer = key.data
+            if events & selectors.EVENT_READ and reader:
+                self.__invoke(reader, ())
+            if events & selectors.EVENT_WRITE and writer:
+                self.__invoke(writer, ())
+        now = time.monotonic()
+        while self.__timers and self.__timers[0][0] <= now:
+            _, _, timer = heapq.heappop(self.__timers)
+            if not timer.cancelled:
+                self.__invoke(timer.callback, timer.args)
+        # Only run the callbacks queued so far, the ones they queue in turn are run on the next iteration
+        for _ in range(len(self.__callbacks)):
+            callback, args = self.__callbacks.popleft()
+            self.__invoke(callback, args)
+
+    def __invoke(self, callback: Callback, args: Tuple[Any, ...]) -> None:
+        try:
+            callback(*args)
+        except Exception as e:
+            log_error(f"Unhandled error in event loop callback {callback}: {e!r}")
+
+    def __watch(self, sock: socket.socket, event: int, callback: Callback) -> None:
+        try:
+            key = self.__selector.get_key(sock)
+        except KeyError:
+            reader, writer = (callback, None) if event == selectors.EVENT_READ else (None, callback)
+            self.__selector.register(sock, event, [reader, writer])
+            return
+        key.data[0 if event == selectors.EVENT_READ else 1] = callback
+        self.__selector.modify(sock, key.events | event, key.data)
+
+    def __unwatch(self, sock: socket.socket, event: int) -> None:
+        try:
+            key = self.__selector.get_key(sock)
+        except (KeyError, ValueError):
+            return
+        key.data[0 if event == selectors.EVENT_READ else 1] = None
+        events = key.events & ~event
+        if events:
+            self.__selector.modify(sock, events, key.data)
+        else:
+            self.__selector.unregister(sock)
+
+    def __wakeup(self) -> None:
+        try:
+            self.__wakeup_writer.send(b"\0")
+        except (BlockingIOError, InterruptedError):
+            # Socket buffer is full, meaning the loop is already bound to wake up
+            pass
+        except OSError:
+            # Loop has been closed
+            pass
+
+    def __drain_wakeups(self) -> None:
+        try:
+            while self.__wakeup_reader.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+
+# Upstream sockets may also be run on an asyncio loop, which shares the subset of the interface they rely on
+AnyEventLoop = Union[EventLoop, asyncio.AbstractEventLoop]
+AnyTimerHandle = Union[TimerHandle, asyncio.TimerHandle]
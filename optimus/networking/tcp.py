@@ -0,0 +1,248 @@
+import errno
+import os
+import random
+import socket
+import struct
+from concurrent import futures
+from functools import partial
+from typing import Callable, Dict, List, Optional, Tuple
+
+from optimus.logging.logger import log_debug
+from optimus.networking.loop import AnyEventLoop, AnyTimerHandle
+from optimus.utils import get_question_section
+
+# DNS messages sent over TCP are prefixed by their length as a 2 byte field (RFC 1035 Section 4.2.2)
+LENGTH_PREFIX_FORMAT = struct.Struct(">H")
+MAX_MESSAGE_SIZE = 0xFFFF
+RECV_BUFFER_SIZE = 65536
+DEFAULT_CONNECTIONS_PER_SERVER = 2
+# Queries outstanding on every connection to a server before another one gets opened to it
+MAX_OUTSTANDING_QUERIES = 16
+UPSTREAM_IDLE_TIMEOUT = 5
+
+
+def frame_message(message: bytes) -> bytes:
+    if len(message) > MAX_MESSAGE_SIZE:
+        raise ValueError(f"Message of {len(message)} bytes can't be sent over TCP")
+    return LENGTH_PREFIX_FORMAT.pack(len(message)) + message
+
+
+def read_messages(buffer: bytearray) -> List[bytes]:
+    """Takes every complete length-prefixed message off the front of the buffer, leaving any partial one behind"""
+    messages: List[bytes] = []
+    pos = 0
+    while len(buffer) - pos >= LENGTH_PREFIX_FORMAT.size:
+        (length,) = LENGTH_PREFIX_FORMAT.unpack_from(buffer, pos)
+        end = pos + LENGTH_PREFIX_FORMAT.size + length
+        if end > len(buffer):
+            break
+        messages.append(bytes(buffer[pos + LENGTH_PREFIX_FORMAT.size : end]))
+        pos = end
+    del buffer[:pos]
+    return messages
+
+
+class PendingQuery:
+    """Upstream query waiting on its response, which is sent with the original ID of the query put back"""
+
+    def __init__(self, original_id: bytes, response: futures.Future, timer: AnyTimerHandle) -> None:
+        self.original_id = original_id
+        self.response = response
+        self.timer = timer
+
+
+class UpstreamConnection:
+    """
+    Persistent connection to an upstream server, over which queries are pipelined (RFC 7766 Section 6.2.1).
+    Each query on it gets a transaction ID which isn't outstanding on the connection yet, so that responses
+    can be matched to queries whatever the order they come back in. Must only be used from the loop thread
+    """
+
+    def __init__(
+        self,
+        loop: AnyEventLoop,
+        server: Tuple[str, int],
+        idle_timeout: float,
+        on_close: Callable[["UpstreamConnection"], None],
+    ) -> None:
+        self.__loop = loop
+        self.__server = server
+        self.__idle_timeout = idle_timeout
+        self.__on_close = on_close
+        self.__sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.__recv_buffer = bytearray()
+        self.__send_buffer = bytearray()
+        self.__pending: Dict[Tuple[int, bytes], PendingQuery] = dict()
+        self.__connected = False
+        self.__writing = False
+        self.__closed = False
+        self.__idle_timer: Optional[AnyTimerHandle] = None
+
+    def connect(self) -> None:
+        self.__sock.setblocking(False)
+        self.__sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        error = self.__sock.connect_ex(self.__server)
+        if error not in (0, errno.EINPROGRESS):
+            self.close(OSError(error, os.strerror(error)))
+            return
+        # Connection is complete once the socket turns writable, queries sent meanwhile are buffered
+        self.__loop.add_writer(self.__sock, self.__on_connected)
+        self.__writing = True
+        self.__touch()
+
+    def close(self, reason: BaseException) -> None:
+        """Closes the connection, failing the queries still waiting on it with `reason`"""
+        if self.__closed:
+            return
+        self.__closed = True
+        if self.__idle_timer:
+            self.__idle_timer.cancel()
+        self.__loop.remove_reader(self.__sock)
+        self.__loop.remove_writer(self.__sock)
+        self.__sock.close()
+        self.__pending, pending = dict(), self.__pending
+        for query in pending.values():
+            query.timer.cancel()
+            if not query.response.done():
+                query.response.set_exception(reason)
+        self.__on_close(self)
+
+    def outstanding_count(self) -> int:
+        return len(self.__pending)
+
+    def send(self, payload: bytes, question: bytes, response: futures.Future, timeout: float) -> None:
+        if self.__closed:
+            response.set_exception(ConnectionAbortedError(f"Connection to {self.__server[0]} is closed"))
+            return
+        while True:
+            query_id = random.getrandbits(16)
+            key = (query_id, question.lower())
+            if key not in self.__pending:
+                break
+        data = bytearray(payload)
+        struct.pack_into(">H", data, 0, query_id)
+        timer = self.__loop.call_later(timeout, self.__expire, key)
+        self.__pending[key] = PendingQuery(payload[0:2], response, timer)
+        self.__send_buffer.extend(frame_message(data))
+        self.__touch()
+        if self.__connected:
+            self.__flush()
+
+    def __on_connected(self) -> None:
+        error = self.__sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            self.close(ConnectionRefusedError(error, os.strerror(error)))
+            return
+        self.__connected = True
+        self.__loop.add_reader(self.__sock, self.__on_readable)
+        self.__flush()
+
+    def __flush(self) -> None:
+        try:
+            sent = self.__sock.send(self.__send_buffer)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError as e:
+            self.close(e)
+            return
+        del self.__send_buffer[:sent]
+        if self.__send_buffer and not self.__writing:
+            self.__writing = True
+            self.__loop.add_writer(self.__sock, self.__flush)
+        elif not self.__send_buffer and self.__writing:
+            self.__writing = False
+            self.__loop.remove_writer(self.__sock)
+
+    def __on_readable(self) -> None:
+        try:
+            data = self.__sock.recv(RECV_BUFFER_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self.close(e)
+            return
+        if not data:
+            self.close(ConnectionResetError(f"Connection closed by {self.__server[0]}:{self.__server[1]}"))
+            return
+        self.__touch()
+        self.__recv_buffer.extend(data)
+        for message in read_messages(self.__recv_buffer):
+            question = get_question_section(message)
+            if len(message) < 12 or question is None:
+                continue
+            query = self.__pending.pop((struct.unpack_from(">H", message, 0)[0], question.lower()), None)
+            if not query:
+                log_debug(f"Dropping unexpected response from {self.__server[0]}:{self.__server[1]} over TCP")
+                continue
+            query.timer.cancel()
+            response = bytearray(message)
+            response[0:2] = query.original_id
+            if not query.response.done():
+                query.response.set_result(bytes(response))
+
+    def __expire(self, key: Tuple[int, bytes]) -> None:
+        query = self.__pending.pop(key, None)
+        if query and not query.response.done():
+            query.response.set_exception(TimeoutError(f"No response from {self.__server[0]}:{self.__server[1]}"))
+
+    def __touch(self) -> None:
+        if self.__idle_timer:
+            self.__idle_timer.cancel()
+        self.__idle_timer = self.__loop.call_later(self.__idle_timeout, self.__on_idle)
+
+    def __on_idle(self) -> None:
+        if self.__pending:
+            self.__touch()
+            return
+        # Servers close idle connections on their own too, closing ours first keeps us from sending
+        # a query on a connection which is being torn down
+        self.close(ConnectionAbortedError("Idle connection closed"))
+
+
+class UpstreamConnectionPool:
+    """
+    Keeps up to `connections_per_server` persistent connections to each upstream server queried over TCP,
+    so that the handshake is only paid once for servers we keep on getting truncated responses from.
+    Queries are pipelined on the least busy connection, another one only being opened once they all have
+    `MAX_OUTSTANDING_QUERIES` outstanding
+    """
+
+    def __init__(
+        self,
+        loop: AnyEventLoop,
+        connections_per_server: int = DEFAULT_CONNECTIONS_PER_SERVER,
+        idle_timeout: float = UPSTREAM_IDLE_TIMEOUT,
+    ) -> None:
+        self.__loop = loop
+        self.__connections_per_server = connections_per_server
+        self.__idle_timeout = idle_timeout
+        self.__connections: Dict[Tuple[str, int], List[UpstreamConnection]] = dict()
+
+    def send(
+        self, payload: bytes, question: bytes, server: Tuple[str, int], response: futures.Future, timeout: float
+    ) -> None:
+        connections = self.__connections.setdefault(server, [])
+        connection = min(connections, key=UpstreamConnection.outstanding_count, default=None)
+        if not connection or (
+            connection.outstanding_count() >= MAX_OUTSTANDING_QUERIES
+            and len(connections) < self.__connections_per_server
+        ):
+            connection = UpstreamConnection(self.__loop, server, self.__idle_timeout, partial(self.__forget, server))
+            connections.append(connection)
+            connection.connect()
+        connection.send(payload, question, response, timeout)
+
+    def close(self) -> None:
+        for connections in list(self.__connections.values()):
+            for connection in list(connections):
+                connection.close(ConnectionAbortedError("Upstream transport was detached"))
+
+    def connection_count(self) -> int:
+        return sum(len(connections) for connections in self.__connections.values())
+
+    def __forget(self, server: Tuple[str, int], connection: UpstreamConnection) -> None:
+        connections = self.__connections.get(server, [])
+        if connection in connections:
+            connections.remove(connection)
+        if not connections:
+            self.__connections.pop(server, None)
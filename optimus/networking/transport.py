@@ -0,0 +1,196 @@
+import random
+import socket
+import struct
+import threading
+from concurrent import futures
+from functools import partial
+from typing import List, Optional, Tuple
+
+from optimus.dns.edns import MAX_UDP_PAYLOAD_SIZE
+from optimus.logging.logger import log_debug
+from optimus.networking.loop import AnyEventLoop, EventLoop
+from optimus.networking.tcp import UPSTREAM_IDLE_TIMEOUT, PendingQuery, UpstreamConnectionPool
+from optimus.utils import SingletonMeta, get_question_section
+
+UPSTREAM_TIMEOUT = 5
+DEFAULT_POOL_SIZE = 16
+# Largest datagram that can be received from an upstream server, which never sends more than we advertise
+RECV_BUFFER_SIZE = MAX_UDP_PAYLOAD_SIZE
+
+# (server address, port, transaction ID, question) of an outstanding query
+PendingKey = Tuple[str, int, int, bytes]
+
+
+class UdpTransport(metaclass=SingletonMeta):
+    """
+    Sends upstream queries over a pool of long-lived UDP sockets registered on an event loop.
+    Every query gets a fresh random transaction ID, and responses are only handed to the query whose
+    (server, port, ID, question) they match, anything else (late, spoofed or stray datagrams) is dropped.
+    Queries may also be sent over TCP, through persistent connections shared with the ones sent before.
+    All state is owned by the event loop thread, callers only ever wait on futures
+    """
+
+    def __init__(self, pool_size: int = DEFAULT_POOL_SIZE, tcp_idle_timeout: float = UPSTREAM_IDLE_TIMEOUT) -> None:
+        self.__pool_size = pool_size
+        self.__tcp_idle_timeout = tcp_idle_timeout
+        self.__sockets: List[socket.socket] = []
+        self.__pending: dict[PendingKey, PendingQuery] = dict()
+        self.__connection_pool: Optional[UpstreamConnectionPool] = None
+        self.__loop: Optional[AnyEventLoop] = None
+        self.__owns_loop = False
+        self.__lock = threading.Lock()
+
+    def attach(self, loop: Optional[AnyEventLoop]) -> None:
+        """
+        Runs the transport on the given event loop (either an `EventLoop` or an asyncio one), which is expected
+        to be run by the caller, and to be the thread attaching and detaching it. Passing None detaches it,
+        in which case it lazily starts a loop of its own on a background thread
+        """
+        with self.__lock:
+            self.__connection_pool, connection_pool = None, self.__connection_pool
+            previous_loop = self.__loop if not self.__owns_loop else None
+            if self.__loop and self.__owns_loop:
+                # Connections are unregistered from the loop they run on before it gets stopped
+                if connection_pool:
+                    self.__loop.call_soon_threadsafe(connection_pool.close)
+                    connection_pool = None
+                self.__loop.stop()
+            self.__loop = loop
+            self.__owns_loop = False
+            self.__sockets, sockets = [], self.__sockets
+            self.__pending, pending = dict(), self.__pending
+        if connection_pool:
+            connection_pool.close()
+        for sock in sockets:
+            # The caller's loop outlives the transport, and must not be left watching closed sockets
+            if previous_loop:
+                previous_loop.remove_reader(sock)
+            sock.close()
+        for query in pending.values():
+            query.timer.cancel()
+            if not query.response.done():
+                query.response.set_exception(ConnectionAbortedError("Upstream transport was detached"))
+
+    def open(self) -> None:
+        """Eagerly opens the socket pool, which is otherwise opened on the first query"""
+        self.__get_loop().call_soon_threadsafe(self.__open_sockets)
+
+    def submit(
+        self,
+        payload: bytes,
+        server_addr: str,
+        port: int = 53,
+        timeout: float = UPSTREAM_TIMEOUT,
+        over_tcp: bool = False,
+    ) -> futures.Future:
+        """
+        Sends the query to the server, returning a future which is resolved with the response bytes
+        (carrying the ID of the given payload), or fails with TimeoutError/OSError
+        """
+        response: futures.Future = futures.Future()
+        send = self.__send_over_tcp if over_tcp else self.__send
+        self.__get_loop().call_soon_threadsafe(send, bytes(payload), server_addr, port, timeout, response)
+        return response
+
+    def pending_count(self) -> int:
+        return len(self.__pending)
+
+    def connection_count(self) -> int:
+        return self.__connection_pool.connection_count() if self.__connection_pool else 0
+
+    def __get_loop(self) -> AnyEventLoop:
+        with self.__lock:
+            if not self.__loop:
+                self.__loop = EventLoop()
+                self.__owns_loop = True
+                threading.Thread(target=self.__run_loop, args=(self.__loop,), name="upstream", daemon=True).start()
+            return self.__loop
+
+    def __run_loop(self, loop: EventLoop) -> None:
+        try:
+            loop.run_forever()
+        finally:
+            loop.close()
+
+    def __open_sockets(self) -> None:
+        loop = self.__loop
+        if not loop:
+            return
+        while len(self.__sockets) < self.__pool_size:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            # Bind right away, so that each socket keeps its own random source port for its whole lifetime
+            sock.bind(("0.0.0.0", 0))
+            loop.add_reader(sock, partial(self.__on_readable, sock))
+            self.__sockets.append(sock)
+
+    def __send(self, payload: bytes, server_addr: str, port: int, timeout: float, response: futures.Future) -> None:
+        if response.done():
+            return
+        loop = self.__loop
+        question = get_question_section(payload)
+        if not loop or question is None:
+            response.set_exception(ValueError("Malformed upstream query"))
+            return
+        self.__open_sockets()
+        # Pick an ID which isn't outstanding for this server and question yet
+        while True:
+            query_id = random.getrandbits(16)
+            key: PendingKey = (server_addr, port, query_id, question.lower())
+            if key not in self.__pending:
+                break
+        data = bytearray(payload)
+        struct.pack_into(">H", data, 0, query_id)
+        try:
+            random.choice(self.__sockets).sendto(data, (server_addr, port))
+        except OSError as e:
+            response.set_exception(e)
+            return
+        timer = loop.call_later(timeout, self.__expire, key)
+        self.__pending[key] = PendingQuery(payload[0:2], response, timer)
+
+    def __send_over_tcp(
+        self, payload: bytes, server_addr: str, port: int, timeout: float, response: futures.Future
+    ) -> None:
+        if response.done():
+            return
+        loop = self.__loop
+        question = get_question_section(payload)
+        if not loop or question is None:
+            response.set_exception(ValueError("Malformed upstream query"))
+            return
+        if not self.__connection_pool:
+            self.__connection_pool = UpstreamConnectionPool(loop, idle_timeout=self.__tcp_idle_timeout)
+        self.__connection_pool.send(payload, question, (server_addr, port), response, timeout)
+
+    def __on_readable(self, sock: socket.socket) -> None:
+        while True:
+            try:
+                data, (server_addr, port) = sock.recvfrom(RECV_BUFFER_SIZE)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # e.g ICMP errors surfaced by the kernel, the affected query is left to time out
+                log_debug(f"Error while reading upstream socket {e!r}")
+                return
+            question = get_question_section(data)
+            if len(data) < 12 or question is None:
+                continue
+            key: PendingKey = (server_addr, port, struct.unpack_from(">H", data, 0)[0], question.lower())
+            query = self.__pending.pop(key, None)
+            if not query:
+                log_debug(f"Dropping unexpected response from {server_addr}:{port}")
+                continue
+            query.timer.cancel()
+            response = bytearray(data)
+            response[0:2] = query.original_id
+            if not query.response.done():
+                query.response.set_result(bytes(response))
+
+    def __expire(self, key: PendingKey) -> None:
+        query = self.__pending.pop(key, None)
+        if query and not query.response.done():
+            query.response.set_exception(TimeoutError(f"No response from {key[0]}:{key[1]}"))
+
+
+upstream_transport = UdpTransport()
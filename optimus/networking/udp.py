@@ -1,31 +1,139 @@
-import socket
-from typing import Optional
+import asyncio
+import math
+import time
+from concurrent import futures
+from functools import partial
+from typing import Dict, Optional, Sequence, Set, Union
 
+from optimus.dns.cache import infra_cache
 from optimus.logging.logger import log_debug, log_error
-from optimus.networking.cache import socket_cache
+from optimus.networking.hedging import hedging_policy
+from optimus.networking.transport import UPSTREAM_TIMEOUT, upstream_transport
+from optimus.utils import split_server_addr
 
 
-def query_server_over_udp(payload: bytearray, server_addr: str) -> bytes:
-    sock: Optional[socket.socket] = socket_cache.get(server_addr)
-    is_root_server = True
+def is_truncated(packet_bytes: bytes) -> bool:
+    return len(packet_bytes) > 2 and packet_bytes[2] & 0x02 != 0
+
+
+def query_server(
+    payload: bytearray, server_addr: str, alternates: Sequence[str] = (), deadline: Optional[float] = None
+) -> bytes:
+    """
+    Queries the server over UDP with a timeout derived from its RTT, which the response (or the lack of one)
+    is fed back into. If hedging is enabled and the server is slow to respond, one of the alternate servers
+    is queried as well, the first response wins. Queries whose response got truncated are retried over TCP.
+    Nothing is waited for past the deadline, an empty response is returned once it has passed
+    """
+    if __get_remaining(deadline) <= 0:
+        return bytes()
+    responses: Dict[futures.Future, str] = {__submit(payload, server_addr, deadline): server_addr}
+    hedge_delay = __get_hedge_delay(server_addr, alternates, deadline)
+    if hedge_delay is not None:
+        done, _ = futures.wait(responses, timeout=hedge_delay)
+        if not done and hedging_policy.try_hedge():
+            hedge_addr = infra_cache.select(list(alternates))
+            log_debug(f"No response from {server_addr} after {hedge_delay:.3f}s, hedging on {hedge_addr}")
+            responses[__submit(payload, hedge_addr, deadline)] = hedge_addr
+    pending: Set[futures.Future] = set(responses)
+    packet_bytes, responder = bytes(), server_addr
+    while pending and not packet_bytes:
+        done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+        for response in done:
+            packet_bytes, responder = __get_result(response, responses[response]), responses[response]
+            if packet_bytes:
+                break
+    for response in pending:
+        response.cancel()
+    if is_truncated(packet_bytes):
+        log_debug(f"Truncated response from {responder}, retrying over TCP")
+        tcp_response = __submit_over_tcp(payload, responder, deadline)
+        packet_bytes = __get_result(tcp_response, responder)
+    return packet_bytes
+
+
+async def query_server_async(
+    payload: bytearray, server_addr: str, alternates: Sequence[str] = (), deadline: Optional[float] = None
+) -> bytes:
+    if __get_remaining(deadline) <= 0:
+        return bytes()
+    responses: Dict[asyncio.Future, str] = {asyncio.wrap_future(__submit(payload, server_addr, deadline)): server_addr}
+    hedge_delay = __get_hedge_delay(server_addr, alternates, deadline)
+    if hedge_delay is not None:
+        done, _ = await asyncio.wait(responses, timeout=hedge_delay)
+        if not done and hedging_policy.try_hedge():
+            hedge_addr = infra_cache.select(list(alternates))
+            log_debug(f"No response from {server_addr} after {hedge_delay:.3f}s, hedging on {hedge_addr}")
+            responses[asyncio.wrap_future(__submit(payload, hedge_addr, deadline))] = hedge_addr
+    pending: Set[asyncio.Future] = set(responses)
+    packet_bytes, responder = bytes(), server_addr
+    while pending and not packet_bytes:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for response in done:
+            packet_bytes, responder = __get_result(response, responses[response]), responses[response]
+            if packet_bytes:
+                break
+    # Cancelling the wrapping futures cancels the transport's ones as well
+    for response in pending:
+        response.cancel()
+    if is_truncated(packet_bytes):
+        log_debug(f"Truncated response from {responder}, retrying over TCP")
+        tcp_response = asyncio.wrap_future(__submit_over_tcp(payload, responder, deadline))
+        await asyncio.wait([tcp_response])
+        packet_bytes = __get_result(tcp_response, responder)
+    return packet_bytes
+
+
+def __submit(payload: bytearray, server_addr: str, deadline: Optional[float]) -> futures.Future:
+    timeout = infra_cache.get_timeout(server_addr)
+    remaining = __get_remaining(deadline)
+    host, port = split_server_addr(server_addr)
+    response: futures.Future = upstream_transport.submit(payload, host, port=port, timeout=min(timeout, remaining))
+    response.add_done_callback(partial(__record_outcome, server_addr, time.monotonic(), remaining >= timeout))
+    return response
+
+
+def __submit_over_tcp(payload: bytearray, server_addr: str, deadline: Optional[float]) -> futures.Future:
+    host, port = split_server_addr(server_addr)
+    return upstream_transport.submit(payload, host, port=port, timeout=__get_tcp_timeout(deadline), over_tcp=True)
+
+
+def __record_outcome(server_addr: str, sent_at: float, full_timeout: bool, response: futures.Future) -> None:
+    # Queries given up on in favour of another server's response tell nothing about the server
+    if response.cancelled():
+        return
+    if response.exception():
+        # Neither do the ones cut short by the deadline of the client query
+        if full_timeout:
+            infra_cache.record_timeout(server_addr)
+    else:
+        infra_cache.record_rtt(server_addr, time.monotonic() - sent_at)
+
+
+def __get_remaining(deadline: Optional[float]) -> float:
+    return deadline - time.monotonic() if deadline is not None else math.inf
+
+
+def __get_hedge_delay(server_addr: str, alternates: Sequence[str], deadline: Optional[float]) -> Optional[float]:
+    hedge_delay = hedging_policy.get_delay(server_addr, alternates)
+    # No point in hedging when the deadline passes before the hedge would be sent
+    if hedge_delay is not None and hedge_delay >= __get_remaining(deadline):
+        return None
+    return hedge_delay
+
+
+def __get_tcp_timeout(deadline: Optional[float]) -> float:
+    return max(min(UPSTREAM_TIMEOUT, __get_remaining(deadline)), 0)
+
+
+def __get_result(response: Union[futures.Future, asyncio.Future], server_addr: str) -> bytes:
+    """Returns the bytes of a completed response, empty if the query failed"""
     try:
-        if not sock:
-            is_root_server = False
-            log_debug(f"Upstream DNS server {server_addr} socket cache miss")
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            sock.settimeout(5)
-            sock.connect((server_addr, 53))
-        sock.send(payload)
-        packet_bytes = sock.recv(600)
+        packet_bytes: bytes = response.result()
         return packet_bytes
-    except socket.timeout:
+    except TimeoutError:
         log_error(f"Time out, couldn't complete lookup on {server_addr}")
         return bytes()
-    except socket.error:
+    except OSError:
         log_error(f"Socket error while connecting to {server_addr}")
         return bytes()
-    finally:
-        if sock and not is_root_server:
-            # Only close sockets for non-root servers since root server sockets have
-            # to remain cached and can't be closed
-            sock.close()
@@ -1,4 +1,6 @@
-from prometheus_client import Counter, Histogram, start_http_server
+import os
+
+from prometheus_client import CollectorRegistry, Counter, Histogram, multiprocess, start_http_server
 
 from optimus.logging.logger import log
 
@@ -9,6 +11,10 @@ erred_rqc = Counter("erred_dns_requests", "Total Requests Failed")
 req_duration_hist = Histogram("duration_dns_request", "Total time taken to process the request")
 
 PORT = 8000
+# When set, metrics of every worker process are written to (and aggregated from) this directory
+MULTIPROC_DIR_ENV = "PROMETHEUS_MULTIPROC_DIR"
+
+__metrics_server_started = False
 
 
 def record_metrics(func):
@@ -28,10 +34,47 @@ def record_metrics(func):
     return wrapper
 
 
+def record_metrics_async(func):
+    """Same as `record_metrics`, for coroutine functions"""
+
+    async def wrapper(*args, **kwargs):
+        inbound_rqc.inc(1)
+        with req_duration_hist.time():
+            was_success: bool = await func(*args, **kwargs)
+        served_rqc.inc(1)
+        if not was_success:
+            erred_rqc.inc(1)
+
+    return wrapper
+
+
+def start_metrics_server() -> None:
+    """
+    Starts the Prometheus metrics server unless already running. In multiprocess mode it has to be started
+    by the supervising process, before any worker is forked
+    """
+    global __metrics_server_started
+    if __metrics_server_started:
+        return
+    if os.environ.get(MULTIPROC_DIR_ENV):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        start_http_server(PORT, registry=registry)
+    else:
+        start_http_server(PORT)
+    __metrics_server_started = True
+    log(f"Started Prometheus Server on Port {PORT}")
+
+
+def mark_worker_dead(pid: int) -> None:
+    """Cleans up the metrics files left behind by a dead worker process"""
+    if os.environ.get(MULTIPROC_DIR_ENV):
+        multiprocess.mark_process_dead(pid)
+
+
 def with_prometheus_metrics_server(func):
     def wrapper(*args, **kwargs):
-        start_http_server(PORT)
-        log(f"Started Prometheus Server on Port {PORT}")
+        start_metrics_server()
         func(*args, **kwargs)
 
     return wrapper
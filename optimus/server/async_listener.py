@@ -0,0 +1,266 @@
+import asyncio
+from concurrent import futures
+from functools import partial
+from typing import Callable, Coroutine, Optional, Set, Tuple
+
+from optimus.dns.cache import response_cache
+from optimus.dns.edns import fit_response
+from optimus.dns.local_zones import local_zones
+from optimus.dns.resolver import resolver_settings
+from optimus.dns.root_zone import local_root_zone
+from optimus.dns.snapshot import cache_snapshot
+from optimus.logging.logger import log, log_debug, log_error
+from optimus.networking.tcp import frame_message, read_messages
+from optimus.networking.transport import upstream_transport
+from optimus.prometheus import record_metrics_async, with_prometheus_metrics_server
+from optimus.server.context import warmup_cache, watch_zone_file
+from optimus.server.handler import (
+    STALE_ANSWER_DELAY,
+    get_stale_response,
+    handle_query_async,
+    make_error_response,
+    refresh_query_async,
+)
+from optimus.server.inflight import inflight_queries
+from optimus.server.tcp_listener import DEFAULT_IDLE_TIMEOUT, DEFAULT_MAX_CONNECTIONS, MAX_PIPELINED_QUERIES
+from optimus.utils import SingletonMeta
+
+
+class QueryAnswerer:
+    """Answers queries as tasks on the running loop, the transport they came in on just provides `send`"""
+
+    def __init__(self) -> None:
+        # Keep references to in-flight requests, the event loop only holds weak references to tasks
+        self.__tasks: Set[asyncio.Task] = set()
+
+    def answer(self, received_bytes: bytes, address: Tuple[str, int], send: Callable[[bytes], None]) -> bool:
+        """Returns False when the query is a retransmission of one still in flight, which is dropped"""
+        inflight = inflight_queries.join(received_bytes, address)
+        if not inflight:
+            return False
+        request: Coroutine
+        if inflight.is_leader:
+            request = self.__handle_request(received_bytes, send, inflight.response, resolver_settings.get_deadline())
+            timer = asyncio.get_running_loop().call_later(
+                STALE_ANSWER_DELAY, self.__answer_stale, received_bytes, send, inflight.response
+            )
+            inflight.response.add_done_callback(lambda _: timer.cancel())
+        else:
+            request = self.__reply_when_resolved(received_bytes, send, inflight.response)
+        self.__run(request)
+        return True
+
+    def prefetch(self, received_bytes: bytes) -> None:
+        """Refreshes a popular cached response in the background, while the cached one keeps being served"""
+        self.__run(refresh_query_async(received_bytes, resolver_settings.get_deadline()))
+
+    def __run(self, request: Coroutine) -> None:
+        task = asyncio.get_running_loop().create_task(request)
+        self.__tasks.add(task)
+        task.add_done_callback(self.__tasks.discard)
+
+    @record_metrics_async
+    async def __handle_request(
+        self, received_bytes: bytes, send: Callable[[bytes], None], response: futures.Future, deadline: float
+    ) -> bool:
+        try:
+            response_bytes, was_success = await handle_query_async(received_bytes, deadline)
+        except BaseException as e:
+            if not response.done():
+                response.set_exception(e)
+                # Still answered, TCP connections would otherwise keep waiting on the query
+                send(make_error_response(received_bytes))
+            if isinstance(e, Exception):
+                log_error(f"Couldn't handle query {e!r}")
+                return False
+            raise
+        # Unless it was already answered with stale data, in which case the fresh response just got cached
+        if not response.done():
+            response.set_result((response_bytes, was_success))
+            send(response_bytes)
+        return was_success
+
+    def __answer_stale(self, received_bytes: bytes, send: Callable[[bytes], None], response: futures.Future) -> None:
+        """Answers a query which is taking too long to resolve with stale data, while the resolution goes on"""
+        if response.done():
+            return
+        stale_response = get_stale_response(received_bytes)
+        if stale_response:
+            response.set_result(stale_response)
+            send(stale_response[0])
+
+    @record_metrics_async
+    async def __reply_when_resolved(
+        self, received_bytes: bytes, send: Callable[[bytes], None], response: futures.Future
+    ) -> bool:
+        """Answers a query which got coalesced with an identical one, once the latter is resolved"""
+        response_bytes: bytes
+        was_success: bool
+        try:
+            response_bytes, was_success = await asyncio.wrap_future(response)
+        except Exception:
+            send(make_error_response(received_bytes))
+            return False
+        send(response_bytes)
+        return was_success
+
+
+class DnsDatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, answerer: QueryAnswerer) -> None:
+        self.__transport: Optional[asyncio.DatagramTransport] = None
+        self.__answerer = answerer
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        self.__transport = transport  # type: ignore
+
+    def datagram_received(self, data: bytes, addr: Tuple[str, int]) -> None:
+        self.__answerer.answer(data, addr, lambda response_bytes: self.__send(fit_response(data, response_bytes), addr))
+
+    def error_received(self, exc: Exception) -> None:
+        log_error(f"Error on server socket {exc}")
+
+    def __send(self, response_bytes: bytes, return_address: Tuple[str, int]) -> None:
+        if self.__transport:
+            self.__transport.sendto(response_bytes, return_address)
+
+
+class DnsStreamProtocol(asyncio.Protocol):
+    """
+    DNS over TCP connection, queries pipelined on it being answered out of order as soon as each is resolved
+    (RFC 7766). Connections beyond the limit are closed right away, idle ones after the idle timeout
+    """
+
+    def __init__(
+        self, answerer: QueryAnswerer, connections: Set["DnsStreamProtocol"], max_connections: int, idle_timeout: float
+    ) -> None:
+        self.__answerer = answerer
+        self.__connections = connections
+        self.__max_connections = max_connections
+        self.__idle_timeout = idle_timeout
+        self.__transport: Optional[asyncio.Transport] = None
+        self.__address: Tuple[str, int] = ("", 0)
+        self.__buffer = bytearray()
+        self.__pending = 0
+        self.__eof = False
+        self.__paused = False
+        self.__idle_timer: Optional[asyncio.TimerHandle] = None
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        self.__transport = transport  # type: ignore
+        self.__address = transport.get_extra_info("peername")
+        if len(self.__connections) >= self.__max_connections:
+            log_debug(f"Refusing TCP connection from {self.__address}, {self.__max_connections} already open")
+            transport.close()
+            return
+        self.__connections.add(self)
+        self.__touch()
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        self.__connections.discard(self)
+        if self.__idle_timer:
+            self.__idle_timer.cancel()
+        self.__transport = None
+
+    def data_received(self, data: bytes) -> None:
+        self.__touch()
+        self.__buffer.extend(data)
+        for query in read_messages(self.__buffer):
+            if self.__answerer.answer(query, self.__address, partial(self.__send, query)):
+                self.__pending += 1
+        if self.__pending >= MAX_PIPELINED_QUERIES and self.__transport and not self.__paused:
+            self.__paused = True
+            self.__transport.pause_reading()
+
+    def eof_received(self) -> bool:
+        # Client is done sending, but still gets the answers to the queries it is waiting on
+        self.__eof = True
+        self.__close_if_done()
+        return True
+
+    def __send(self, query: bytes, response_bytes: bytes) -> None:
+        self.__pending -= 1
+        if not self.__transport or self.__transport.is_closing():
+            return
+        self.__touch()
+        self.__transport.write(frame_message(fit_response(query, response_bytes, over_tcp=True)))
+        if self.__paused and self.__pending < MAX_PIPELINED_QUERIES:
+            self.__paused = False
+            self.__transport.resume_reading()
+        self.__close_if_done()
+
+    def __close_if_done(self) -> None:
+        if self.__eof and not self.__pending and self.__transport:
+            self.__transport.close()
+
+    def __touch(self) -> None:
+        if self.__idle_timer:
+            self.__idle_timer.cancel()
+        self.__idle_timer = asyncio.get_running_loop().call_later(self.__idle_timeout, self.__on_idle)
+
+    def __on_idle(self) -> None:
+        if self.__pending:
+            # Still working on it, the client isn't the one being idle
+            self.__touch()
+            return
+        if self.__transport:
+            log_debug(f"Closing idle connection from {self.__address}")
+            self.__transport.close()
+
+
+class AsyncUdpServer(metaclass=SingletonMeta):
+    """
+    Single threaded alternative to `UdpServer`, where listening over UDP and TCP as well as upstream queries
+    are non-blocking, so that the number of in-flight resolutions isn't bound by a thread pool. The upstream
+    transport is attached to the asyncio loop while serving, so its sockets and timers run on it as well
+    """
+
+    def __init__(
+        self,
+        port: int,
+        reuse_port: bool = False,
+        max_tcp_connections: int = DEFAULT_MAX_CONNECTIONS,
+        tcp_idle_timeout: float = DEFAULT_IDLE_TIMEOUT,
+    ) -> None:
+        self.__port = port
+        self.__reuse_port = reuse_port
+        self.__max_tcp_connections = max_tcp_connections
+        self.__tcp_idle_timeout = tcp_idle_timeout
+
+    @with_prometheus_metrics_server
+    @warmup_cache(cache_snapshot)
+    @watch_zone_file(local_root_zone)
+    @watch_zone_file(local_zones)
+    def run(self) -> None:
+        try:
+            asyncio.run(self.__serve())
+        except KeyboardInterrupt:
+            log("Goodbye ! Shutting Down the server...")
+
+    async def __serve(self) -> None:
+        loop = asyncio.get_running_loop()
+        answerer = QueryAnswerer()
+        connections: Set[DnsStreamProtocol] = set()
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: DnsDatagramProtocol(answerer), local_addr=("0.0.0.0", self.__port), reuse_port=self.__reuse_port
+        )
+        tcp_server = await loop.create_server(
+            lambda: DnsStreamProtocol(answerer, connections, self.__max_tcp_connections, self.__tcp_idle_timeout),
+            host="0.0.0.0",
+            port=self.__port,
+            reuse_port=self.__reuse_port,
+        )
+        # Upstream round trips never leave the loop thread, its responses resolving the awaited futures directly
+        upstream_transport.attach(loop)
+        upstream_transport.open()
+        # Cache hits only ever happen on the loop, where the refresh can be started right away
+        response_cache.set_prefetcher(answerer.prefetch)
+        for query in cache_snapshot.get_hot_queries():
+            answerer.prefetch(query)
+        log(f"Started Optimus Server on Port {self.__port} in async mode")
+        try:
+            await loop.create_future()  # Serve until cancelled
+        finally:
+            response_cache.set_prefetcher(None)
+            upstream_transport.attach(None)
+            tcp_server.close()
+            transport.close()
@@ -2,7 +2,6 @@ import json
 import os
 import pathlib
 import posixpath
-import socket
 from typing import List
 
 __NAMESERVERS: List[str] = []
@@ -20,16 +19,32 @@ def get_root_servers():
     return __NAMESERVERS
 
 
-def warmup_cache(cache):
+def warmup_cache(snapshot):
+    """Restores the cache snapshot in the background while the decorated function serves, saving it when it returns"""
+
+    def inner(func):
+        def wrapper(*args, **kwargs):
+            snapshot.start()
+            try:
+                func(*args, **kwargs)
+            finally:
+                snapshot.stop()
+
+        return wrapper
+
+    return inner
+
+
+def watch_zone_file(zone):
+    """Reloads the zone whenever its file changes, in the background while the decorated function serves"""
+
     def inner(func):
         def wrapper(*args, **kwargs):
-            addresses = get_root_servers()
-            for addr in addresses:
-                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                sock.settimeout(5)
-                sock.connect((addr, 53))
-                cache.put(addr, sock)
-            func(*args, **kwargs)
+            zone.start()
+            try:
+                func(*args, **kwargs)
+            finally:
+                zone.stop()
 
         return wrapper
 
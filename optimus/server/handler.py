@@ -0,0 +1,138 @@
+import struct
+from typing import Optional, Tuple
+
+from optimus.dns.cache import is_cacheable_response, record_cache, response_cache
+from optimus.dns.edns import strip_opt_records
+from optimus.dns.local_zones import local_zones
+from optimus.dns.models.packet import DNSPacket, ResponseCode, Section
+from optimus.dns.models.records import RecordType
+from optimus.dns.parser.parse import DNSParser
+from optimus.dns.resolver import resolve, resolve_async
+from optimus.logging.logger import log, log_debug, log_error
+from optimus.utils import get_question_section
+
+# Time after which a query still being resolved gets a stale answer, if there is one (RFC 8767 Section 5)
+STALE_ANSWER_DELAY = 1.8
+
+
+def handle_query(received_bytes: bytes, deadline: Optional[float] = None) -> Tuple[bytes, bool]:
+    """
+    Answers a query received from a client, either out of the local zones, from cache or by resolving it
+    before the deadline.
+    Returns the serialized response along with whether the query was answered successfully
+    """
+    if not local_zones.covers(received_bytes):
+        cached_response: Optional[bytearray] = response_cache.get(received_bytes)
+        if cached_response:
+            return cached_response, True
+    query_packet: DNSPacket = parse_query(received_bytes)
+    local_response: Optional[DNSPacket] = local_zones.answer(query_packet)
+    if local_response:
+        return finish_local_response(query_packet, local_response)
+    response_packet: Optional[DNSPacket] = record_cache.get_response(query_packet)
+    if not response_packet:
+        response_packet = fall_back_to_stale(query_packet, resolve(query_packet, deadline))
+    return finish_response(received_bytes, query_packet, response_packet)
+
+
+async def handle_query_async(received_bytes: bytes, deadline: Optional[float] = None) -> Tuple[bytes, bool]:
+    """Same as `handle_query`, except that upstream queries don't block the event loop"""
+    if not local_zones.covers(received_bytes):
+        cached_response: Optional[bytearray] = response_cache.get(received_bytes)
+        if cached_response:
+            return cached_response, True
+    query_packet: DNSPacket = parse_query(received_bytes)
+    local_response: Optional[DNSPacket] = local_zones.answer(query_packet)
+    if local_response:
+        return finish_local_response(query_packet, local_response)
+    response_packet: Optional[DNSPacket] = record_cache.get_response(query_packet)
+    if not response_packet:
+        response_packet = fall_back_to_stale(query_packet, await resolve_async(query_packet, deadline))
+    return finish_response(received_bytes, query_packet, response_packet)
+
+
+def get_stale_response(received_bytes: bytes) -> Optional[Tuple[bytes, bool]]:
+    """Answers a query which is taking too long to resolve with expired cached answers, if there are any"""
+    query_packet: DNSPacket = DNSParser(bytearray(received_bytes)).get_dns_packet()
+    response_packet: Optional[DNSPacket] = record_cache.get_stale_response(query_packet)
+    if not response_packet:
+        return None
+    log(f"Resolution of {query_packet.questions[0].name} TYPE {query_packet.questions[0].rtype} is slow, serving stale")
+    return finish_response(received_bytes, query_packet, response_packet)
+
+
+def fall_back_to_stale(query_packet: DNSPacket, response_packet: DNSPacket) -> DNSPacket:
+    """Caches the resolved response, or replaces it with expired cached answers if the resolution failed"""
+    if response_packet.header.response_code != ResponseCode.SERVFAIL:
+        record_cache.put_response(response_packet)
+        return response_packet
+    stale_packet: Optional[DNSPacket] = record_cache.get_stale_response(query_packet)
+    if not stale_packet:
+        return response_packet
+    log(f"Resolution of {query_packet.questions[0].name} TYPE {query_packet.questions[0].rtype} failed, serving stale")
+    return stale_packet
+
+
+def refresh_query(received_bytes: bytes, deadline: Optional[float] = None) -> None:
+    """Resolves a query whose answer is about to expire from cache again, caching the fresh response"""
+    query_packet: DNSPacket = DNSParser(bytearray(received_bytes)).get_dns_packet()
+    log_debug(f"Prefetching {query_packet.questions[0].name} TYPE {query_packet.questions[0].rtype}")
+    response_packet: DNSPacket = resolve(query_packet, deadline)
+    record_cache.put_response(response_packet)
+    finish_response(received_bytes, query_packet, response_packet)
+
+
+async def refresh_query_async(received_bytes: bytes, deadline: Optional[float] = None) -> None:
+    query_packet: DNSPacket = DNSParser(bytearray(received_bytes)).get_dns_packet()
+    log_debug(f"Prefetching {query_packet.questions[0].name} TYPE {query_packet.questions[0].rtype}")
+    response_packet: DNSPacket = await resolve_async(query_packet, deadline)
+    record_cache.put_response(response_packet)
+    finish_response(received_bytes, query_packet, response_packet)
+
+
+def parse_query(received_bytes: bytes) -> DNSPacket:
+    query_packet: DNSPacket = DNSParser(bytearray(received_bytes)).get_dns_packet()
+    log(f"Received query for {query_packet.questions[0].name} TYPE {query_packet.questions[0].rtype}")
+    return query_packet
+
+
+def finish_response(received_bytes: bytes, query_packet: DNSPacket, response_packet: DNSPacket) -> Tuple[bytes, bool]:
+    response_packet.header.is_recursion_available = True
+    # Answers relayed from upstream aren't authoritative coming from us
+    response_packet.header.is_authoritative_answer = False
+    # Responses are cached without EDNS, which is only added for clients that asked for it
+    strip_opt_records(response_packet)
+    if not response_packet.answers:
+        # Denials are cached and relayed for their negative TTL rather than the TTL of the SOA (RFC 2308 Section 3)
+        for soa in response_packet.get_records(Section.AUTHORITY, RecordType.SOA):
+            soa.ttl = record_cache.get_negative_ttl(soa)
+    response_bytes, ttl_offsets = response_packet.to_bin_with_ttl_offsets()
+    if is_cacheable_response(response_packet):
+        response_cache.put(received_bytes, response_bytes, ttl_offsets)
+    if response_packet.header.response_code != ResponseCode.NOERROR:
+        log_error(f"Query for {query_packet.questions[0].name} TYPE {query_packet.questions[0].rtype} errored out")
+        return response_bytes, False
+    log(f"Query for {query_packet.questions[0].name} TYPE {query_packet.questions[0].rtype} successfully processed")
+    return response_bytes, True
+
+
+def finish_local_response(query_packet: DNSPacket, response_packet: DNSPacket) -> Tuple[bytes, bool]:
+    """Answers out of the local zones aren't cached, so that reloaded zones are served right away"""
+    response_packet.header.is_recursion_available = True
+    log(f"Query for {query_packet.questions[0].name} TYPE {query_packet.questions[0].rtype} answered locally")
+    return bytes(response_packet.to_bin()), response_packet.header.response_code == ResponseCode.NOERROR
+
+
+def make_error_response(received_bytes: bytes) -> bytes:
+    """
+    Response to a query which couldn't be handled, so that its client isn't left waiting on it:
+    FORMERR if the query doesn't carry exactly one well-formed question, SERVFAIL otherwise.
+    Only the ID, OPCODE and RD bit of the query are echoed back, along with its question if any
+    """
+    header = bytearray(bytes(received_bytes[:12]).ljust(12, b"\x00"))
+    question = get_question_section(received_bytes) if header[4:6] == b"\x00\x01" else None
+    # QR set, OPCODE and RD kept, AA, TC and RA cleared
+    header[2] = 0x80 | (header[2] & 0x79)
+    header[3] = (ResponseCode.SERVFAIL if question else ResponseCode.FORMERR).value
+    struct.pack_into(">HHHH", header, 4, 1 if question else 0, 0, 0, 0)
+    return bytes(header) + (question or b"")
@@ -0,0 +1,94 @@
+import threading
+from concurrent import futures
+from typing import Optional, Set, Tuple
+
+from optimus.dns.cache import get_response_key
+from optimus.utils import SingletonMeta, get_question_section
+
+# (client address, transaction ID) of a query received from a client
+ClientKey = Tuple[Tuple[str, int], bytes]
+
+
+class InflightQuery:
+    # Resolved with the (response bytes, success) answering this very query, or failed when resolution blew up
+    response: futures.Future
+    # Whether the receiver is the one expected to resolve the query, the others just wait on `response`
+    is_leader: bool
+
+    def __init__(self, response: futures.Future, is_leader: bool) -> None:
+        self.response = response
+        self.is_leader = is_leader
+
+
+def get_coalescing_key(query: bytes) -> Optional[bytes]:
+    """Queries which would be answered with the very same response can share a resolution"""
+    return get_response_key(query)
+
+
+def tailor_response(query: bytes, response: bytes) -> bytes:
+    """Patches a response to an identical query with the ID and question (casing) of the given query"""
+    question = get_question_section(query)
+    tailored = bytearray(response)
+    tailored[0:2] = query[0:2]
+    if question and response[4:6] == b"\x00\x01":
+        tailored[12 : 12 + len(question)] = question
+    return bytes(tailored)
+
+
+class InflightQueries(metaclass=SingletonMeta):
+    """
+    Thread safe registry of queries being resolved. Identical queries arriving in the meantime wait for the
+    resolution which is already under way instead of starting their own, and retransmissions of a query
+    (same client address and ID) which hasn't been answered yet are dropped altogether
+    """
+
+    def __init__(self) -> None:
+        self.__resolutions: dict[bytes, futures.Future] = dict()
+        self.__clients: Set[ClientKey] = set()
+        self.__lock = threading.Lock()
+
+    def join(self, query: bytes, client_address: Tuple[str, int]) -> Optional[InflightQuery]:
+        """
+        Registers a query received from the client, returning None if it is a retransmission of a query
+        still in flight. The leader must complete the response future with the result of resolving the query
+        """
+        client_key: ClientKey = (client_address, bytes(query[0:2]))
+        key = get_coalescing_key(query)
+        response: futures.Future = futures.Future()
+        with self.__lock:
+            if client_key in self.__clients:
+                return None
+            self.__clients.add(client_key)
+            resolution: Optional[futures.Future] = self.__resolutions.get(key) if key else None
+            if key and not resolution:
+                self.__resolutions[key] = response
+        response.add_done_callback(lambda _: self.__forget_client(client_key))
+        if resolution:
+            resolution.add_done_callback(lambda done: self.__answer_follower(done, query, response))
+            return InflightQuery(response, is_leader=False)
+        if key:
+            response.add_done_callback(lambda _: self.__forget_resolution(key, response))
+        return InflightQuery(response, is_leader=True)
+
+    def __len__(self) -> int:
+        return len(self.__clients)
+
+    def __forget_client(self, client_key: ClientKey) -> None:
+        with self.__lock:
+            self.__clients.discard(client_key)
+
+    def __forget_resolution(self, key: bytes, response: futures.Future) -> None:
+        with self.__lock:
+            if self.__resolutions.get(key) is response:
+                del self.__resolutions[key]
+
+    def __answer_follower(self, resolution: futures.Future, query: bytes, response: futures.Future) -> None:
+        error = resolution.exception()
+        if error:
+            response.set_exception(error)
+            return
+        response_bytes, was_success = resolution.result()
+        response.set_result((tailor_response(query, response_bytes), was_success))
+
+
+inflight_queries = InflightQueries()
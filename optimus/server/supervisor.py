@@ -0,0 +1,99 @@
+import os
+import signal
+import time
+from typing import Callable, Tuple
+
+from optimus.logging.logger import log, log_error
+from optimus.prometheus import mark_worker_dead, start_metrics_server
+
+# Workers dying sooner than this after being spawned are restarted with a delay, to avoid crash loops
+MIN_WORKER_UPTIME = 1
+RESTART_DELAY = 1
+# Time given to workers to exit gracefully on shutdown before they are killed
+SHUTDOWN_TIMEOUT = 5
+
+
+class Supervisor:
+    """
+    Forks a number of worker processes, each of which runs its own server bound to the same port with
+    SO_REUSEPORT so that the kernel load-balances incoming datagrams across them. Crashed workers are
+    restarted with the index of the worker they replace, which the target is called with, and SIGINT/SIGTERM
+    are forwarded to the workers for a clean shutdown
+    """
+
+    def __init__(self, workers: int, target: Callable[[int], None]) -> None:
+        self.__workers = workers
+        self.__target = target
+        # pid -> index of the worker, monotonic time at which it was spawned
+        self.__children: dict[int, Tuple[int, float]] = dict()
+        self.__stopping = False
+
+    def run(self) -> None:
+        start_metrics_server()
+        signal.signal(signal.SIGINT, self.__stop)
+        signal.signal(signal.SIGTERM, self.__stop)
+        for index in range(self.__workers):
+            self.__spawn(index)
+        log(f"Supervising {self.__workers} worker processes")
+        while self.__children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            child = self.__children.pop(pid, None)
+            if child is None:
+                continue
+            index, spawned_at = child
+            mark_worker_dead(pid)
+            if self.__stopping:
+                continue
+            log_error(f"Worker {pid} exited with status {os.waitstatus_to_exitcode(status)}, restarting it")
+            if time.monotonic() - spawned_at < MIN_WORKER_UPTIME:
+                time.sleep(RESTART_DELAY)
+            self.__spawn(index)
+        log("Goodbye ! All workers have exited")
+
+    def __spawn(self, index: int) -> None:
+        pid = os.fork()
+        if pid:
+            self.__children[pid] = (index, time.monotonic())
+            return
+        # Worker process, SIGINT surfaces as KeyboardInterrupt which the servers handle gracefully
+        signal.signal(signal.SIGINT, self.__interrupt_once)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        exit_code = 0
+        try:
+            self.__target(index)
+        except BaseException as e:
+            log_error(f"Worker {os.getpid()} crashed: {e!r}")
+            exit_code = 1
+        finally:
+            os._exit(exit_code)
+
+    @staticmethod
+    def __interrupt_once(signum: int, frame) -> None:
+        # Ctrl-C reaches workers both from the terminal and through the supervisor, a second interrupt
+        # would cut their shutdown (e.g saving the cache snapshot) short
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.default_int_handler(signum, frame)
+
+    def __stop(self, signum: int, _) -> None:
+        if self.__stopping:
+            return
+        self.__stopping = True
+        log("Shutting down workers...")
+        for pid in list(self.__children):
+            self.__signal(pid, signal.SIGINT)
+        signal.signal(signal.SIGALRM, self.__kill)
+        signal.alarm(SHUTDOWN_TIMEOUT)
+
+    def __kill(self, signum: int, _) -> None:
+        for pid in list(self.__children):
+            log_error(f"Worker {pid} didn't exit in time, killing it")
+            self.__signal(pid, signal.SIGKILL)
+
+    def __signal(self, pid: int, signum: int) -> None:
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
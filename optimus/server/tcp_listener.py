@@ -0,0 +1,214 @@
+import socket
+from functools import partial
+from typing import Callable, Dict, Optional, Tuple
+
+from optimus.dns.edns import fit_response
+from optimus.logging.logger import log, log_debug
+from optimus.networking.loop import EventLoop, TimerHandle
+from optimus.networking.tcp import RECV_BUFFER_SIZE, frame_message, read_messages
+
+DEFAULT_MAX_CONNECTIONS = 1000
+DEFAULT_IDLE_TIMEOUT = 10
+# Queries a single connection may have outstanding, reading from it is paused beyond that
+MAX_PIPELINED_QUERIES = 64
+
+Address = Tuple[str, int]
+# Answers the query received from the address by calling the reply callback, which may be called from any thread.
+# Returns False if the query got dropped, in which case the callback is never called
+Dispatcher = Callable[[bytes, Address, Callable[[bytes], None]], bool]
+
+
+class TcpConnection:
+    """
+    Client connection on which queries may be pipelined, each being answered as soon as it is resolved,
+    regardless of the order the queries came in (RFC 7766 Section 6.2.1.1)
+    """
+
+    def __init__(
+        self,
+        loop: EventLoop,
+        sock: socket.socket,
+        address: Address,
+        dispatch: Dispatcher,
+        idle_timeout: float,
+        on_close: Callable[["TcpConnection"], None],
+    ) -> None:
+        self.__loop = loop
+        self.__sock = sock
+        self.__address = address
+        self.__dispatch = dispatch
+        self.__idle_timeout = idle_timeout
+        self.__on_close = on_close
+        self.__recv_buffer = bytearray()
+        self.__send_buffer = bytearray()
+        self.__pending = 0
+        self.__reading = False
+        self.__writing = False
+        self.__eof = False
+        self.__closed = False
+        self.__idle_timer: Optional[TimerHandle] = None
+
+    def open(self) -> None:
+        self.__sock.setblocking(False)
+        self.__resume_reading()
+        self.__touch()
+
+    def close(self) -> None:
+        if self.__closed:
+            return
+        self.__closed = True
+        if self.__idle_timer:
+            self.__idle_timer.cancel()
+        self.__loop.remove_reader(self.__sock)
+        self.__loop.remove_writer(self.__sock)
+        self.__sock.close()
+        self.__on_close(self)
+
+    def __on_readable(self) -> None:
+        try:
+            data = self.__sock.recv(RECV_BUFFER_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            log_debug(f"Error while reading from {self.__address} {e!r}")
+            self.close()
+            return
+        if not data:
+            # Client is done sending, but still gets the answers to the queries it is waiting on
+            self.__eof = True
+            self.__pause_reading()
+            self.__close_if_done()
+            return
+        self.__touch()
+        self.__recv_buffer.extend(data)
+        for query in read_messages(self.__recv_buffer):
+            if self.__dispatch(query, self.__address, partial(self.__reply, query)):
+                self.__pending += 1
+        if self.__pending >= MAX_PIPELINED_QUERIES:
+            self.__pause_reading()
+
+    def __reply(self, query: bytes, response_bytes: bytes) -> None:
+        self.__loop.call_soon_threadsafe(self.__send, fit_response(query, response_bytes, over_tcp=True))
+
+    def __send(self, response_bytes: bytes) -> None:
+        self.__pending -= 1
+        if self.__closed:
+            return
+        self.__touch()
+        self.__send_buffer.extend(frame_message(response_bytes))
+        self.__flush()
+        if not self.__eof and self.__pending < MAX_PIPELINED_QUERIES:
+            self.__resume_reading()
+
+    def __flush(self) -> None:
+        try:
+            sent = self.__sock.send(self.__send_buffer)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError as e:
+            log_debug(f"Error while writing to {self.__address} {e!r}")
+            self.close()
+            return
+        del self.__send_buffer[:sent]
+        if self.__send_buffer and not self.__writing:
+            self.__writing = True
+            self.__loop.add_writer(self.__sock, self.__flush)
+        elif not self.__send_buffer and self.__writing:
+            self.__writing = False
+            self.__loop.remove_writer(self.__sock)
+        self.__close_if_done()
+
+    def __close_if_done(self) -> None:
+        if self.__eof and not self.__pending and not self.__send_buffer:
+            self.close()
+
+    def __pause_reading(self) -> None:
+        if self.__reading:
+            self.__reading = False
+            self.__loop.remove_reader(self.__sock)
+
+    def __resume_reading(self) -> None:
+        if not self.__reading:
+            self.__reading = True
+            self.__loop.add_reader(self.__sock, self.__on_readable)
+
+    def __touch(self) -> None:
+        if self.__idle_timer:
+            self.__idle_timer.cancel()
+        self.__idle_timer = self.__loop.call_later(self.__idle_timeout, self.__on_idle)
+
+    def __on_idle(self) -> None:
+        if self.__pending or self.__send_buffer:
+            # Still working on it, the client isn't the one being idle
+            self.__touch()
+            return
+        log_debug(f"Closing idle connection from {self.__address}")
+        self.close()
+
+
+class TcpListener:
+    """
+    Accepts DNS over TCP connections on an event loop, so that thousands of mostly idle connections cost
+    no more than their sockets. Queries are handed over to the same dispatcher as the ones received over UDP
+    """
+
+    def __init__(
+        self,
+        loop: EventLoop,
+        port: int,
+        dispatch: Dispatcher,
+        reuse_port: bool = False,
+        max_connections: int = DEFAULT_MAX_CONNECTIONS,
+        idle_timeout: float = DEFAULT_IDLE_TIMEOUT,
+    ) -> None:
+        self.__loop = loop
+        self.__port = port
+        self.__dispatch = dispatch
+        self.__reuse_port = reuse_port
+        self.__max_connections = max_connections
+        self.__idle_timeout = idle_timeout
+        self.__connections: Dict[int, TcpConnection] = dict()
+        self.__sock: Optional[socket.socket] = None
+
+    def open(self) -> None:
+        self.__sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.__sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.__reuse_port:
+            self.__sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.__sock.bind(("0.0.0.0", self.__port))
+        self.__sock.listen(socket.SOMAXCONN)
+        self.__sock.setblocking(False)
+        self.__loop.add_reader(self.__sock, self.__on_acceptable)
+        log(f"Listening for TCP connections on Port {self.__port}, up to {self.__max_connections} at a time")
+
+    def close(self) -> None:
+        for connection in list(self.__connections.values()):
+            connection.close()
+        if self.__sock:
+            self.__loop.remove_reader(self.__sock)
+            self.__sock.close()
+            self.__sock = None
+
+    def connection_count(self) -> int:
+        return len(self.__connections)
+
+    def __on_acceptable(self) -> None:
+        while self.__sock:
+            try:
+                sock, address = self.__sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # e.g running out of file descriptors, the pending connection is left in the backlog
+                log_debug(f"Error while accepting TCP connection {e!r}")
+                return
+            if len(self.__connections) >= self.__max_connections:
+                log_debug(f"Refusing TCP connection from {address}, {self.__max_connections} already open")
+                sock.close()
+                continue
+            connection = TcpConnection(self.__loop, sock, address, self.__dispatch, self.__idle_timeout, self.__forget)
+            self.__connections[id(connection)] = connection
+            connection.open()
+
+    def __forget(self, connection: TcpConnection) -> None:
+        self.__connections.pop(id(connection), None)
@@ -1,47 +1,211 @@
 import socket
+from collections import deque
 from concurrent import futures
+from functools import partial
+from typing import Callable, Deque, Optional, Tuple
 
-from optimus.dns.models.packet import DNSPacket, ResponseCode
-from optimus.dns.parser.parse import DNSParser
-from optimus.dns.resolver import resolve
+from optimus.dns.cache import response_cache
+from optimus.dns.edns import MAX_UDP_PAYLOAD_SIZE, fit_response
+from optimus.dns.local_zones import local_zones
+from optimus.dns.resolver import resolver_settings
+from optimus.dns.root_zone import local_root_zone
+from optimus.dns.snapshot import cache_snapshot
 from optimus.logging.logger import log, log_error
-from optimus.networking.cache import socket_cache
+from optimus.networking.loop import EventLoop
+from optimus.networking.transport import upstream_transport
 from optimus.prometheus import record_metrics, with_prometheus_metrics_server
-from optimus.server.context import warmup_cache
+from optimus.server.context import warmup_cache, watch_zone_file
+from optimus.server.handler import (
+    STALE_ANSWER_DELAY,
+    get_stale_response,
+    handle_query,
+    make_error_response,
+    refresh_query,
+)
+from optimus.server.inflight import inflight_queries
+from optimus.server.tcp_listener import DEFAULT_IDLE_TIMEOUT, DEFAULT_MAX_CONNECTIONS, TcpListener
 from optimus.utils import SingletonMeta
 
+# Upper bound on datagrams read per wakeup, so that a flood of queries can't starve replies and timers
+MAX_RECV_BATCH = 1024
+
 
 class UdpServer(metaclass=SingletonMeta):
-    def __init__(self, port: int, worker_threads: int) -> None:
+    """
+    Listens for UDP and TCP queries on an epoll driven event loop, which drains every pending datagram on
+    each wakeup. Cache hits are answered right away on the loop, the rest are resolved by a pool of worker
+    threads whose upstream queries are multiplexed on the same loop. Queries identical to one being resolved
+    wait for its response without taking up a worker. Replies are queued up and flushed together by the loop
+    """
+
+    def __init__(
+        self,
+        port: int,
+        worker_threads: int,
+        reuse_port: bool = False,
+        max_tcp_connections: int = DEFAULT_MAX_CONNECTIONS,
+        tcp_idle_timeout: float = DEFAULT_IDLE_TIMEOUT,
+    ) -> None:
         self.__port = port
         self.__threads = worker_threads
+        # Lets several worker processes bind the same port, the kernel then load-balances between them
+        self.__reuse_port = reuse_port
+        self.__max_tcp_connections = max_tcp_connections
+        self.__tcp_idle_timeout = tcp_idle_timeout
+        self.__replies: Deque[Tuple[bytes, Tuple[str, int]]] = deque()
+        self.__flush_scheduled = False
+        self.__waiting_for_writable = False
 
     @with_prometheus_metrics_server
-    @warmup_cache(socket_cache)
+    @warmup_cache(cache_snapshot)
+    @watch_zone_file(local_root_zone)
+    @watch_zone_file(local_zones)
     def run(self) -> None:
         self.__master_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if self.__reuse_port:
+            self.__master_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.__master_socket.bind(("0.0.0.0", self.__port))
+        self.__master_socket.setblocking(False)
+        self.__loop = EventLoop()
+        tcp_listener = TcpListener(
+            self.__loop,
+            self.__port,
+            self.__dispatch,
+            reuse_port=self.__reuse_port,
+            max_connections=self.__max_tcp_connections,
+            idle_timeout=self.__tcp_idle_timeout,
+        )
         log(f"Started Optimus Server on Port {self.__port} with {self.__threads} threads")
-        # TODO: Test with ProcessPoolExecutor and EPOLL
         try:
             with futures.ThreadPoolExecutor(max_workers=self.__threads) as pool:
-                while True:
-                    received_bytes, address = self.__master_socket.recvfrom(600)
-                    pool.submit(self.__handle_request, received_bytes, address)
+                self.__pool = pool
+                # Upstream sockets get multiplexed on the same loop as the listener
+                upstream_transport.attach(self.__loop)
+                response_cache.set_prefetcher(self.__prefetch)
+                for query in cache_snapshot.get_hot_queries():
+                    # Left to start their deadline once a worker picks them up, as they may be many
+                    pool.submit(refresh_query, query)
+                self.__loop.add_reader(self.__master_socket, self.__on_readable)
+                tcp_listener.open()
+                upstream_transport.open()
+                try:
+                    self.__loop.run_forever()
+                finally:
+                    response_cache.set_prefetcher(None)
+                    upstream_transport.attach(None)
         except KeyboardInterrupt:
             log("Goodbye ! Shutting Down the server...")
         finally:
+            tcp_listener.close()
+            self.__loop.close()
             self.__master_socket.close()
 
-    @record_metrics
-    def __handle_request(self, received_bytes: bytes, return_address: tuple[str, int]) -> bool:
-        query_packet: DNSPacket = DNSParser(bytearray(received_bytes)).get_dns_packet()
-        log(f"Received query for {query_packet.questions[0].name} TYPE {query_packet.questions[0].rtype}")
-        response_packet: DNSPacket = resolve(query_packet)
-        response_packet.header.is_recursion_available = True
-        self.__master_socket.sendto(response_packet.to_bin(), return_address)
-        if response_packet.header.response_code != ResponseCode.NOERROR:
-            log_error(f"Query for {query_packet.questions[0].name} TYPE {query_packet.questions[0].rtype} errored out")
+    def __on_readable(self) -> None:
+        # Drain every datagram which is already queued on the socket, until it would block
+        for _ in range(MAX_RECV_BATCH):
+            try:
+                received_bytes, address = self.__master_socket.recvfrom(MAX_UDP_PAYLOAD_SIZE)
+            except (BlockingIOError, InterruptedError):
+                break
+            reply = partial(self.__queue_reply, query=received_bytes, return_address=address)
+            self.__dispatch(received_bytes, address, reply)
+        self.__flush()
+
+    def __dispatch(self, received_bytes: bytes, address: Tuple[str, int], reply: Callable[[bytes], None]) -> bool:
+        """
+        Answers the query from cache right away or gets it resolved, calling `reply` with the response.
+        Returns False when the query is dropped as a retransmission of one still in flight
+        """
+        # Names of the local zones are always answered out of the zones, on a worker
+        if not local_zones.covers(received_bytes):
+            cached_response: Optional[bytearray] = response_cache.get(received_bytes)
+            if cached_response:
+                self.__reply_from_cache(cached_response, reply)
+                return True
+        inflight = inflight_queries.join(received_bytes, address)
+        if not inflight:
             return False
-        log(f"Query for {query_packet.questions[0].name} TYPE {query_packet.questions[0].rtype} successfully processed")
+        inflight.response.add_done_callback(partial(self.__on_resolved, received_bytes=received_bytes, reply=reply))
+        if inflight.is_leader:
+            # The deadline runs from now on, so queries which waited too long for a worker are abandoned right away
+            self.__pool.submit(
+                self.__handle_request, received_bytes, inflight.response, resolver_settings.get_deadline()
+            )
+            timer = self.__loop.call_later(STALE_ANSWER_DELAY, self.__answer_stale, received_bytes, inflight.response)
+            inflight.response.add_done_callback(lambda _: timer.cancel())
+        else:
+            inflight.response.add_done_callback(self.__answered_by_leader)
+        return True
+
+    def __prefetch(self, received_bytes: bytes) -> None:
+        """Refreshes a popular cached response on a worker, while the cached one keeps being served"""
+        self.__pool.submit(refresh_query, received_bytes, resolver_settings.get_deadline())
+
+    @record_metrics
+    def __reply_from_cache(self, response_bytes: bytes, reply: Callable[[bytes], None]) -> bool:
+        reply(response_bytes)
         return True
+
+    @record_metrics
+    def __handle_request(self, received_bytes: bytes, response: futures.Future, deadline: float) -> bool:
+        try:
+            response_bytes, was_success = handle_query(received_bytes, deadline)
+        except Exception as e:
+            log_error(f"Couldn't handle query {e!r}")
+            if not response.done():
+                response.set_exception(e)
+            return False
+        try:
+            response.set_result((response_bytes, was_success))
+        except futures.InvalidStateError:
+            # Already answered with stale data, the fresh response just got cached
+            pass
+        return was_success
+
+    def __answer_stale(self, received_bytes: bytes, response: futures.Future) -> None:
+        """Answers a query which is taking too long to resolve with stale data, while the resolution goes on"""
+        if response.done():
+            return
+        stale_response = get_stale_response(received_bytes)
+        if not stale_response:
+            return
+        try:
+            response.set_result(stale_response)
+        except futures.InvalidStateError:
+            pass
+
+    @record_metrics
+    def __answered_by_leader(self, response: futures.Future) -> bool:
+        return not response.exception() and response.result()[1]
+
+    def __on_resolved(self, response: futures.Future, received_bytes: bytes, reply: Callable[[bytes], None]) -> None:
+        if response.exception():
+            # Still answered, TCP connections would otherwise keep waiting on the query
+            reply(make_error_response(received_bytes))
+            return
+        response_bytes, _ = response.result()
+        reply(response_bytes)
+
+    def __queue_reply(self, response_bytes: bytes, query: bytes, return_address: Tuple[str, int]) -> None:
+        self.__replies.append((fit_response(query, response_bytes), return_address))
+        # Replies from workers are batched up until the loop gets around to flushing them
+        if not self.__flush_scheduled:
+            self.__flush_scheduled = True
+            self.__loop.call_soon_threadsafe(self.__flush)
+
+    def __flush(self) -> None:
+        self.__flush_scheduled = False
+        while self.__replies:
+            response_bytes, return_address = self.__replies.popleft()
+            try:
+                self.__master_socket.sendto(response_bytes, return_address)
+            except (BlockingIOError, InterruptedError):
+                # Socket buffer is full, resume once it is writable again
+                self.__replies.appendleft((response_bytes, return_address))
+                if not self.__waiting_for_writable:
+                    self.__waiting_for_writable = True
+                    self.__loop.add_writer(self.__master_socket, self.__flush)
+                return
+        if self.__waiting_for_writable:
+            self.__waiting_for_writable = False
+            self.__loop.remove_writer(self.__master_socket)
@@ -1,3 +1,8 @@
+from typing import Optional, Tuple
+
+DNS_PORT = 53
+
+
 class SingletonMeta(type):
     __INSTANCE: dict[str, object] = dict()
 
@@ -7,13 +12,32 @@ class SingletonMeta(type):
         return cls.__INSTANCE[cls_name]
 
 
-def to_n_bytes(data: int, n: int) -> bytearray:
-    """Given an integer, converts it to a bytearray of size n"""
-    ret = bytearray()
-    mask = 0xFF
-    for i in range(n):
-        right_shift_by_bits = 8 * i
-        temp = (data >> right_shift_by_bits) & mask
-        ret.append(temp)
-    ret.reverse()
-    return ret
+def normalize_name(name: str) -> str:
+    """Lowercases a domain name and strips its trailing dot, the root domain being an empty string"""
+    return name.lower().rstrip(".")
+
+
+def is_subdomain(name: str, zone: str) -> bool:
+    """Checks whether the (normalized) name is the zone itself or lies below it"""
+    return not zone or name == zone or name.endswith("." + zone)
+
+
+def split_server_addr(server_addr: str) -> Tuple[str, int]:
+    """Splits the port off server addresses written as `address:port`, the port being 53 otherwise"""
+    host, _, port = server_addr.partition(":")
+    return host, int(port) if port else DNS_PORT
+
+
+def get_question_section(packet: bytes) -> Optional[bytes]:
+    """Returns the raw bytes (name, Type and Class) of the first question of a DNS message, if well-formed"""
+    pos = 12
+    while pos < len(packet):
+        label_length = packet[pos]
+        if label_length == 0:
+            end = pos + 1 + 4
+            return bytes(packet[12:end]) if end <= len(packet) else None
+        if label_length & 0xC0:
+            # Names in the question section are never compressed
+            return None
+        pos += label_length + 1
+    return None
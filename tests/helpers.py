@@ -0,0 +1,35 @@
+import socket
+
+from optimus.dns.models.packet import DNSHeader, DNSPacket, Question
+from optimus.dns.models.records import RecordClass, RecordType
+from optimus.networking.tcp import read_messages
+
+
+def query(name: str, rtype: RecordType = RecordType.A, id: int = 7, recursion_desired: bool = True) -> DNSPacket:
+    return DNSPacket(
+        DNSHeader(id=id, is_query=True, question_count=1, is_recursion_desired=recursion_desired),
+        [Question(name, rtype, RecordClass.IN)],
+    )
+
+
+def query_bin(name: str, rtype: RecordType = RecordType.A, id: int = 7, recursion_desired: bool = True) -> bytes:
+    return bytes(query(name, rtype, id=id, recursion_desired=recursion_desired).to_bin())
+
+
+def get_free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        port: int = sock.getsockname()[1]
+        return port
+
+
+def recv_message(sock: socket.socket) -> bytes:
+    buffer = bytearray()
+    while True:
+        messages = read_messages(buffer)
+        if messages:
+            return messages[0]
+        data = sock.recv(4096)
+        if not data:
+            raise ConnectionError("Connection closed")
+        buffer.extend(data)
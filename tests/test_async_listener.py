@@ -0,0 +1,142 @@
+import asyncio
+import socket
+import threading
+import unittest
+from ipaddress import IPv4Address
+from typing import Dict, List
+from unittest import mock
+
+from optimus.dns.cache import RecordCache, ResponseCache
+from optimus.dns.models.packet import DNSHeader, DNSPacket
+from optimus.dns.models.records import A, Record, RecordClass, RecordType
+from optimus.dns.parser.parse import DNSParser
+from optimus.networking.tcp import frame_message
+from optimus.server.async_listener import DnsDatagramProtocol, DnsStreamProtocol, QueryAnswerer
+from tests.helpers import get_free_port, query_bin, recv_message
+
+
+def parse(response_bytes: bytes) -> DNSPacket:
+    return DNSParser(bytearray(response_bytes)).get_dns_packet()
+
+
+class FakeResolver:
+    """Resolves names to as many A records as asked for, after the given delay, recording every resolution"""
+
+    def __init__(self) -> None:
+        self.resolved: List[str] = []
+        self.delays: Dict[str, float] = dict()
+        self.record_counts: Dict[str, int] = dict()
+
+    async def __call__(self, qpacket: DNSPacket, deadline=None) -> DNSPacket:
+        name = qpacket.questions[0].name
+        self.resolved.append(name)
+        await asyncio.sleep(self.delays.get(name, 0))
+        answers: List[Record] = [
+            A(name, RecordType.A, RecordClass.IN, 300, 4, IPv4Address(f"10.0.{i // 256}.{i % 256}"))
+            for i in range(self.record_counts.get(name, 1))
+        ]
+        return DNSPacket(
+            DNSHeader(id=qpacket.header.ID, question_count=1, answer_count=len(answers)),
+            qpacket.questions,
+            answers,
+        )
+
+
+class TestAsyncListener(unittest.TestCase):
+
+    def setUp(self):
+        self.port = get_free_port()
+        self.resolver = FakeResolver()
+        patches = [
+            mock.patch("optimus.server.handler.resolve_async", self.resolver),
+            mock.patch("optimus.server.handler.response_cache", ResponseCache()),
+            mock.patch("optimus.server.handler.record_cache", RecordCache()),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        loop = asyncio.new_event_loop()
+        answerer = QueryAnswerer()
+        transport, _ = loop.run_until_complete(
+            loop.create_datagram_endpoint(lambda: DnsDatagramProtocol(answerer), local_addr=("127.0.0.1", self.port))
+        )
+        tcp_server = loop.run_until_complete(
+            loop.create_server(
+                lambda: DnsStreamProtocol(answerer, set(), max_connections=4, idle_timeout=1),
+                host="127.0.0.1",
+                port=self.port,
+            )
+        )
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+
+        def stop():
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            transport.close()
+            tcp_server.close()
+            loop.run_until_complete(tcp_server.wait_closed())
+            loop.close()
+
+        self.addCleanup(stop)
+
+    def udp_client(self) -> socket.socket:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(2)
+        sock.connect(("127.0.0.1", self.port))
+        self.addCleanup(sock.close)
+        return sock
+
+    def tcp_client(self) -> socket.socket:
+        sock = socket.create_connection(("127.0.0.1", self.port), timeout=2)
+        self.addCleanup(sock.close)
+        return sock
+
+    def test_cache_hits_are_not_resolved_again(self):
+        sock = self.udp_client()
+        for id in (1, 2):
+            sock.send(query_bin("www.example.com", id=id))
+            packet = parse(sock.recv(4096))
+            self.assertEqual(packet.header.ID, id)
+            self.assertEqual(str(packet.answers[0].ipv4_address), "10.0.0.0")
+        self.assertEqual(self.resolver.resolved, ["www.example.com"])
+
+    def test_identical_queries_are_resolved_once(self):
+        self.resolver.delays["www.example.com"] = 0.2
+        clients = [self.udp_client() for _ in range(3)]
+        for id, sock in enumerate(clients):
+            sock.send(query_bin("www.example.com", id=id))
+        for id, sock in enumerate(clients):
+            packet = parse(sock.recv(4096))
+            self.assertEqual(packet.header.ID, id)
+            self.assertEqual(len(packet.answers), 1)
+        self.assertEqual(self.resolver.resolved, ["www.example.com"])
+
+    def test_large_responses_are_truncated_over_udp_only(self):
+        self.resolver.record_counts["big.example.com"] = 64
+        sock = self.udp_client()
+        sock.send(query_bin("big.example.com"))
+        packet = parse(sock.recv(4096))
+        self.assertTrue(packet.header.is_truncated_message)
+        self.assertEqual(packet.answers, [])
+        # Clients then retry over TCP, where the response fits whole
+        sock = self.tcp_client()
+        sock.sendall(frame_message(query_bin("big.example.com")))
+        packet = parse(recv_message(sock))
+        self.assertFalse(packet.header.is_truncated_message)
+        self.assertEqual(len(packet.answers), 64)
+
+    def test_pipelined_queries_are_answered_as_resolved(self):
+        self.resolver.delays["slow.example.com"] = 0.2
+        sock = self.tcp_client()
+        sock.sendall(
+            frame_message(query_bin("slow.example.com", id=1)) + frame_message(query_bin("fast.example.com", id=2))
+        )
+        self.assertEqual(parse(recv_message(sock)).questions[0].name, "fast.example.com")
+        self.assertEqual(parse(recv_message(sock)).questions[0].name, "slow.example.com")
+        sock.shutdown(socket.SHUT_WR)
+        self.assertEqual(sock.recv(10), b"")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,326 @@
+import struct
+import unittest
+from ipaddress import IPv4Address
+from unittest import mock
+
+from optimus.dns.cache import (
+    DEFAULT_MAX_STALE_TTL,
+    DEFAULT_PREFETCH_MIN_HITS,
+    HOLD_DOWN_SECONDS,
+    MAX_CONSECUTIVE_FAILURES,
+    STALE_ANSWER_TTL,
+    UNKNOWN_SERVER_TIMEOUT,
+    InfraCache,
+    RecordCache,
+    ResponseCache,
+    get_question_key,
+    is_cacheable_response,
+)
+from optimus.dns.models.packet import DNSHeader, DNSPacket, Question, ResponseCode
+from optimus.dns.models.records import NS, SOA, A, RecordClass, RecordType
+from tests.helpers import query, query_bin
+
+
+def a_record(name: str, ttl: int, address: str = "10.0.0.1") -> A:
+    return A(name, RecordType.A, RecordClass.IN, ttl, 4, IPv4Address(address))
+
+
+def soa_record(zone: str, ttl: int, minimum: int) -> SOA:
+    mname, rname = f"ns1.{zone}", f"admin.{zone}"
+    return SOA(zone, RecordType.SOA, RecordClass.IN, ttl, 0, mname, rname, 1, 7200, 900, 86400, minimum)
+
+
+class TestRecordCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = RecordCache(max_entries=3)
+
+    def test_get_miss(self):
+        self.assertIsNone(self.cache.get("google.com", RecordType.A, RecordClass.IN))
+
+    def test_put_and_get_is_case_insensitive(self):
+        self.cache.put("Google.com", RecordType.A, RecordClass.IN, [a_record("google.com", 300)])
+        records = self.cache.get("google.COM.", RecordType.A, RecordClass.IN)
+        self.assertIsNotNone(records)
+        self.assertEqual(str(records[0].ipv4_address), "10.0.0.1")
+        self.assertIsNone(self.cache.get("google.com", RecordType.AAAA, RecordClass.IN))
+
+    def test_ttl_counts_down_and_expires(self):
+        now = 1000.0
+        with mock.patch("optimus.dns.cache.time.monotonic", return_value=now):
+            self.cache.put("google.com", RecordType.A, RecordClass.IN, [a_record("google.com", 300)])
+        with mock.patch("optimus.dns.cache.time.monotonic", return_value=now + 100):
+            records = self.cache.get("google.com", RecordType.A, RecordClass.IN)
+            self.assertEqual(records[0].ttl, 200)
+        with mock.patch("optimus.dns.cache.time.monotonic", return_value=now + 301):
+            self.assertIsNone(self.cache.get("google.com", RecordType.A, RecordClass.IN))
+        # Kept around to be served stale, until the stale window is over as well
+        self.assertEqual(len(self.cache), 1)
+        with mock.patch("optimus.dns.cache.time.monotonic", return_value=now + 301 + DEFAULT_MAX_STALE_TTL):
+            self.assertIsNone(self.cache.get("google.com", RecordType.A, RecordClass.IN))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_stale_response_within_stale_window(self):
+        now = 1000.0
+        self.cache.configure(max_stale_ttl=3600)
+        with mock.patch("optimus.dns.cache.time.monotonic", return_value=now):
+            self.cache.put("google.com", RecordType.A, RecordClass.IN, [a_record("google.com", 300)])
+        with mock.patch("optimus.dns.cache.time.monotonic", return_value=now + 1000):
+            self.assertIsNone(self.cache.get_response(query("google.com")))
+            response = self.cache.get_stale_response(query("google.com"))
+        self.assertEqual(response.answers[0].ttl, STALE_ANSWER_TTL)
+        self.assertEqual(str(response.answers[0].ipv4_address), "10.0.0.1")
+        self.assertIsNone(self.cache.get_stale_response(query("google.com", RecordType.MX)))
+        with mock.patch("optimus.dns.cache.time.monotonic", return_value=now + 300 + 3600):
+            self.assertIsNone(self.cache.get_stale_response(query("google.com")))
+
+    def test_returned_records_are_copies(self):
+        self.cache.put("google.com", RecordType.A, RecordClass.IN, [a_record("google.com", 300)])
+        self.cache.get("google.com", RecordType.A, RecordClass.IN)[0].ttl = 0
+        self.assertEqual(self.cache.get("google.com", RecordType.A, RecordClass.IN)[0].ttl, 300)
+
+    def test_zero_ttl_is_not_cached(self):
+        self.cache.put("google.com", RecordType.A, RecordClass.IN, [a_record("google.com", 0)])
+        self.assertIsNone(self.cache.get("google.com", RecordType.A, RecordClass.IN))
+
+    def test_lru_eviction_by_entries(self):
+        for name in ["a.com", "b.com", "c.com"]:
+            self.cache.put(name, RecordType.A, RecordClass.IN, [a_record(name, 300)])
+        # Touch a.com so that b.com becomes the least recently used entry
+        self.cache.get("a.com", RecordType.A, RecordClass.IN)
+        self.cache.put("d.com", RecordType.A, RecordClass.IN, [a_record("d.com", 300)])
+        self.assertIsNone(self.cache.get("b.com", RecordType.A, RecordClass.IN))
+        for name in ["a.com", "c.com", "d.com"]:
+            self.assertIsNotNone(self.cache.get(name, RecordType.A, RecordClass.IN))
+
+    def test_eviction_by_memory(self):
+        self.cache.configure(max_entries=100, max_bytes=1)
+        self.cache.put("a.com", RecordType.A, RecordClass.IN, [a_record("a.com", 300)])
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache.used_bytes, 0)
+
+    def test_put_response_only_caches_answers(self):
+        question = Question("google.com", RecordType.A, RecordClass.IN)
+        servfail = DNSPacket(DNSHeader(id=1, response_code=ResponseCode.SERVFAIL), [question])
+        self.cache.put_response(servfail)
+        self.assertIsNone(self.cache.get("google.com", RecordType.A, RecordClass.IN))
+        answer = DNSPacket(DNSHeader(id=1, answer_count=1), [question], answers=[a_record("google.com", 60)])
+        self.cache.put_response(answer)
+        self.assertEqual(len(self.cache.get("google.com", RecordType.A, RecordClass.IN)), 1)
+
+    def test_get_response_for_positive_answer(self):
+        self.cache.put("google.com", RecordType.A, RecordClass.IN, [a_record("google.com", 300)])
+        response = self.cache.get_response(query("google.com", id=42))
+        self.assertEqual(response.header.ID, 42)
+        self.assertFalse(response.header.is_query)
+        self.assertEqual(response.header.response_code, ResponseCode.NOERROR)
+        self.assertEqual(response.header.answer_count, 1)
+        self.assertIsNone(self.cache.get_response(query("google.com", RecordType.MX)))
+
+
+class TestNegativeCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = RecordCache(max_negative_ttl=600)
+
+    def negative_response(self, name: str, rtype: RecordType, rcode: ResponseCode, soa: SOA) -> DNSPacket:
+        return DNSPacket(
+            DNSHeader(id=1, response_code=rcode, question_count=1, nameserver_records_count=1),
+            [Question(name, rtype, RecordClass.IN)],
+            nameserver_records=[soa],
+        )
+
+    def test_nodata_is_cached_for_soa_minimum(self):
+        soa = soa_record("example.com", 3600, 300)
+        self.cache.put_response(self.negative_response("example.com", RecordType.AAAA, ResponseCode.NOERROR, soa))
+        response = self.cache.get_response(query("example.com", RecordType.AAAA))
+        self.assertEqual(response.header.response_code, ResponseCode.NOERROR)
+        self.assertEqual(response.answers, [])
+        self.assertEqual(response.nameserver_records[0].ttl, 300)
+        # NODATA only denies that type, other types of the same name are still a miss
+        self.assertIsNone(self.cache.get_response(query("example.com", RecordType.A)))
+        self.assertIsNone(self.cache.get("example.com", RecordType.AAAA, RecordClass.IN))
+
+    def test_negative_ttl_is_clamped(self):
+        soa = soa_record("example.com", 86400, 86400)
+        self.cache.put_response(self.negative_response("nope.example.com", RecordType.A, ResponseCode.NXDOMAIN, soa))
+        response = self.cache.get_response(query("nope.example.com"))
+        self.assertEqual(response.nameserver_records[0].ttl, 600)
+
+    def test_nxdomain_cut_denies_names_below(self):
+        soa = soa_record("example.com", 300, 300)
+        self.cache.put_response(self.negative_response("nope.example.com", RecordType.A, ResponseCode.NXDOMAIN, soa))
+        for name, rtype in [("nope.example.com", RecordType.MX), ("a.b.NOPE.example.com", RecordType.A)]:
+            response = self.cache.get_response(query(name, rtype))
+            self.assertEqual(response.header.response_code, ResponseCode.NXDOMAIN)
+            self.assertEqual(response.questions[0].name, name)
+        self.assertIsNone(self.cache.get_response(query("example.com")))
+        self.assertIsNone(self.cache.get_response(query("other.example.com")))
+
+    def test_nxdomain_cut_is_dropped_with_its_entry(self):
+        soa = soa_record("example.com", 300, 300)
+        self.cache.put_response(self.negative_response("nope.example.com", RecordType.A, ResponseCode.NXDOMAIN, soa))
+        self.cache.delete("nope.example.com", RecordType.A, RecordClass.IN)
+        self.assertIsNone(self.cache.get_response(query("a.nope.example.com")))
+
+    def test_negative_response_without_soa_is_not_cached(self):
+        response = DNSPacket(
+            DNSHeader(id=1, response_code=ResponseCode.NXDOMAIN, question_count=1),
+            [Question("nope.example.com", RecordType.A, RecordClass.IN)],
+        )
+        self.cache.put_response(response)
+        self.assertEqual(len(self.cache), 0)
+
+
+class TestInfraCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = InfraCache(max_entries=3)
+        patch = mock.patch("optimus.dns.cache.random.random", return_value=1.0)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_rtt_is_smoothed(self):
+        self.assertEqual(self.cache.get_timeout("10.0.0.1"), UNKNOWN_SERVER_TIMEOUT)
+        self.cache.record_rtt("10.0.0.1", 0.1)
+        self.assertAlmostEqual(self.cache.get_rtt("10.0.0.1"), 0.1)
+        # Timeout is SRTT + 4 * RTTVAR
+        self.assertAlmostEqual(self.cache.get_timeout("10.0.0.1"), 0.3)
+        self.cache.record_rtt("10.0.0.1", 0.5)
+        self.assertAlmostEqual(self.cache.get_rtt("10.0.0.1"), 0.15)
+        self.assertAlmostEqual(self.cache.get_timeout("10.0.0.1"), 0.15 + 4 * (0.0375 + 0.1))
+
+    def test_fastest_server_is_selected(self):
+        self.cache.record_rtt("10.0.0.1", 0.2)
+        self.cache.record_rtt("10.0.0.2", 0.02)
+        self.assertEqual(self.cache.select(["10.0.0.1", "10.0.0.2"]), "10.0.0.2")
+        # Servers never queried are assumed slower than fast known ones, but faster than slow ones
+        self.assertEqual(self.cache.select(["10.0.0.1", "10.0.0.3", "10.0.0.2"]), "10.0.0.2")
+        self.cache.record_rtt("10.0.0.1", 2.0)
+        self.assertEqual(self.cache.select(["10.0.0.1", "10.0.0.3"]), "10.0.0.3")
+
+    def test_other_servers_get_explored(self):
+        self.cache.record_rtt("10.0.0.1", 0.2)
+        self.cache.record_rtt("10.0.0.2", 0.02)
+        with mock.patch("optimus.dns.cache.random.random", return_value=0.0):
+            with mock.patch("optimus.dns.cache.random.choice", side_effect=lambda servers: servers[0]):
+                self.assertEqual(self.cache.select(["10.0.0.1", "10.0.0.2"]), "10.0.0.1")
+
+    def test_unresponsive_server_is_held_down(self):
+        now = 1000.0
+        self.cache.record_rtt("10.0.0.2", 0.5)
+        with mock.patch("optimus.dns.cache.time.monotonic", return_value=now):
+            self.cache.record_rtt("10.0.0.1", 0.01)
+            timeouts = []
+            for _ in range(MAX_CONSECUTIVE_FAILURES):
+                self.cache.record_timeout("10.0.0.1")
+                timeouts.append(self.cache.get_timeout("10.0.0.1"))
+            # Timeout backs off on every consecutive failure
+            self.assertEqual(timeouts, sorted(timeouts))
+            self.assertTrue(self.cache.is_held_down("10.0.0.1"))
+            self.assertEqual(self.cache.select(["10.0.0.1", "10.0.0.2"]), "10.0.0.2")
+            # Held down servers are still used when there is no other choice
+            self.assertEqual(self.cache.select(["10.0.0.1"]), "10.0.0.1")
+        with mock.patch("optimus.dns.cache.time.monotonic", return_value=now + HOLD_DOWN_SECONDS + 1):
+            self.assertFalse(self.cache.is_held_down("10.0.0.1"))
+            self.cache.record_rtt("10.0.0.1", 0.01)
+            self.assertLess(self.cache.get_timeout("10.0.0.1"), timeouts[0])
+
+    def test_least_recently_updated_servers_are_evicted(self):
+        for i in range(4):
+            self.cache.record_rtt(f"10.0.0.{i}", 0.1)
+        self.assertEqual(len(self.cache), 3)
+        self.assertEqual(self.cache.get_rtt("10.0.0.0"), 0.376)
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = ResponseCache()
+
+    def response_bin(self, name: str, ttl: int):
+        packet = DNSPacket(
+            DNSHeader(id=1, question_count=1, answer_count=1, is_recursion_available=True),
+            [Question(name, RecordType.A, RecordClass.IN)],
+            answers=[a_record(name, ttl)],
+        )
+        return packet.to_bin_with_ttl_offsets()
+
+    def test_question_key(self):
+        key = get_question_key(bytes(query("Google.COM").to_bin()))
+        self.assertEqual(key, b"\x06google\x03com\x00\x00\x01\x00\x01")
+        self.assertIsNone(get_question_key(bytes(self.response_bin("google.com", 60)[0])))
+        self.assertIsNone(get_question_key(b"\x00\x01"))
+
+    def test_hit_patches_id_question_and_ttls(self):
+        now = 1000.0
+        response, ttl_offsets = self.response_bin("google.com", 300)
+        self.assertEqual(struct.unpack_from(">I", response, ttl_offsets[0])[0], 300)
+        with mock.patch("optimus.dns.cache.time.monotonic", return_value=now):
+            self.cache.put(bytes(query("google.com").to_bin()), response, ttl_offsets)
+        client_query = query("GOOGLE.com", id=0xBEEF)
+        with mock.patch("optimus.dns.cache.time.monotonic", return_value=now + 10):
+            cached = self.cache.get(bytes(client_query.to_bin()))
+        self.assertEqual(cached[0:2], b"\xbe\xef")
+        self.assertEqual(cached[13:19], b"GOOGLE")
+        self.assertEqual(struct.unpack_from(">I", cached, ttl_offsets[0])[0], 290)
+        with mock.patch("optimus.dns.cache.time.monotonic", return_value=now + 300):
+            self.assertIsNone(self.cache.get(bytes(client_query.to_bin())))
+
+    def test_responses_are_keyed_by_recursion_desired(self):
+        response, ttl_offsets = self.response_bin("google.com", 300)
+        self.cache.put(bytes(query("google.com").to_bin()), response, ttl_offsets)
+        self.assertIsNone(self.cache.get(query_bin("google.com", recursion_desired=False)))
+        self.assertIsNotNone(self.cache.get(bytes(query("google.com").to_bin())))
+
+    def test_only_answers_and_denials_are_cacheable(self):
+        question = [Question("www.google.com", RecordType.A, RecordClass.IN)]
+        answer = DNSPacket(DNSHeader(id=1), question, answers=[a_record("www.google.com", 60)])
+        nxdomain = DNSHeader(id=1, response_code=ResponseCode.NXDOMAIN)
+        denial = DNSPacket(nxdomain, question, nameserver_records=[soa_record("com", 60, 60)])
+        referral = DNSPacket(
+            DNSHeader(id=1),
+            question,
+            nameserver_records=[NS("com", RecordType.NS, RecordClass.IN, 3600, 0, "a.gtld-servers.net")],
+        )
+        self.assertTrue(is_cacheable_response(answer))
+        self.assertTrue(is_cacheable_response(denial))
+        self.assertFalse(is_cacheable_response(referral))
+        self.assertFalse(is_cacheable_response(DNSPacket(nxdomain, question)))
+
+    def test_errors_are_not_cached(self):
+        packet = DNSPacket(
+            DNSHeader(id=1, question_count=1, response_code=ResponseCode.SERVFAIL),
+            [Question("google.com", RecordType.A, RecordClass.IN)],
+        )
+        response, ttl_offsets = packet.to_bin_with_ttl_offsets()
+        self.cache.put(bytes(query("google.com").to_bin()), response, ttl_offsets)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_popular_response_is_prefetched_before_expiry(self):
+        prefetched = []
+        self.cache.set_prefetcher(prefetched.append)
+        self.addCleanup(self.cache.set_prefetcher, None)
+        self.addCleanup(self.cache.configure, prefetch_min_hits=DEFAULT_PREFETCH_MIN_HITS)
+        self.cache.configure(prefetch_min_hits=2)
+        response, ttl_offsets = self.response_bin("google.com", 100)
+        client_query = bytes(query("google.com").to_bin())
+        with mock.patch("optimus.dns.cache.time.monotonic", return_value=1000.0):
+            self.cache.put(client_query, response, ttl_offsets)
+            self.cache.get(client_query)
+        # Popular enough, but not within the last 10% of the TTL yet
+        with mock.patch("optimus.dns.cache.time.monotonic", return_value=1089.0):
+            self.cache.get(client_query)
+        self.assertEqual(prefetched, [])
+        self.cache.clear()
+        with mock.patch("optimus.dns.cache.time.monotonic", return_value=1000.0):
+            self.cache.put(client_query, response, ttl_offsets)
+        with mock.patch("optimus.dns.cache.time.monotonic", return_value=1091.0):
+            # Within the last 10% of the TTL, but not popular enough yet
+            self.assertIsNotNone(self.cache.get(client_query))
+            self.assertEqual(prefetched, [])
+            self.assertIsNotNone(self.cache.get(client_query))
+            self.assertEqual(prefetched, [client_query])
+            # Only prefetched once
+            self.cache.get(client_query)
+        self.assertEqual(prefetched, [client_query])
@@ -0,0 +1,80 @@
+import unittest
+from ipaddress import IPv4Address
+from typing import List
+
+from optimus.dns.edns import edns_config, fit_response, get_udp_payload_size, strip_opt_records
+from optimus.dns.models.packet import DNSHeader, DNSPacket, Question
+from optimus.dns.models.records import A, OptPseudoRR, Record, RecordClass, RecordType
+from optimus.dns.parser.parse import DNSParser
+
+
+def query(payload_size: int = 0) -> bytes:
+    additional: List[Record] = [OptPseudoRR("", RecordType.OPT, payload_size, 0, 0, [])] if payload_size else []
+    packet = DNSPacket(
+        DNSHeader(id=7, is_query=True, question_count=1, additional_records_count=len(additional)),
+        [Question("example.com", RecordType.A, RecordClass.IN)],
+        additional_records=additional,
+    )
+    return bytes(packet.to_bin())
+
+
+def response(answer_count: int) -> bytes:
+    answers: List[Record] = [
+        A("example.com", RecordType.A, RecordClass.IN, 300, 4, IPv4Address(f"10.0.{i // 256}.{i % 256}"))
+        for i in range(answer_count)
+    ]
+    packet = DNSPacket(
+        DNSHeader(id=7, question_count=1, answer_count=len(answers)),
+        [Question("example.com", RecordType.A, RecordClass.IN)],
+        answers,
+    )
+    return bytes(packet.to_bin())
+
+
+class TestEdns(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(edns_config.configure, edns_config.udp_payload_size)
+        edns_config.configure(1232)
+
+    def test_udp_payload_size_of_query(self):
+        self.assertIsNone(get_udp_payload_size(query()))
+        self.assertEqual(get_udp_payload_size(query(4096)), 4096)
+        # Anything below 512 is treated as 512
+        self.assertEqual(get_udp_payload_size(query(100)), 512)
+        self.assertIsNone(get_udp_payload_size(query(4096)[:-5]))
+
+    def test_opt_record_only_added_for_edns_clients(self):
+        plain = DNSParser(bytearray(fit_response(query(), response(1)))).get_dns_packet()
+        self.assertEqual(plain.additional_records, [])
+        edns = DNSParser(bytearray(fit_response(query(4096), response(1)))).get_dns_packet()
+        self.assertEqual(edns.header.additional_records_count, 1)
+        self.assertEqual(edns.additional_records[0].requestor_udp_payload_size, 1232)
+        self.assertEqual(str(edns.answers[0].ipv4_address), "10.0.0.0")
+
+    def test_response_truncated_to_client_payload_size(self):
+        # 40 A records take 29 + 40 * 16 = 669 bytes
+        large_response = response(40)
+        truncated = DNSParser(bytearray(fit_response(query(), large_response))).get_dns_packet()
+        self.assertTrue(truncated.header.is_truncated_message)
+        self.assertEqual(truncated.header.answer_count, 0)
+        self.assertEqual(truncated.questions[0].name, "example.com")
+        self.assertEqual(len(fit_response(query(1232), large_response)), len(large_response) + 11)
+        # Size is capped by what we advertise ourselves
+        self.assertTrue(fit_response(query(4096), response(100))[2] & 0x02)
+        edns_truncated = DNSParser(bytearray(fit_response(query(600), large_response))).get_dns_packet()
+        self.assertTrue(edns_truncated.header.is_truncated_message)
+        self.assertEqual(edns_truncated.additional_records[0].rtype, RecordType.OPT)
+
+    def test_no_truncation_over_tcp(self):
+        self.assertEqual(fit_response(query(), response(100), over_tcp=True), response(100))
+
+    def test_upstream_opt_record_is_stripped(self):
+        packet = DNSParser(bytearray(fit_response(query(1232), response(1)))).get_dns_packet()
+        strip_opt_records(packet)
+        self.assertEqual(packet.header.additional_records_count, 0)
+        self.assertEqual(bytes(packet.to_bin()), response(1))
+
+
+if __name__ == "__main__":
+    unittest.main()
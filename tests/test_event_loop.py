@@ -0,0 +1,51 @@
+import socket
+import threading
+import unittest
+
+from optimus.networking.loop import EventLoop
+
+
+class TestEventLoop(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = EventLoop()
+        self.addCleanup(self.loop.close)
+
+    def test_timers_run_in_order_and_can_be_cancelled(self):
+        calls = []
+        self.loop.call_later(0.02, calls.append, "second")
+        self.loop.call_later(0.01, calls.append, "first")
+        self.loop.call_later(0.01, calls.append, "cancelled").cancel()
+        self.loop.call_later(0.03, self.loop.stop)
+        self.loop.run_forever()
+        self.assertEqual(calls, ["first", "second"])
+
+    def test_reader_and_threadsafe_callbacks(self):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(("127.0.0.1", 0))
+        receiver.setblocking(False)
+        self.addCleanup(receiver.close)
+        received = []
+
+        def on_readable():
+            received.append(receiver.recv(100))
+            self.loop.remove_reader(receiver)
+            self.loop.stop()
+
+        def send():
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sender:
+                sender.sendto(b"ping", receiver.getsockname())
+
+        self.loop.add_reader(receiver, on_readable)
+        # Callbacks queued from other threads wake the loop up and run on it
+        threading.Timer(0.01, self.loop.call_soon_threadsafe, args=(send,)).start()
+        self.loop.run_forever()
+        self.assertEqual(received, [b"ping"])
+
+    def test_failing_callback_does_not_stop_the_loop(self):
+        calls = []
+        self.loop.call_soon(lambda: 1 / 0)
+        self.loop.call_soon(calls.append, "ran")
+        self.loop.call_soon(self.loop.stop)
+        self.loop.run_forever()
+        self.assertEqual(calls, ["ran"])
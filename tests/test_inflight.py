@@ -0,0 +1,66 @@
+import unittest
+
+from optimus.server.inflight import InflightQueries
+from tests.helpers import query_bin
+
+CLIENT = ("127.0.0.1", 5000)
+OTHER_CLIENT = ("127.0.0.2", 5000)
+
+
+def response_bin(query: bytes) -> bytes:
+    response = bytearray(query)
+    response[2] |= 0x80
+    return bytes(response)
+
+
+class TestInflightQueries(unittest.TestCase):
+
+    def setUp(self):
+        self.inflight = InflightQueries()
+
+    def test_identical_queries_share_one_resolution(self):
+        first_query = query_bin("google.com", id=1)
+        second_query = query_bin("GOOGLE.com", id=2)
+        leader = self.inflight.join(first_query, CLIENT)
+        follower = self.inflight.join(second_query, OTHER_CLIENT)
+        assert leader and follower
+        self.assertTrue(leader.is_leader)
+        self.assertFalse(follower.is_leader)
+        self.assertFalse(follower.response.done())
+
+        leader.response.set_result((response_bin(first_query), True))
+        response_bytes, was_success = follower.response.result(timeout=1)
+        self.assertTrue(was_success)
+        # Follower gets its own ID and question casing back
+        self.assertEqual(response_bytes, response_bin(second_query))
+        self.assertEqual(len(self.inflight), 0)
+
+        # Once answered, the next query starts a resolution of its own
+        next_query = self.inflight.join(query_bin("google.com", id=3), CLIENT)
+        assert next_query
+        self.assertTrue(next_query.is_leader)
+
+    def test_followers_fail_along_with_leader(self):
+        leader = self.inflight.join(query_bin("google.com", id=1), CLIENT)
+        follower = self.inflight.join(query_bin("google.com", id=2), CLIENT)
+        assert leader and follower
+        leader.response.set_exception(ValueError("boom"))
+        self.assertRaises(ValueError, follower.response.result, 1)
+
+    def test_different_queries_are_not_coalesced(self):
+        queries = [
+            self.inflight.join(query_bin("google.com", id=1), CLIENT),
+            self.inflight.join(query_bin("example.com", id=2), CLIENT),
+            self.inflight.join(query_bin("google.com", id=3, recursion_desired=False), CLIENT),
+        ]
+        self.assertTrue(all(query and query.is_leader for query in queries))
+
+    def test_retransmission_is_dropped_while_in_flight(self):
+        leader = self.inflight.join(query_bin("google.com", id=1), CLIENT)
+        assert leader
+        self.assertIsNone(self.inflight.join(query_bin("google.com", id=1), CLIENT))
+        # Same ID from another client is a different query altogether
+        self.assertIsNotNone(self.inflight.join(query_bin("google.com", id=1), OTHER_CLIENT))
+
+        leader.response.set_result((response_bin(query_bin("google.com", id=1)), True))
+        self.assertIsNotNone(self.inflight.join(query_bin("google.com", id=1), CLIENT))
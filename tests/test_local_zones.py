@@ -0,0 +1,174 @@
+import os
+import tempfile
+import time
+import unittest
+from ipaddress import IPv4Address
+from unittest import mock
+
+from optimus.dns.cache import DelegationCache, RecordCache, ResponseCache
+from optimus.dns.local_zones import LocalZones
+from optimus.dns.models.packet import DNSHeader, DNSPacket, Question, ResponseCode
+from optimus.dns.models.records import A, RecordClass, RecordType
+from optimus.dns.parser.parse import DNSParser
+from optimus.server.handler import handle_query
+from tests.helpers import query
+
+ZONE = """\
+$TTL 300
+@           SOA     ns1 hostmaster 1 3600 600 86400 60
+            NS      ns1
+ns1         A       10.0.0.53
+www         A       10.0.0.1
+            A       10.0.0.2
+alias       CNAME   www
+a.b.c       A       10.0.0.3
+*.apps      A       10.0.0.4
+sub         NS      ns.sub
+ns.sub      A       10.0.0.54
+"""
+
+
+class TestLocalZones(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "corp.zone")
+        self.write_zone(ZONE)
+        self.zones = LocalZones()
+        self.zones.configure([f"corp.example={self.path}"])
+
+    def write_zone(self, zone: str) -> None:
+        with open(self.path, "w") as f:
+            f.write(zone)
+
+    def test_names_are_answered_authoritatively(self):
+        packet = self.zones.answer(query("WWW.corp.example."))
+        self.assertTrue(packet.header.is_authoritative_answer)
+        self.assertEqual([str(rec.ipv4_address) for rec in packet.answers], ["10.0.0.1", "10.0.0.2"])
+        packet = self.zones.answer(query("alias.corp.example"))
+        self.assertEqual([rec.rtype for rec in packet.answers], [RecordType.CNAME, RecordType.A, RecordType.A])
+        self.assertIsNone(self.zones.answer(query("www.example.com")))
+
+    def test_missing_names_and_data_are_denied(self):
+        for name, rtype, response_code in [
+            ("missing.corp.example", RecordType.A, ResponseCode.NXDOMAIN),
+            ("www.corp.example", RecordType.MX, ResponseCode.NOERROR),
+            # Empty non-terminal
+            ("b.c.corp.example", RecordType.A, ResponseCode.NOERROR),
+        ]:
+            packet = self.zones.answer(query(name, rtype))
+            self.assertEqual(packet.header.response_code, response_code)
+            self.assertEqual(packet.answers, [])
+            self.assertEqual(packet.nameserver_records[0].rtype, RecordType.SOA)
+            self.assertEqual(packet.nameserver_records[0].ttl, 60)
+
+    def test_wildcards_are_expanded(self):
+        packet = self.zones.answer(query("web.apps.corp.example"))
+        self.assertEqual(
+            [(rec.name, str(rec.ipv4_address)) for rec in packet.answers], [("web.apps.corp.example", "10.0.0.4")]
+        )
+        # Wildcards don't apply below names which exist
+        packet = self.zones.answer(query("x.b.c.corp.example"))
+        self.assertEqual(packet.header.response_code, ResponseCode.NXDOMAIN)
+
+    def test_delegated_names_are_referred_without_recursion(self):
+        qpacket = query("www.sub.corp.example", recursion_desired=False)
+        packet = self.zones.answer(qpacket)
+        self.assertFalse(packet.header.is_authoritative_answer)
+        self.assertEqual(packet.answers, [])
+        self.assertEqual([rec.nsdname for rec in packet.nameserver_records], ["ns.sub.corp.example"])
+        self.assertEqual([str(rec.ipv4_address) for rec in packet.additional_records], ["10.0.0.54"])
+
+    def test_reload_swaps_zones_unless_broken(self):
+        self.write_zone(ZONE.replace("10.0.0.1", "10.0.1.1"))
+        self.assertTrue(self.zones.load())
+        self.assertEqual(str(self.zones.answer(query("www.corp.example")).answers[0].ipv4_address), "10.0.1.1")
+        self.write_zone(ZONE + "www CNAME alias\n")
+        self.assertFalse(self.zones.load())
+        self.assertEqual(str(self.zones.answer(query("www.corp.example")).answers[0].ipv4_address), "10.0.1.1")
+
+    def test_delegated_names_are_resolved_through_the_delegation(self):
+        self.assertIsNone(self.zones.answer(query("www.sub.corp.example")))
+        self.assertFalse(self.zones.covers(bytes(query("www.sub.corp.example").to_bin())))
+        queried = []
+
+        def query_server(payload, server_addr, alternates=(), deadline=None):
+            queried.append(server_addr)
+            qpacket = DNSParser(bytearray(payload)).get_dns_packet()
+            answer = A(qpacket.questions[0].name, RecordType.A, RecordClass.IN, 300, 4, IPv4Address("10.0.2.1"))
+            return bytes(
+                DNSPacket(
+                    DNSHeader(id=qpacket.header.ID, question_count=1, answer_count=1), qpacket.questions, [answer]
+                ).to_bin()
+            )
+
+        patches = [
+            mock.patch("optimus.server.handler.local_zones", self.zones),
+            mock.patch("optimus.server.handler.record_cache", RecordCache()),
+            mock.patch("optimus.server.handler.response_cache", ResponseCache()),
+            mock.patch("optimus.dns.resolver.local_zones", self.zones),
+            mock.patch("optimus.dns.resolver.delegation_cache", DelegationCache()),
+            mock.patch("optimus.dns.resolver.query_server", query_server),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        response_bytes, success = handle_query(bytes(query("www.sub.corp.example").to_bin()))
+        self.assertTrue(success)
+        self.assertEqual(queried, ["10.0.0.54"])
+        packet = DNSParser(bytearray(response_bytes)).get_dns_packet()
+        self.assertFalse(packet.header.is_authoritative_answer)
+        self.assertEqual(str(packet.answers[0].ipv4_address), "10.0.2.1")
+
+    def test_changed_zone_files_are_reloaded(self):
+        zones = LocalZones()
+        zones.configure([f"corp.example={self.path}"], reload_interval=0.01)
+        zones.start()
+        self.addCleanup(zones.stop)
+        self.write_zone(ZONE.replace("10.0.0.1", "10.0.1.1"))
+        # Modification times may not be fine grained enough to tell both versions apart
+        os.utime(self.path, (time.time() + 10, time.time() + 10))
+        deadline = time.monotonic() + 2
+        while str(zones.answer(query("www.corp.example")).answers[0].ipv4_address) != "10.0.1.1":
+            if time.monotonic() > deadline:
+                self.fail("Zone file wasn't reloaded")
+            time.sleep(0.01)
+
+    def test_local_names_are_never_resolved(self):
+        with (
+            mock.patch("optimus.server.handler.local_zones", self.zones),
+            mock.patch("optimus.server.handler.resolve") as resolve,
+        ):
+            response_bytes, success = handle_query(bytes(query("www.corp.example").to_bin()))
+        resolve.assert_not_called()
+        self.assertTrue(success)
+        packet = DNSParser(bytearray(response_bytes)).get_dns_packet()
+        self.assertEqual(str(packet.answers[0].ipv4_address), "10.0.0.1")
+
+    def test_local_names_are_never_answered_from_response_cache(self):
+        query_bytes = bytes(query("www.corp.example").to_bin())
+        # Resolved before the zone was loaded, e.g restored from a cache snapshot
+        resolved = DNSPacket(
+            DNSHeader(id=7, question_count=1, answer_count=1, is_recursion_desired=True),
+            [Question("www.corp.example", RecordType.A, RecordClass.IN)],
+            [A("www.corp.example", RecordType.A, RecordClass.IN, 300, 4, IPv4Address("192.0.2.1"))],
+        )
+        response_cache = ResponseCache()
+        response_cache.put(query_bytes, *resolved.to_bin_with_ttl_offsets())
+        self.assertTrue(self.zones.covers(query_bytes))
+        self.assertFalse(self.zones.covers(bytes(query("www.example.com").to_bin())))
+        with (
+            mock.patch("optimus.server.handler.local_zones", self.zones),
+            mock.patch("optimus.server.handler.response_cache", response_cache),
+        ):
+            for address in ["10.0.0.1", "10.0.1.1"]:
+                self.write_zone(ZONE.replace("10.0.0.1", address))
+                self.assertTrue(self.zones.load())
+                response_bytes, _ = handle_query(query_bytes)
+                packet = DNSParser(bytearray(response_bytes)).get_dns_packet()
+                self.assertEqual(str(packet.answers[0].ipv4_address), address)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,36 @@
+import copy
+import unittest
+from ipaddress import IPv4Address
+
+from optimus.dns.models.packet import DNSHeader, DNSPacket, Question, ResponseCode
+from optimus.dns.models.records import SOA, A, RecordClass, RecordType
+
+
+class TestModels(unittest.TestCase):
+
+    def test_enum_lookups_by_value(self):
+        self.assertEqual(RecordType.from_value(28), RecordType.AAAA)
+        self.assertEqual(RecordType.from_value(4242), RecordType.UNKNOWN)
+        self.assertEqual(RecordClass.from_value(1), RecordClass.IN)
+        self.assertEqual(RecordClass.from_value(3), RecordClass.UNKNOWN)
+        self.assertEqual(ResponseCode.from_value(3), ResponseCode.NXDOMAIN)
+        self.assertEqual(ResponseCode.from_value(15), ResponseCode.UNKNOWN)
+
+    def test_models_are_slotted(self):
+        record = A("google.com", RecordType.A, RecordClass.IN, 300, 4, IPv4Address("1.2.3.4"))
+        soa = SOA(
+            "google.com", RecordType.SOA, RecordClass.IN, 60, 0, "ns1.google.com", "dns.google.com", 1, 2, 3, 4, 5
+        )
+        header = DNSHeader(id=1, question_count=1)
+        question = Question("google.com", RecordType.A, RecordClass.IN)
+        packet = DNSPacket(header, [question], [record])
+        for model in (record, soa, header, question, packet):
+            self.assertFalse(hasattr(model, "__dict__"), type(model).__name__)
+        self.assertRaises(AttributeError, setattr, record, "not_a_field", 1)
+
+    def test_slotted_records_can_be_copied(self):
+        record = A("google.com", RecordType.A, RecordClass.IN, 300, 4, IPv4Address("1.2.3.4"))
+        record_copy = copy.copy(record)
+        record_copy.ttl = 10
+        self.assertEqual(record.ttl, 300)
+        self.assertEqual(record_copy.ipv4_address, record.ipv4_address)
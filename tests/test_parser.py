@@ -1,9 +1,11 @@
 import binascii
+import struct
 import unittest
 from collections import namedtuple
+from ipaddress import IPv4Address
 
-from optimus.dns.models.packet import DNSPacket
-from optimus.dns.models.records import RecordClass, RecordType
+from optimus.dns.models.packet import DNSHeader, DNSPacket, Question, Section
+from optimus.dns.models.records import CNAME, NS, A, EdnsOption, RecordClass, RecordType
 from optimus.dns.parser.parse import DNSParser
 
 
@@ -141,4 +143,107 @@ class TestDnsParser(unittest.TestCase):
                 self.assertIsNotNone(answer.retry)
                 self.assertIsNotNone(answer.expire)
                 self.assertIsNotNone(answer.minimum)
-            # TODO: serialize the response_packet again and match with response_packet_hex
+            # Names get compressed the same way upstream did
+            self.assertEqual(response_packet.to_bin().hex(), response_packet_hex)
+
+    def test_compression_pointer_uses_all_14_bits(self):
+        # First answer's data holds a name at offset 0x012C, past what a single byte could address
+        name = bytes.fromhex("06676f6f676c6503636f6d00")
+        padding = bytes(0x012C - 12 - 11)
+        response = bytearray.fromhex("abcd81800000000200000000")
+        response.extend(bytes.fromhex("0000100001000000800000") + padding + name)
+        response[12 + 9 : 12 + 11] = (len(padding) + len(name)).to_bytes(2, "big")
+        response.extend(bytes.fromhex("c12c000100010000012c00048efab74e"))
+        packet = DNSParser(response).get_dns_packet()
+        self.assertEqual(packet.answers[1].name, "google.com")
+        self.assertEqual(str(packet.answers[1].ipv4_address), "142.250.183.78")
+
+    def test_compression_pointer_loop_is_rejected(self):
+        # Name at offset 12 points to itself
+        response = bytearray.fromhex("abcd81800001000000000000c00c00010001")
+        self.assertRaises(Exception, DNSParser(response).get_dns_packet)
+
+    def test_unknown_record_data_is_skipped_and_kept(self):
+        # TXT answer followed by an OPT record carrying an option, and an A record in the additional section
+        response = bytearray.fromhex(
+            "d38d8180000100010000000206676f6f676c6503636f6d0000100001"
+            "c00c00100001000000800006057370663d31"
+            "00002904d0000000000008000a000401020304"
+            "c00c000100010000008000048efab74e"
+        )
+        packet = DNSParser(response).get_dns_packet()
+        self.assertEqual(packet.answers[0].rtype, RecordType.TXT)
+        self.assertEqual(packet.answers[0].rdata, b"\x05spf=1")
+        self.assertTrue(packet.answers[0].to_bin().endswith(response[34:46]))
+        self.assertEqual(packet.additional_records[0].rtype, RecordType.OPT)
+        self.assertEqual(str(packet.additional_records[1].ipv4_address), "142.250.183.78")
+
+    def test_edns_options_are_parsed_and_written_back(self):
+        # Query carrying an OPT record with a DO bit, a cookie option and an empty padding option
+        query = bytearray.fromhex(
+            "d38d0100000100000000000106676f6f676c6503636f6d0000010001"
+            "00002904d000008000000c000a00040102030400000000"
+        )
+        packet = DNSParser(query).get_dns_packet()
+        opt = packet.additional_records[0]
+        self.assertEqual(packet.header.additional_records_count, 1)
+        self.assertEqual(opt.requestor_udp_payload_size, 1232)
+        self.assertEqual((opt.extended_rcode, opt.version, opt.dnssec_ok), (0, 0, True))
+        self.assertEqual(opt.options, [EdnsOption(10, b"\x01\x02\x03\x04"), EdnsOption(0, b"")])
+        self.assertEqual(packet.to_bin(), query)
+
+    def test_truncated_edns_option_is_rejected(self):
+        query = bytearray.fromhex(
+            "d38d0100000100000000000106676f6f676c6503636f6d000001000100002904d0000000000006000a00040102"
+        )
+        packet = DNSParser(query).get_dns_packet()
+        self.assertRaises(Exception, lambda: packet.additional_records)
+
+    def test_sections_are_parsed_on_access(self):
+        # Answer section holds an A record whose data runs past the end of the message
+        response = bytearray.fromhex(
+            "d38d8180000100010000000006676f6f676c6503636f6d0000010001"
+            "c00c000100010000008000ff8e"
+        )
+        packet = DNSParser(response).get_dns_packet()
+        self.assertEqual(packet.questions[0].name, "google.com")
+        self.assertEqual(packet.header.answer_count, 1)
+        self.assertRaises(Exception, lambda: packet.answers)
+
+    def test_records_of_a_type_are_picked_out_of_a_section(self):
+        response = bytearray.fromhex(
+            "d38d8180000100000001000206676f6f676c6503636f6d0000010001"
+            "c0130002000100000080000603"
+            "6e7331c013"
+            "c028001c00010000008000102001486048020034000000000000000a"
+            "c028000100010000008000048efab74e"
+        )
+        packet = DNSParser(response).get_dns_packet()
+        glue = packet.get_records(Section.ADDITIONAL, RecordType.A)
+        self.assertEqual([str(rec.ipv4_address) for rec in glue], ["142.250.183.78"])
+        self.assertEqual(packet.get_records(Section.AUTHORITY, RecordType.NS)[0].nsdname, "ns1.com")
+        self.assertEqual([rec.rtype for rec in packet.additional_records], [RecordType.AAAA, RecordType.A])
+
+    def test_serialized_names_are_compressed(self):
+        packet = DNSPacket(
+            DNSHeader(id=1, question_count=1, answer_count=2, nameserver_records_count=1),
+            [Question("www.Example.com", RecordType.CNAME, RecordClass.IN)],
+            [
+                CNAME("www.example.com", RecordType.CNAME, RecordClass.IN, 300, 0, "web.example.com"),
+                A("web.example.com", RecordType.A, RecordClass.IN, 300, 0, IPv4Address("1.2.3.4")),
+            ],
+            [NS("example.com", RecordType.NS, RecordClass.IN, 300, 0, "ns1.example.com")],
+        )
+        response_bin, ttl_offsets = packet.to_bin_with_ttl_offsets()
+        uncompressed_length = 12 + len(packet.questions[0].to_bin()) + sum(
+            len(rec.to_bin()) for rec in packet.answers + packet.nameserver_records
+        )
+        self.assertLess(len(response_bin), uncompressed_length)
+        # Answer owner name points to the question, and the CNAME target reuses its "example.com" suffix
+        self.assertEqual(response_bin[33:35], b"\xc0\x0c")
+        parsed = DNSParser(response_bin).get_dns_packet()
+        # Compression is case insensitive, so suffixes take the casing of their first occurrence
+        self.assertEqual(parsed.answers[0].cname, "web.Example.com")
+        self.assertEqual(parsed.answers[1].name, "web.Example.com")
+        self.assertEqual(parsed.nameserver_records[0].nsdname, "ns1.Example.com")
+        self.assertEqual([struct.unpack_from(">I", response_bin, offset)[0] for offset in ttl_offsets], [300] * 3)
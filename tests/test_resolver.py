@@ -0,0 +1,278 @@
+import asyncio
+import unittest
+from ipaddress import IPv4Address
+import time
+from typing import Callable, Dict, List, Optional, Sequence
+from unittest import mock
+
+from optimus.dns.cache import delegation_cache, infra_cache
+from optimus.dns.forwarding import ForwardingRules
+from optimus.dns.models.packet import DNSHeader, DNSPacket, ResponseCode, Section
+from optimus.dns.models.records import NS, A, Record, RecordClass, RecordType
+from optimus.dns.parser.parse import DNSParser
+from optimus.dns.resolver import MAX_ATTEMPTS_PER_ZONE, resolve, resolve_async
+from tests.helpers import query
+
+ROOT_SERVER = "198.41.0.4"
+
+
+def a_record(name: str, address: str, ttl: int = 300) -> A:
+    return A(name, RecordType.A, RecordClass.IN, ttl, 4, IPv4Address(address))
+
+
+def ns_record(zone: str, nsdname: str, ttl: int = 3600) -> NS:
+    return NS(zone, RecordType.NS, RecordClass.IN, ttl, 0, nsdname)
+
+
+def response(
+    qpacket: DNSPacket,
+    answers: List[Record] = [],
+    authority: List[Record] = [],
+    additional: List[Record] = [],
+    rcode: ResponseCode = ResponseCode.NOERROR,
+) -> bytes:
+    return bytes(
+        DNSPacket(
+            DNSHeader(
+                id=qpacket.header.ID,
+                response_code=rcode,
+                question_count=len(qpacket.questions),
+                answer_count=len(answers),
+                nameserver_records_count=len(authority),
+                additional_records_count=len(additional),
+            ),
+            qpacket.questions,
+            answers,
+            authority,
+            additional,
+        ).to_bin()
+    )
+
+
+class FakeUpstream:
+    """Maps server addresses to handlers building responses, recording every server that was queried"""
+
+    def __init__(self, handlers: Dict[str, Callable[[DNSPacket], bytes]]) -> None:
+        self.handlers = handlers
+        self.queried: List[str] = []
+
+    def __call__(
+        self, payload: bytearray, server_addr: str, alternates: Sequence[str] = (), deadline: Optional[float] = None
+    ) -> bytes:
+        self.queried.append(server_addr)
+        handler = self.handlers.get(server_addr)
+        if not handler:
+            return bytes()
+        return handler(DNSParser(bytearray(payload)).get_dns_packet())
+
+    async def query_async(
+        self, payload: bytearray, server_addr: str, alternates: Sequence[str] = (), deadline: Optional[float] = None
+    ) -> bytes:
+        return self(payload, server_addr)
+
+
+class TestResolver(unittest.TestCase):
+
+    def setUp(self):
+        delegation_cache.clear()
+        infra_cache.clear()
+        self.upstream = FakeUpstream(
+            {
+                # Refers every name to its TLD, all of them served by the same servers
+                ROOT_SERVER: lambda q: response(
+                    q,
+                    authority=[ns_record(q.questions[0].name.rsplit(".", 1)[-1], "a.gtld-servers.net")],
+                    additional=[a_record("a.gtld-servers.net", "192.5.6.30")],
+                ),
+                "192.5.6.30": lambda q: response(
+                    q,
+                    authority=[ns_record("example.com", "ns1.example.com")],
+                    additional=[a_record("ns1.example.com", "10.0.0.53")],
+                ),
+                "10.0.0.53": lambda q: response(q, answers=[a_record(q.questions[0].name, "10.0.0.1")]),
+            }
+        )
+        patches = [
+            mock.patch("optimus.dns.resolver.query_server", self.upstream),
+            mock.patch("optimus.dns.resolver.query_server_async", self.upstream.query_async),
+            mock.patch("optimus.dns.resolver.get_root_servers", return_value=[ROOT_SERVER]),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_resolve_walks_referrals(self):
+        packet = resolve(query("www.example.com"))
+        self.assertEqual(packet.header.response_code, ResponseCode.NOERROR)
+        self.assertEqual(str(packet.answers[0].ipv4_address), "10.0.0.1")
+        self.assertEqual(self.upstream.queried, [ROOT_SERVER, "192.5.6.30", "10.0.0.53"])
+
+    def test_resolve_async_walks_referrals(self):
+        packet = asyncio.run(resolve_async(query("www.example.com")))
+        self.assertEqual(str(packet.answers[0].ipv4_address), "10.0.0.1")
+        self.assertEqual(self.upstream.queried, [ROOT_SERVER, "192.5.6.30", "10.0.0.53"])
+
+    def test_resolve_starts_at_closest_cached_delegation(self):
+        resolve(query("www.example.com"))
+        self.upstream.queried.clear()
+        resolve(query("mail.example.com"))
+        self.assertEqual(self.upstream.queried, ["10.0.0.53"])
+        self.assertEqual(delegation_cache.get_closest("other.com").zone, "com")
+
+    def test_upstream_queries_advertise_edns(self):
+        payload_sizes: List[int] = []
+        handler = self.upstream.handlers["10.0.0.53"]
+
+        def record_payload_size(q):
+            payload_sizes.append(q.additional_records[0].requestor_udp_payload_size)
+            return handler(q)
+
+        self.upstream.handlers["10.0.0.53"] = record_payload_size
+        resolve(query("www.example.com"))
+        self.assertEqual(payload_sizes, [1232])
+
+    def test_resolve_falls_back_to_plain_dns(self):
+        self.upstream.handlers["10.0.0.53"] = lambda q: (
+            response(q, rcode=ResponseCode.FORMERR)
+            if q.get_records(Section.ADDITIONAL, RecordType.OPT)
+            else response(q, answers=[a_record(q.questions[0].name, "10.0.0.1")])
+        )
+        packet = resolve(query("www.example.com"))
+        self.assertEqual(str(packet.answers[0].ipv4_address), "10.0.0.1")
+        self.assertEqual(self.upstream.queried, [ROOT_SERVER, "192.5.6.30", "10.0.0.53", "10.0.0.53"])
+
+    def test_resolve_fails_over_to_another_server(self):
+        self.upstream.handlers["192.5.6.30"] = lambda q: response(
+            q,
+            authority=[ns_record("example.com", "ns1.example.com"), ns_record("example.com", "ns2.example.com")],
+            additional=[a_record("ns1.example.com", "10.0.0.53"), a_record("ns2.example.com", "10.0.0.54")],
+        )
+        # Dead server is the fastest one we know of
+        infra_cache.record_rtt("10.0.0.54", 0.001)
+        with mock.patch("optimus.dns.cache.random.random", return_value=1.0):
+            packet = resolve(query("www.example.com"))
+        self.assertEqual(str(packet.answers[0].ipv4_address), "10.0.0.1")
+        self.assertEqual(self.upstream.queried, [ROOT_SERVER, "192.5.6.30", "10.0.0.54", "10.0.0.53"])
+
+    def test_resolve_fails_over_on_error_responses(self):
+        self.upstream.handlers["192.5.6.30"] = lambda q: response(
+            q,
+            authority=[ns_record("example.com", "ns1.example.com"), ns_record("example.com", "ns2.example.com")],
+            additional=[a_record("ns1.example.com", "10.0.0.53"), a_record("ns2.example.com", "10.0.0.54")],
+        )
+        self.upstream.handlers["10.0.0.54"] = lambda q: response(q, rcode=ResponseCode.REFUSED)
+        infra_cache.record_rtt("10.0.0.54", 0.001)
+        with mock.patch("optimus.dns.cache.random.random", return_value=1.0):
+            packet = resolve(query("www.example.com"))
+        self.assertEqual(str(packet.answers[0].ipv4_address), "10.0.0.1")
+        self.assertEqual(self.upstream.queried[2:], ["10.0.0.54", "10.0.0.53"])
+        # Once every server of the zone failed, the last error they responded with is returned
+        self.upstream.handlers["10.0.0.53"] = lambda q: response(q, rcode=ResponseCode.SERVFAIL)
+        self.upstream.queried.clear()
+        with mock.patch("optimus.dns.cache.random.random", return_value=1.0):
+            packet = resolve(query("mail.example.com"))
+        self.assertEqual(packet.header.response_code, ResponseCode.SERVFAIL)
+        self.assertEqual(sorted(self.upstream.queried), ["10.0.0.53", "10.0.0.54"])
+
+    def test_resolve_fails_over_on_malformed_responses(self):
+        self.upstream.handlers["192.5.6.30"] = lambda q: response(
+            q,
+            authority=[ns_record("example.com", "ns1.example.com"), ns_record("example.com", "ns2.example.com")],
+            additional=[a_record("ns1.example.com", "10.0.0.53"), a_record("ns2.example.com", "10.0.0.54")],
+        )
+
+        def truncated(q):
+            # Header and question are fine, the answer is cut short
+            return response(q, answers=[a_record(q.questions[0].name, "1.1.1.1")])[:-2]
+
+        self.upstream.handlers["10.0.0.54"] = truncated
+        infra_cache.record_rtt("10.0.0.54", 0.001)
+        with mock.patch("optimus.dns.cache.random.random", return_value=1.0):
+            packet = resolve(query("www.example.com"))
+        self.assertEqual(str(packet.answers[0].ipv4_address), "10.0.0.1")
+        self.assertEqual(self.upstream.queried[2:], ["10.0.0.54", "10.0.0.53"])
+
+    def test_resolve_fails_with_servfail(self):
+        del self.upstream.handlers["10.0.0.53"]
+        packet = resolve(query("www.example.com"))
+        self.assertEqual(packet.header.response_code, ResponseCode.SERVFAIL)
+        self.assertEqual(packet.header.ID, 7)
+        self.assertEqual(self.upstream.queried.count("10.0.0.53"), MAX_ATTEMPTS_PER_ZONE)
+
+    def test_resolve_retries_lone_server(self):
+        handler = self.upstream.handlers["10.0.0.53"]
+        attempts: List[int] = []
+
+        def drop_first_query(q):
+            attempts.append(1)
+            return handler(q) if len(attempts) > 1 else bytes()
+
+        self.upstream.handlers["10.0.0.53"] = drop_first_query
+        packet = resolve(query("www.example.com"))
+        self.assertEqual(str(packet.answers[0].ipv4_address), "10.0.0.1")
+        self.assertEqual(self.upstream.queried, [ROOT_SERVER, "192.5.6.30", "10.0.0.53", "10.0.0.53"])
+
+    def test_resolve_gives_up_past_deadline(self):
+        packet = resolve(query("www.example.com"), deadline=time.monotonic() - 1)
+        self.assertEqual(packet.header.response_code, ResponseCode.SERVFAIL)
+        self.assertEqual(self.upstream.queried, [])
+        packet = asyncio.run(resolve_async(query("www.example.com"), deadline=time.monotonic() - 1))
+        self.assertEqual(packet.header.response_code, ResponseCode.SERVFAIL)
+        self.assertEqual(self.upstream.queried, [])
+
+    def test_resolve_stops_on_upward_referral(self):
+        self.upstream.handlers["10.0.0.53"] = lambda q: response(
+            q,
+            authority=[ns_record("com", "a.gtld-servers.net")],
+            additional=[a_record("a.gtld-servers.net", "1.1.1.1")],
+        )
+        packet = resolve(query("www.example.com"))
+        self.assertEqual(packet.answers, [])
+        self.assertEqual(len(self.upstream.queried), 3)
+        self.assertEqual(delegation_cache.get("com").get_server_addresses(), ["192.5.6.30"])
+
+    def test_resolve_stops_on_referral_to_unrelated_zone(self):
+        self.upstream.handlers["192.5.6.30"] = lambda q: response(
+            q,
+            authority=[ns_record("other.com", "ns1.other.com")],
+            additional=[a_record("ns1.other.com", "10.0.0.66")],
+        )
+        packet = resolve(query("www.example.com"))
+        self.assertEqual(packet.answers, [])
+        self.assertEqual(self.upstream.queried, [ROOT_SERVER, "192.5.6.30"])
+        self.assertIsNone(delegation_cache.get("other.com"))
+
+    def test_resolve_glueless_delegation(self):
+        self.upstream.handlers["192.5.6.30"] = lambda q: (
+            response(q, authority=[ns_record("example.com", "ns.example.net")])
+            if q.questions[0].name.endswith("example.com")
+            else response(q, answers=[a_record("ns.example.net", "10.0.0.53")])
+        )
+        packet = resolve(query("www.example.com"))
+        self.assertEqual(str(packet.answers[0].ipv4_address), "10.0.0.1")
+        self.assertEqual(delegation_cache.get("example.com").addresses, {"ns.example.net": ["10.0.0.53"]})
+
+    def test_forwarded_queries_skip_iteration(self):
+        rules = ForwardingRules()
+        rules.configure(["corp.example=10.1.0.1,10.1.0.2:5353", "10.2.0.1"])
+        self.assertEqual(rules.get_forwarders("www.Corp.Example."), ["10.1.0.1", "10.1.0.2:5353"])
+        self.assertEqual(rules.get_forwarders("example.com"), ["10.2.0.1"])
+        rules.configure(["corp.example=10.1.0.1,10.1.0.2:5353"])
+        self.assertIsNone(rules.get_forwarders("example.com"))
+        self.upstream.handlers["10.1.0.1"] = lambda q: response(q, rcode=ResponseCode.SERVFAIL)
+        self.upstream.handlers["10.1.0.2:5353"] = lambda q: response(
+            q, answers=[a_record("www.corp.example", "10.1.1.1")]
+        )
+        with (
+            mock.patch("optimus.dns.resolver.forwarding_rules", rules),
+            mock.patch("optimus.dns.cache.random.random", return_value=1.0),
+        ):
+            infra_cache.record_rtt("10.1.0.1", 0.001)
+            packet = resolve(query("www.corp.example"))
+            self.assertEqual(str(packet.answers[0].ipv4_address), "10.1.1.1")
+            # Fails over from the fastest resolver, which couldn't answer
+            self.assertEqual(self.upstream.queried, ["10.1.0.1", "10.1.0.2:5353"])
+            resolve(query("www.example.com"))
+        self.assertEqual(self.upstream.queried[2:], [ROOT_SERVER, "192.5.6.30", "10.0.0.53"])
+        with self.assertRaises(ValueError):
+            rules.configure(["corp.example="])
@@ -0,0 +1,86 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from optimus.dns.cache import delegation_cache, infra_cache
+from optimus.dns.models.packet import ResponseCode
+from optimus.dns.models.records import RecordType
+from optimus.dns.resolver import resolve
+from optimus.dns.root_zone import LocalRootZone
+from tests.helpers import query
+
+ROOT_ZONE = """\
+.                   86400   IN  SOA     a.root-servers.net. nstld.verisign-grs.com. 2024010100 1800 900 604800 86400
+.                   518400  IN  NS      a.root-servers.net.
+com.                172800  IN  NS      a.gtld-servers.net.
+com.                172800  IN  NS      b.gtld-servers.net.
+com.                86400   IN  DS      19718 13 2 8ACBB0CD28F41250A80A491389424D341522D946B0DA0C0291F2D3D771D7805A
+a.gtld-servers.net. 172800  IN  A       192.5.6.30
+a.gtld-servers.net. 172800  IN  AAAA    2001:503:a83e::2:30
+a.root-servers.net. 518400  IN  A       198.41.0.4
+"""
+
+
+class TestLocalRootZone(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "root.zone")
+        with open(self.path, "w") as f:
+            f.write(ROOT_ZONE)
+        self.root_zone = LocalRootZone()
+        self.root_zone.configure(self.path)
+
+    def test_referrals_to_tlds_are_synthesized(self):
+        delegation = self.root_zone.get_delegation("www.Example.COM.")
+        self.assertEqual(delegation.zone, "com")
+        self.assertEqual(delegation.nameservers, ["a.gtld-servers.net", "b.gtld-servers.net"])
+        self.assertEqual(delegation.get_server_addresses(), ["192.5.6.30"])
+        self.assertIsNone(self.root_zone.get_delegation("example.invalid"))
+        self.assertIsNone(self.root_zone.answer(query("example.com")))
+
+    def test_root_and_unknown_tlds_are_answered(self):
+        ns_response = self.root_zone.answer(query("", RecordType.NS))
+        self.assertEqual(ns_response.header.response_code, ResponseCode.NOERROR)
+        self.assertEqual([rec.nsdname for rec in ns_response.answers], ["a.root-servers.net"])
+        nxdomain = self.root_zone.answer(query("example.invalid"))
+        self.assertEqual(nxdomain.header.response_code, ResponseCode.NXDOMAIN)
+        self.assertEqual(nxdomain.nameserver_records[0].rtype, RecordType.SOA)
+
+    def test_expired_copy_is_not_used(self):
+        with mock.patch("optimus.dns.root_zone.time.time", return_value=time.time() + 604800):
+            self.assertIsNone(self.root_zone.get_delegation("example.com"))
+            self.assertIsNone(self.root_zone.answer(query("example.invalid")))
+
+    def test_broken_reload_keeps_the_previous_copy(self):
+        with open(self.path, "w") as f:
+            f.write("com. 172800 IN NS a.gtld-servers.net.\n")
+        self.assertFalse(self.root_zone.load())
+        self.assertEqual(self.root_zone.get_delegation("example.com").zone, "com")
+        with self.assertRaises(ValueError):
+            LocalRootZone().configure(self.path)
+
+    def test_resolution_skips_the_root_servers(self):
+        delegation_cache.clear()
+        infra_cache.clear()
+        queried = []
+
+        def query_server(payload, server_addr, alternates=(), deadline=None):
+            queried.append(server_addr)
+            return bytes()
+
+        with (
+            mock.patch("optimus.dns.resolver.local_root_zone", self.root_zone),
+            mock.patch("optimus.dns.resolver.query_server", query_server),
+        ):
+            self.assertEqual(resolve(query("www.example.invalid")).header.response_code, ResponseCode.NXDOMAIN)
+            self.assertEqual(queried, [])
+            resolve(query("www.example.com"))
+        self.assertEqual(set(queried), {"192.5.6.30"})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+import time
+import unittest
+from ipaddress import IPv4Address
+from unittest import mock
+
+from optimus.dns.cache import DEFAULT_MAX_NEGATIVE_TTL, STALE_ANSWER_TTL, record_cache, response_cache
+from optimus.dns.models.packet import DNSHeader, DNSPacket, ResponseCode
+from optimus.dns.models.records import A, SOA, RecordClass, RecordType
+from optimus.dns.parser.parse import DNSParser
+from optimus.server.handler import get_stale_response, handle_query
+from tests.helpers import query_bin
+
+
+def servfail(qpacket, deadline=None):
+    return DNSPacket(
+        DNSHeader(id=qpacket.header.ID, question_count=1, response_code=ResponseCode.SERVFAIL), qpacket.questions
+    )
+
+
+class TestServeStale(unittest.TestCase):
+
+    def setUp(self):
+        for cache in (record_cache, response_cache):
+            cache.clear()
+            self.addCleanup(cache.clear)
+        # Cached an hour ago with a TTL of 5 minutes
+        with mock.patch("optimus.dns.cache.time.monotonic", return_value=time.monotonic() - 3600):
+            record_cache.put(
+                "example.com",
+                RecordType.A,
+                RecordClass.IN,
+                [A("example.com", RecordType.A, RecordClass.IN, 300, 4, IPv4Address("10.0.0.1"))],
+            )
+
+    def test_stale_answer_served_when_resolution_fails(self):
+        with mock.patch("optimus.server.handler.resolve", servfail):
+            response_bytes, was_success = handle_query(query_bin("example.com"))
+        response = DNSParser(bytearray(response_bytes)).get_dns_packet()
+        self.assertTrue(was_success)
+        self.assertEqual(response.header.ID, 7)
+        self.assertEqual(str(response.answers[0].ipv4_address), "10.0.0.1")
+        self.assertEqual(response.answers[0].ttl, STALE_ANSWER_TTL)
+        # Stale answer keeps being served from cache for a while, without trying upstream servers again
+        self.assertIsNotNone(response_cache.get(query_bin("example.com")))
+
+    def test_servfail_without_stale_answer(self):
+        with mock.patch("optimus.server.handler.resolve", servfail):
+            response_bytes, was_success = handle_query(query_bin("other.com"))
+        self.assertFalse(was_success)
+        self.assertEqual(response_bytes[3] & 0x0F, ResponseCode.SERVFAIL.value)
+
+    def test_stale_answer_for_slow_resolution(self):
+        response_bytes, was_success = get_stale_response(query_bin("example.com"))
+        self.assertEqual(DNSParser(bytearray(response_bytes)).get_dns_packet().answers[0].ttl, STALE_ANSWER_TTL)
+        self.assertIsNone(get_stale_response(query_bin("other.com")))
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        for cache in (record_cache, response_cache):
+            cache.clear()
+            self.addCleanup(cache.clear)
+        record_cache.configure(max_negative_ttl=60)
+        self.addCleanup(record_cache.configure, max_negative_ttl=DEFAULT_MAX_NEGATIVE_TTL)
+
+    def test_denials_are_cached_for_their_negative_ttl(self):
+        def nxdomain(qpacket, deadline=None):
+            soa = SOA("com", RecordType.SOA, RecordClass.IN, 86400, 0, "ns.com", "admin.com", 1, 1800, 900, 86400, 300)
+            return DNSPacket(
+                DNSHeader(
+                    id=qpacket.header.ID,
+                    question_count=1,
+                    nameserver_records_count=1,
+                    response_code=ResponseCode.NXDOMAIN,
+                ),
+                qpacket.questions,
+                nameserver_records=[soa],
+            )
+
+        with mock.patch("optimus.server.handler.resolve", nxdomain):
+            response_bytes, _ = handle_query(query_bin("missing.com"))
+        self.assertEqual(DNSParser(bytearray(response_bytes)).get_dns_packet().nameserver_records[0].ttl, 60)
+        self.assertIsNotNone(response_cache.get(query_bin("missing.com")))
+        with mock.patch("optimus.dns.cache.time.monotonic", return_value=time.monotonic() + 61):
+            self.assertIsNone(response_cache.get(query_bin("missing.com")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+import os
+import tempfile
+import time
+import unittest
+from ipaddress import IPv4Address
+from unittest import mock
+
+from optimus.dns.cache import Delegation, delegation_cache, record_cache
+from optimus.dns.models.packet import ResponseCode
+from optimus.dns.models.records import SOA, A, RecordClass, RecordType
+from optimus.dns.parser.parse import DNSParser
+from optimus.dns.snapshot import (
+    ENTRY_HEADER_FORMAT,
+    RESPONSE_ENTRY,
+    SNAPSHOT_HEADER_FORMAT,
+    SNAPSHOT_MAGIC,
+    SNAPSHOT_VERSION,
+    CacheSnapshot,
+)
+from tests.helpers import query
+
+
+class TestCacheSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "cache.snapshot")
+        self.hot_names_path = os.path.join(directory.name, "hot_names")
+        self.snapshot = CacheSnapshot(self.path, hot_names_path=self.hot_names_path)
+        for cache in (record_cache, delegation_cache):
+            cache.clear()
+            self.addCleanup(cache.clear)
+
+    def test_caches_are_restored_with_ttls_counted_down(self):
+        record_cache.put(
+            "example.com",
+            RecordType.A,
+            RecordClass.IN,
+            [A("example.com", RecordType.A, RecordClass.IN, 300, 4, IPv4Address("10.0.0.1"))],
+        )
+        record_cache.put(
+            "short.example.com",
+            RecordType.A,
+            RecordClass.IN,
+            [A("short.example.com", RecordType.A, RecordClass.IN, 60, 4, IPv4Address("10.0.0.2"))],
+        )
+        soa = SOA(
+            "example.com", RecordType.SOA, RecordClass.IN, 600, 0, "ns1.example.com", "admin", 1, 7200, 900, 86400, 600
+        )
+        record_cache.put_negative("missing.example.com", RecordType.A, RecordClass.IN, ResponseCode.NXDOMAIN, soa)
+        delegation_cache.put(Delegation("example.com", ["ns1.example.com"], {"ns1.example.com": ["10.0.0.53"]}, 3600))
+        self.assertEqual(self.snapshot.save(), 4)
+        record_cache.clear()
+        delegation_cache.clear()
+        # Loaded two minutes later, the short lived answer expired in the meantime
+        with mock.patch("optimus.dns.snapshot.time.time", return_value=time.time() + 120):
+            self.assertEqual(self.snapshot.load(), 3)
+        self.assertEqual(record_cache.get("example.com", RecordType.A, RecordClass.IN)[0].ttl, 180)
+        self.assertIsNone(record_cache.get_response(query("short.example.com")))
+        negative = record_cache.get_response(query("www.missing.example.com"))
+        self.assertEqual(negative.header.response_code, ResponseCode.NXDOMAIN)
+        self.assertEqual(negative.nameserver_records[0].ttl, 480)
+        self.assertEqual(delegation_cache.get_closest("www.example.com").get_server_addresses(), ["10.0.0.53"])
+
+    def test_corrupt_snapshot_is_ignored(self):
+        with open(self.path, "wb") as f:
+            f.write(b"not a snapshot at all")
+        self.assertEqual(self.snapshot.load(), 0)
+        self.assertEqual(CacheSnapshot(self.path + ".missing").load(), 0)
+
+    def test_damaged_entries_stop_loading(self):
+        entries = []
+        for name in ("example.com", "example.org"):
+            packet = query(name)
+            packet.header.answer_count = 1
+            packet.answers = [A(name, RecordType.A, RecordClass.IN, 300, 4, IPv4Address("10.0.0.1"))]
+            entries.append(bytes(packet.to_bin()))
+        # Header of the second entry is fine, its record data is cut short
+        entries[1] = entries[1][:-2]
+        with open(self.path, "wb") as f:
+            f.write(SNAPSHOT_HEADER_FORMAT.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, time.time()))
+            for entry in entries:
+                f.write(ENTRY_HEADER_FORMAT.pack(RESPONSE_ENTRY, len(entry)) + entry)
+        self.assertEqual(self.snapshot.load(), 1)
+        self.assertIsNotNone(record_cache.get("example.com", RecordType.A, RecordClass.IN))
+        self.assertIsNone(record_cache.get("example.org", RecordType.A, RecordClass.IN))
+
+    def test_hot_queries(self):
+        with open(self.hot_names_path, "w") as f:
+            f.write("example.com\n# Comment\n\nexample.org aaaa\nexample.net BOGUS\n")
+        queries = [DNSParser(bytearray(q)).get_dns_packet() for q in self.snapshot.get_hot_queries()]
+        self.assertEqual(
+            [(q.questions[0].name, q.questions[0].rtype) for q in queries],
+            [("example.com", RecordType.A), ("example.org", RecordType.AAAA)],
+        )
+        self.assertTrue(queries[0].header.is_recursion_desired)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+import os
+import signal
+import tempfile
+import time
+import unittest
+from typing import Callable, List
+from unittest import mock
+
+from optimus.server.supervisor import SHUTDOWN_TIMEOUT, Supervisor
+
+
+class TestSupervisor(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        patches = [
+            mock.patch("optimus.server.supervisor.start_metrics_server"),
+            mock.patch("optimus.server.supervisor.MIN_WORKER_UPTIME", 0),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def serve(self, index: int) -> None:
+        """Worker which records its pid along with its index, then serves until interrupted"""
+        with open(os.path.join(self.directory, str(os.getpid())), "w") as f:
+            f.write(str(index))
+        try:
+            while True:
+                time.sleep(0.05)
+        except KeyboardInterrupt:
+            pass
+
+    def serve_stubbornly(self, index: int) -> None:
+        """Worker which won't exit on its own"""
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        self.serve(index)
+
+    def start_supervisor(self, workers: int, target: Callable[[int], None]) -> int:
+        pid = os.fork()
+        if pid == 0:
+            # Supervising process, which must never make it back into the test runner
+            exit_code = 1
+            try:
+                Supervisor(workers, target).run()
+                exit_code = 0
+            finally:
+                os._exit(exit_code)
+        self.addCleanup(self.reap, pid)
+        return pid
+
+    def reap(self, pid: int) -> None:
+        try:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        except (ProcessLookupError, ChildProcessError):
+            pass
+
+    def wait_for_workers(self, count: int) -> List[int]:
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            pids = [int(name) for name in os.listdir(self.directory)]
+            if len(pids) >= count:
+                return pids
+            time.sleep(0.01)
+        self.fail(f"Timed out waiting for {count} workers")
+
+    def wait_for_exit(self, pid: int, timeout: float) -> int:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            waited_pid, status = os.waitpid(pid, os.WNOHANG)
+            if waited_pid:
+                return os.waitstatus_to_exitcode(status)
+            time.sleep(0.01)
+        self.fail(f"Process {pid} didn't exit within {timeout}s")
+
+    def get_index(self, pid: int) -> int:
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            with open(os.path.join(self.directory, str(pid))) as f:
+                index = f.read()
+            if index:
+                return int(index)
+            time.sleep(0.01)
+        self.fail(f"Timed out waiting for the index of worker {pid}")
+
+    def assert_exited(self, pids: List[int]) -> None:
+        for pid in pids:
+            with self.assertRaises(ProcessLookupError):
+                os.kill(pid, 0)
+
+    def test_dead_workers_are_respawned_with_their_index(self):
+        supervisor = self.start_supervisor(2, self.serve)
+        workers = self.wait_for_workers(2)
+        self.assertEqual(sorted(self.get_index(pid) for pid in workers), [0, 1])
+        os.kill(workers[0], signal.SIGKILL)
+        respawned = set(self.wait_for_workers(3)) - set(workers)
+        self.assertEqual(len(respawned), 1)
+        self.assert_exited([workers[0]])
+        # Takes over the index of the worker it replaces
+        self.assertEqual(self.get_index(next(iter(respawned))), self.get_index(workers[0]))
+        os.kill(supervisor, signal.SIGTERM)
+        self.assertEqual(self.wait_for_exit(supervisor, SHUTDOWN_TIMEOUT), 0)
+        self.assert_exited([workers[1], *respawned])
+
+    def test_workers_which_dont_exit_are_killed(self):
+        with mock.patch("optimus.server.supervisor.SHUTDOWN_TIMEOUT", 1):
+            supervisor = self.start_supervisor(2, self.serve_stubbornly)
+        workers = self.wait_for_workers(2)
+        os.kill(supervisor, signal.SIGTERM)
+        self.assertEqual(self.wait_for_exit(supervisor, 1 + 2), 0)
+        self.assert_exited(workers)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,196 @@
+import asyncio
+import socket
+import threading
+import time
+import unittest
+from unittest import mock
+
+from optimus.dns.models.packet import ResponseCode
+from optimus.networking.loop import EventLoop
+from optimus.networking.tcp import LENGTH_PREFIX_FORMAT, frame_message, read_messages
+from optimus.server.async_listener import DnsStreamProtocol, QueryAnswerer
+from optimus.server.handler import make_error_response
+from optimus.server.tcp_listener import TcpListener
+from optimus.server.udp_listener import UdpServer
+from tests.helpers import get_free_port, recv_message
+
+# Header of a query without any question
+MALFORMED_QUERY = b"\x12\x34\x01\x00" + bytes(8)
+
+
+class TestFraming(unittest.TestCase):
+
+    def test_frame_message_prefixes_length(self):
+        self.assertEqual(frame_message(b"abc"), b"\x00\x03abc")
+        with self.assertRaises(ValueError):
+            frame_message(bytes(0x10000))
+
+    def test_read_messages_leaves_partial_message_behind(self):
+        buffer = bytearray(frame_message(b"first") + frame_message(b"second") + frame_message(b"third")[:4])
+        self.assertEqual(read_messages(buffer), [b"first", b"second"])
+        self.assertEqual(buffer, LENGTH_PREFIX_FORMAT.pack(5) + b"th")
+        buffer.extend(b"ird")
+        self.assertEqual(read_messages(buffer), [b"third"])
+        self.assertEqual(buffer, b"")
+
+    def test_read_messages_waits_for_length_prefix(self):
+        buffer = bytearray(b"\x00")
+        self.assertEqual(read_messages(buffer), [])
+        self.assertEqual(buffer, b"\x00")
+
+
+class TestTcpListener(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = EventLoop()
+        self.port = get_free_port()
+        self.replies = dict()
+        self.listener = TcpListener(self.loop, self.port, self.dispatch, max_connections=2, idle_timeout=0.2)
+        self.listener.open()
+        thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        thread.start()
+
+        def stop():
+            self.loop.call_soon_threadsafe(self.listener.close)
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            thread.join()
+            self.loop.close()
+
+        self.addCleanup(stop)
+
+    def dispatch(self, query, address, reply):
+        if query == b"dropped":
+            return False
+        # Hold on to the reply callbacks, so that the test decides on the order queries get answered in
+        self.replies[query] = reply
+        return True
+
+    def connect(self) -> socket.socket:
+        sock = socket.create_connection(("127.0.0.1", self.port), timeout=2)
+        self.addCleanup(sock.close)
+        return sock
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 2
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail("Timed out")
+            time.sleep(0.01)
+
+    def test_pipelined_queries_are_answered_out_of_order(self):
+        sock = self.connect()
+        sock.sendall(frame_message(b"first") + frame_message(b"dropped") + frame_message(b"second"))
+        self.wait_for(lambda: len(self.replies) == 2)
+        # Replies may come from worker threads
+        threading.Thread(target=self.replies[b"second"], args=(b"second answer",)).start()
+        self.assertEqual(recv_message(sock), b"second answer")
+        self.replies[b"first"](b"first answer")
+        self.assertEqual(recv_message(sock), b"first answer")
+
+    def test_connection_closed_once_client_is_done_and_answered(self):
+        sock = self.connect()
+        sock.sendall(frame_message(b"query"))
+        sock.shutdown(socket.SHUT_WR)
+        self.wait_for(lambda: b"query" in self.replies)
+        self.replies[b"query"](b"answer")
+        self.assertEqual(recv_message(sock), b"answer")
+        self.assertEqual(sock.recv(10), b"")
+        self.wait_for(lambda: self.listener.connection_count() == 0)
+
+    def test_idle_connections_are_closed(self):
+        sock = self.connect()
+        self.wait_for(lambda: self.listener.connection_count() == 1)
+        self.assertEqual(sock.recv(10), b"")
+        self.wait_for(lambda: self.listener.connection_count() == 0)
+
+    def test_connections_beyond_limit_are_refused(self):
+        self.connect()
+        self.connect()
+        self.wait_for(lambda: self.listener.connection_count() == 2)
+        refused = self.connect()
+        self.assertEqual(refused.recv(10), b"")
+        self.assertEqual(self.listener.connection_count(), 2)
+
+
+class TestMalformedQueries(unittest.TestCase):
+
+    def setUp(self):
+        self.port = get_free_port()
+
+    def start_threaded_server(self):
+        server = UdpServer(self.port, 2, tcp_idle_timeout=0.2)
+        patcher = mock.patch("optimus.prometheus.start_metrics_server")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        thread = threading.Thread(target=server.run, daemon=True)
+        thread.start()
+
+        def stop():
+            loop = server._UdpServer__loop
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+
+        self.addCleanup(stop)
+
+    def start_async_server(self):
+        loop = asyncio.new_event_loop()
+        tcp_server = loop.run_until_complete(
+            loop.create_server(
+                lambda: DnsStreamProtocol(QueryAnswerer(), set(), max_connections=2, idle_timeout=0.2),
+                host="127.0.0.1",
+                port=self.port,
+            )
+        )
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+
+        def stop():
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            tcp_server.close()
+            loop.run_until_complete(tcp_server.wait_closed())
+            loop.close()
+
+        self.addCleanup(stop)
+
+    def connect(self) -> socket.socket:
+        deadline = time.monotonic() + 2
+        while True:
+            try:
+                sock = socket.create_connection(("127.0.0.1", self.port), timeout=2)
+                break
+            except ConnectionRefusedError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.01)
+        self.addCleanup(sock.close)
+        return sock
+
+    def assert_answered_and_closed(self):
+        sock = self.connect()
+        sock.sendall(frame_message(MALFORMED_QUERY))
+        response = recv_message(sock)
+        self.assertEqual(response, make_error_response(MALFORMED_QUERY))
+        self.assertEqual(response[:2], MALFORMED_QUERY[:2])
+        self.assertEqual(response[3] & 0xF, ResponseCode.FORMERR.value)
+        sock.shutdown(socket.SHUT_WR)
+        self.assertEqual(sock.recv(10), b"")
+
+    def test_threaded_server_answers_malformed_queries(self):
+        self.start_threaded_server()
+        self.assert_answered_and_closed()
+
+    def test_async_server_answers_malformed_queries(self):
+        self.start_async_server()
+        self.assert_answered_and_closed()
+
+    def test_make_error_response(self):
+        self.assertEqual(make_error_response(b"\x12"), b"\x12\x00\x80\x01" + bytes(8))
+        query = b"\xab\xcd\x01\x20\x00\x01" + bytes(6) + b"\x03com\x00\x00\x01\x00\x01"
+        self.assertEqual(
+            make_error_response(query), b"\xab\xcd\x81\x02\x00\x01" + bytes(6) + b"\x03com\x00\x00\x01\x00\x01"
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,245 @@
+import asyncio
+import socket
+import threading
+import time
+import unittest
+from concurrent import futures
+from typing import List
+from unittest import mock
+
+from optimus.networking.tcp import frame_message, read_messages
+from optimus.networking.transport import UdpTransport
+from optimus.dns.cache import infra_cache
+from optimus.networking.hedging import HedgingPolicy, hedging_policy
+from optimus.networking.udp import query_server, query_server_async
+from tests.helpers import query_bin
+
+
+class FakeServer:
+    """UDP server answering every query by echoing it back with the QR bit set, unless told to tamper with it"""
+
+    def __init__(self) -> None:
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.port = self.sock.getsockname()[1]
+        self.received_ids: List[bytes] = []
+        self.tamper_id = False
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self) -> None:
+        while True:
+            try:
+                data, address = self.sock.recvfrom(600)
+            except OSError:
+                return
+            self.received_ids.append(data[0:2])
+            response = bytearray(data)
+            response[2] |= 0x80
+            if self.tamper_id:
+                response[0] ^= 0xFF
+            try:
+                self.sock.sendto(response, address)
+            except OSError:
+                return
+
+
+class FakeTcpServer:
+    """TCP server answering queries in batches of `batch_size`, most recent query first"""
+
+    def __init__(self, batch_size: int = 1) -> None:
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen()
+        self.port = self.sock.getsockname()[1]
+        self.batch_size = batch_size
+        self.accepted = 0
+        self.closed = threading.Event()
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self) -> None:
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            self.accepted += 1
+            threading.Thread(target=self.serve_connection, args=(conn,), daemon=True).start()
+
+    def serve_connection(self, conn: socket.socket) -> None:
+        buffer = bytearray()
+        queries: List[bytes] = []
+        with conn:
+            while True:
+                data = conn.recv(4096)
+                if not data:
+                    self.closed.set()
+                    return
+                buffer.extend(data)
+                queries.extend(read_messages(buffer))
+                while len(queries) >= self.batch_size:
+                    batch, queries = queries[: self.batch_size], queries[self.batch_size :]
+                    for query in reversed(batch):
+                        response = bytearray(query)
+                        response[2] |= 0x80
+                        conn.sendall(frame_message(response))
+
+
+class TestUdpTransport(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = UdpTransport(pool_size=2)
+        self.server = FakeServer()
+        self.addCleanup(self.server.sock.close)
+        self.addCleanup(self.transport.attach, None)
+
+    def test_response_carries_original_id(self):
+        response = self.transport.submit(query_bin("google.com", id=1234), "127.0.0.1", self.server.port)
+        data = response.result(timeout=2)
+        self.assertEqual(data[0:2], (1234).to_bytes(2, "big"))
+        self.assertTrue(data[2] & 0x80)
+        self.assertEqual(self.transport.pending_count(), 0)
+
+    def test_concurrent_queries_get_their_own_responses(self):
+        responses = [
+            self.transport.submit(query_bin(f"host{i}.example.com", id=7), "127.0.0.1", self.server.port)
+            for i in range(50)
+        ]
+        for i, response in enumerate(responses):
+            data = response.result(timeout=2)
+            self.assertIn(f"host{i}".encode(), data)
+            self.assertEqual(data[0:2], (7).to_bytes(2, "big"))
+        # Upstream only ever sees IDs chosen by the transport
+        self.assertEqual(len(self.server.received_ids), 50)
+
+    def test_runs_on_asyncio_loop(self):
+        async def resolve() -> bytes:
+            self.transport.attach(asyncio.get_running_loop())
+            try:
+                response = self.transport.submit(query_bin("google.com", id=1234), "127.0.0.1", self.server.port)
+                return await asyncio.wait_for(asyncio.wrap_future(response), timeout=2)
+            finally:
+                self.transport.attach(None)
+
+        data = asyncio.run(resolve())
+        self.assertEqual(data[0:2], (1234).to_bytes(2, "big"))
+        # No loop of its own was started to run the query on
+        self.assertNotIn("upstream", [thread.name for thread in threading.enumerate()])
+
+    def test_mismatched_response_is_dropped(self):
+        self.server.tamper_id = True
+        response = self.transport.submit(query_bin("google.com", id=1), "127.0.0.1", self.server.port, timeout=0.2)
+        self.assertRaises(TimeoutError, response.result, 2)
+        self.assertEqual(self.transport.pending_count(), 0)
+
+    def test_detach_fails_pending_queries(self):
+        self.server.sock.close()
+        response = self.transport.submit(query_bin("google.com", id=1), "127.0.0.1", self.server.port)
+        futures.wait([response], timeout=0.1)
+        self.transport.attach(None)
+        self.assertRaises(ConnectionAbortedError, response.result, 2)
+
+
+class TestTcpTransport(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = UdpTransport(pool_size=2, tcp_idle_timeout=0.2)
+        self.server = FakeTcpServer(batch_size=2)
+        self.addCleanup(self.server.sock.close)
+        self.addCleanup(self.transport.attach, None)
+
+    def submit(self, query_id: int, name: str) -> futures.Future:
+        response: futures.Future = self.transport.submit(
+            query_bin(name, id=query_id), "127.0.0.1", self.server.port, over_tcp=True
+        )
+        return response
+
+    def test_pipelined_queries_share_a_connection(self):
+        first, second = self.submit(1, "first.example.com"), self.submit(2, "second.example.com")
+        # Answered in reverse order, each still gets its own response
+        self.assertIn(b"first", first.result(timeout=2))
+        self.assertEqual(first.result()[0:2], (1).to_bytes(2, "big"))
+        self.assertIn(b"second", second.result(timeout=2))
+        self.assertEqual(second.result()[0:2], (2).to_bytes(2, "big"))
+        self.assertEqual(self.server.accepted, 1)
+
+    def test_idle_connection_is_reused_then_closed(self):
+        self.server.batch_size = 1
+        self.submit(1, "first.example.com").result(timeout=2)
+        self.submit(2, "second.example.com").result(timeout=2)
+        self.assertEqual(self.server.accepted, 1)
+        self.assertTrue(self.server.closed.wait(2))
+        time.sleep(0.05)
+        self.assertEqual(self.transport.connection_count(), 0)
+
+    def test_refused_connection_fails_query(self):
+        self.server.sock.close()
+        self.assertRaises(OSError, self.submit(1, "google.com").result, 2)
+
+
+class TestQueryServer(unittest.TestCase):
+
+    def setUp(self):
+        infra_cache.clear()
+        self.addCleanup(infra_cache.clear)
+        self.addCleanup(hedging_policy.configure, 0)
+
+    def test_truncated_response_is_retried_over_tcp(self):
+        query = query_bin("google.com", id=1)
+        truncated, full = bytearray(query), bytearray(query)
+        truncated[2] |= 0x82
+        full[2] |= 0x80
+        responses: List[futures.Future] = [futures.Future(), futures.Future()]
+        responses[0].set_result(bytes(truncated))
+        responses[1].set_result(bytes(full))
+        transport = mock.Mock()
+        transport.submit.side_effect = responses
+        with mock.patch("optimus.networking.udp.upstream_transport", transport):
+            self.assertEqual(query_server(bytearray(query), "10.0.0.53"), bytes(full))
+        self.assertEqual(
+            transport.submit.call_args_list[1],
+            mock.call(bytearray(query), "10.0.0.53", port=53, timeout=5, over_tcp=True),
+        )
+
+    def test_deadline_bounds_the_timeout(self):
+        query = query_bin("google.com", id=1)
+        transport = mock.Mock()
+        with mock.patch("optimus.networking.udp.upstream_transport", transport):
+            self.assertEqual(query_server(bytearray(query), "10.0.0.53", deadline=time.monotonic() - 1), b"")
+            transport.submit.assert_not_called()
+            response: futures.Future = futures.Future()
+            response.set_exception(TimeoutError())
+            transport.submit.return_value = response
+            self.assertEqual(query_server(bytearray(query), "10.0.0.53", deadline=time.monotonic() + 0.2), b"")
+        self.assertLessEqual(transport.submit.call_args.kwargs["timeout"], 0.2)
+        # Server isn't blamed for a timeout cut short by the deadline
+        self.assertEqual(len(infra_cache), 0)
+
+    def test_slow_server_is_hedged(self):
+        hedging_policy.configure(1.0)
+        # Known to be fast, so that it's hedged after the minimal delay
+        infra_cache.record_rtt("10.0.0.53", 0.001)
+        query = query_bin("google.com", id=1)
+        for query_function in (query_server, lambda *args: asyncio.run(query_server_async(*args))):
+            responses = {"10.0.0.53": futures.Future(), "10.0.0.54": futures.Future()}
+            responses["10.0.0.54"].set_result(b"hedged response")
+            transport = mock.Mock()
+            transport.submit.side_effect = lambda payload, server_addr, **kwargs: responses[server_addr]
+            with mock.patch("optimus.networking.udp.upstream_transport", transport):
+                self.assertEqual(query_function(bytearray(query), "10.0.0.53", ["10.0.0.54"]), b"hedged response")
+            # Slow server is given up on
+            self.assertTrue(responses["10.0.0.53"].cancelled())
+
+
+class TestHedgingPolicy(unittest.TestCase):
+
+    def test_hedges_are_capped(self):
+        policy = HedgingPolicy(max_ratio=0.5)
+        self.assertIsNone(policy.get_delay("10.0.0.53", []))
+        self.assertIsNotNone(policy.get_delay("10.0.0.53", ["10.0.0.54"]))
+        self.assertFalse(policy.try_hedge())
+        policy.get_delay("10.0.0.53", ["10.0.0.54"])
+        self.assertTrue(policy.try_hedge())
+        self.assertFalse(policy.try_hedge())
+
+    def test_hedging_disabled_by_default(self):
+        self.assertIsNone(HedgingPolicy().get_delay("10.0.0.53", ["10.0.0.54"]))
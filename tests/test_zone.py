@@ -0,0 +1,74 @@
+import unittest
+from ipaddress import IPv4Address
+
+from optimus.dns.models.records import RecordType
+from optimus.dns.parser.zone import ZoneFileParser, parse_ttl
+
+ZONE = """\
+$ORIGIN example.com.
+$TTL 1h
+@   IN  SOA ns1 hostmaster (
+            2024010101 ; serial
+            2h 15m 2w 300 )
+    IN  NS  ns1
+        NS  ns2.example.net.
+ns1 60 IN A 10.0.0.53
+www IN 120 CNAME @
+@   MX  10 mail
+txt TXT "v=spf1 -all" "semi;colon \\"quoted\\""
+ptr PTR www.example.com.
+ds  DS  12345 8 2 ABCDEF
+raw TYPE99 \\# 3 abcdef
+"""
+
+
+class TestZoneFileParser(unittest.TestCase):
+
+    def test_parses_master_file_entries(self):
+        parser = ZoneFileParser(ZONE.splitlines(True), source="example.zone")
+        records = parser.get_records()
+        self.assertEqual(
+            [(rec.name, rec.rtype, rec.ttl) for rec in records],
+            [
+                ("example.com", RecordType.SOA, 3600),
+                ("example.com", RecordType.NS, 3600),
+                ("example.com", RecordType.NS, 3600),
+                ("ns1.example.com", RecordType.A, 60),
+                ("www.example.com", RecordType.CNAME, 120),
+                ("example.com", RecordType.MX, 3600),
+                ("txt.example.com", RecordType.TXT, 3600),
+                ("ptr.example.com", RecordType.PTR, 3600),
+                ("raw.example.com", RecordType.UNKNOWN, 3600),
+            ],
+        )
+        soa, ns1, ns2, a, cname, mx, txt, ptr, raw = records
+        self.assertEqual((soa.mname, soa.rname, soa.serial), ("ns1.example.com", "hostmaster.example.com", 2024010101))
+        self.assertEqual((soa.refresh, soa.retry, soa.expire, soa.minimum), (7200, 900, 1209600, 300))
+        self.assertEqual([ns1.nsdname, ns2.nsdname], ["ns1.example.com", "ns2.example.net"])
+        self.assertEqual(a.ipv4_address, IPv4Address("10.0.0.53"))
+        self.assertEqual(cname.cname, "example.com")
+        self.assertEqual((mx.preference, mx.exchange), (10, "mail.example.com"))
+        self.assertEqual(txt.rdata, b'\x0bv=spf1 -all\x13semi;colon "quoted"')
+        self.assertEqual(ptr.rdata, b"\x03www\x07example\x03com\x00")
+        self.assertEqual((raw.type_value, raw.rdata), (99, b"\xab\xcd\xef"))
+        self.assertEqual(parser.skipped_types, {"DS"})
+
+    def test_errors_point_at_the_line(self):
+        for zone, line in [
+            ("$TTL 60\n@ IN SOA ns1 admin 1 2 3 4\n", 2),
+            ("$TTL 60\nwww A 10.0.0.1\n( A 10.0.0.2\n", 3),
+            ("www A 10.0.0.1\n", 1),
+            ("$INCLUDE /etc/passwd\n", 1),
+        ]:
+            with self.assertRaisesRegex(ValueError, f"^test.zone, line {line}: "):
+                ZoneFileParser(zone.splitlines(True), origin="example.com", source="test.zone").get_records()
+
+    def test_parse_ttl(self):
+        self.assertEqual(parse_ttl("86400"), 86400)
+        self.assertEqual(parse_ttl("1d2H30m"), 95400)
+        with self.assertRaises(ValueError):
+            parse_ttl("1y")
+
+
+if __name__ == "__main__":
+    unittest.main()